@@ -0,0 +1,3 @@
+DROP INDEX IF EXISTS BucketName;
+DROP INDEX IF EXISTS FileBucketId;
+DROP INDEX IF EXISTS FileLocalFileId;
\ No newline at end of file
@@ -0,0 +1,5 @@
+CREATE UNIQUE INDEX [BucketName] ON bucket(name);
+
+CREATE INDEX [FileBucketId] ON file(bucket_id, id);
+
+CREATE INDEX [FileLocalFileId] ON file(local_file_id);
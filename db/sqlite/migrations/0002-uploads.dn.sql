@@ -0,0 +1,3 @@
+DROP TABLE IF EXISTS upload_part;
+DROP INDEX IF EXISTS UploadLastUpdated;
+DROP TABLE IF EXISTS upload;
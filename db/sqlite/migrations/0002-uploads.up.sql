@@ -0,0 +1,20 @@
+CREATE TABLE upload
+(
+    id CHAR(36) PRIMARY KEY,
+    file_id CHAR(36) NOT NULL,
+    part_size INT NOT NULL,
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    FOREIGN KEY(file_id) REFERENCES file(id)
+);
+
+CREATE INDEX [UploadLastUpdated] ON upload(last_updated);
+
+CREATE TABLE upload_part
+(
+    upload_id CHAR(36) NOT NULL,
+    number INT NOT NULL,
+    size INT NOT NULL,
+    PRIMARY KEY(upload_id, number),
+    FOREIGN KEY(upload_id) REFERENCES upload(id)
+);
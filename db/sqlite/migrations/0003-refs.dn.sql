@@ -0,0 +1,7 @@
+DROP TRIGGER IF EXISTS FileUpdateRefs;
+DROP TRIGGER IF EXISTS FileDeleteRefs;
+DROP TRIGGER IF EXISTS FileInsertRefs;
+DROP INDEX IF EXISTS UploadFileId;
+DROP INDEX IF EXISTS FilePending;
+DROP INDEX IF EXISTS LocalFileUnreferenced;
+ALTER TABLE local_file DROP COLUMN refs;
@@ -0,0 +1,37 @@
+ALTER TABLE local_file ADD COLUMN refs INT NOT NULL DEFAULT 0;
+
+UPDATE local_file SET refs = (SELECT COUNT(*) FROM file WHERE file.local_file_id = local_file.id);
+
+CREATE INDEX [LocalFileUnreferenced] ON local_file(id) WHERE refs = 0;
+
+CREATE INDEX [FilePending] ON file(created) WHERE pending = 1;
+
+CREATE INDEX [UploadFileId] ON upload(file_id);
+
+CREATE TRIGGER [FileInsertRefs]
+    AFTER INSERT
+    ON file
+    FOR EACH ROW
+    WHEN NEW.local_file_id IS NOT NULL
+    BEGIN
+        UPDATE local_file SET refs = refs + 1 WHERE id = NEW.local_file_id;
+    END;
+
+CREATE TRIGGER [FileDeleteRefs]
+    AFTER DELETE
+    ON file
+    FOR EACH ROW
+    WHEN OLD.local_file_id IS NOT NULL
+    BEGIN
+        UPDATE local_file SET refs = refs - 1 WHERE id = OLD.local_file_id;
+    END;
+
+CREATE TRIGGER [FileUpdateRefs]
+    AFTER UPDATE OF local_file_id
+    ON file
+    FOR EACH ROW
+    WHEN OLD.local_file_id IS NOT NEW.local_file_id
+    BEGIN
+        UPDATE local_file SET refs = refs - 1 WHERE id = OLD.local_file_id;
+        UPDATE local_file SET refs = refs + 1 WHERE id = NEW.local_file_id;
+    END;
@@ -0,0 +1,2 @@
+ALTER TABLE local_file DROP COLUMN size;
+ALTER TABLE local_file DROP COLUMN encoding;
@@ -0,0 +1,3 @@
+ALTER TABLE local_file ADD COLUMN encoding TEXT NOT NULL DEFAULT 'identity';
+
+ALTER TABLE local_file ADD COLUMN size INT NOT NULL DEFAULT 0;
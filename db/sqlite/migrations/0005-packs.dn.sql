@@ -0,0 +1,3 @@
+DROP INDEX IF EXISTS PackedBlobSegment;
+DROP TABLE IF EXISTS packed_blob;
+DROP TABLE IF EXISTS segment;
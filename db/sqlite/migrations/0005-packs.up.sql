@@ -0,0 +1,17 @@
+CREATE TABLE segment
+(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path VARCHAR NOT NULL
+);
+
+CREATE TABLE packed_blob
+(
+    id CHAR(32) PRIMARY KEY,
+    segment_id INT NOT NULL,
+    offset INT NOT NULL,
+    length INT NOT NULL,
+    FOREIGN KEY(id) REFERENCES local_file(id),
+    FOREIGN KEY(segment_id) REFERENCES segment(id)
+);
+
+CREATE INDEX [PackedBlobSegment] ON packed_blob(segment_id, length);
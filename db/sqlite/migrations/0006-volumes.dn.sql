@@ -0,0 +1,2 @@
+ALTER TABLE segment DROP COLUMN volume;
+ALTER TABLE local_file DROP COLUMN volume;
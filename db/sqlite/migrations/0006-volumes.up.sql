@@ -0,0 +1,3 @@
+ALTER TABLE local_file ADD COLUMN volume TEXT NOT NULL DEFAULT '';
+
+ALTER TABLE segment ADD COLUMN volume TEXT NOT NULL DEFAULT '';
@@ -0,0 +1 @@
+CREATE INDEX [FileBucketFolder] ON file(bucket_id, path || '/', name);
@@ -0,0 +1,2 @@
+DROP INDEX IF EXISTS PackedBlobSegment;
+CREATE INDEX [PackedBlobSegment] ON packed_blob(segment_id, id, length);
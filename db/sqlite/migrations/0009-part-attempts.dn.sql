@@ -0,0 +1,2 @@
+ALTER TABLE upload_part DROP COLUMN attempt;
+ALTER TABLE upload DROP COLUMN attempts;
@@ -0,0 +1,3 @@
+ALTER TABLE upload ADD COLUMN attempts INT NOT NULL DEFAULT 0;
+
+ALTER TABLE upload_part ADD COLUMN attempt INT NOT NULL DEFAULT 0;
@@ -1,24 +1,57 @@
 import falcon
-import sqlite3
+import typing
+from .background import Periodic
+from .collector import collector
+from .config import Config
+from .copies import FileCopyResource, FileMoveResource
+from .db import ConnectionPool
+from .archives import ArchiveResource
+from .batch import FileBatchResource
 from .buckets import BucketCollectionResource, BucketResource
 from .files import FileCollectionResource, FilesResource
 from .local_files import LocalFileResource
+from .metrics import MetricsMiddleware, metrics
+from .monitoring import MetricsResource, ProfileResource
+from .uploads import UploadCollectionResource, UploadPartResource, UploadResource, upload_expiry
+from .volumes import Volume, Volumes
 
 
-class API(falcon.API):
+class API(falcon.App):
     """ The HTTP REST API for the storage service. """
 
-    def __init__(self, sql_conn: sqlite3.Connection, volume: str):
-        super().__init__()
-        file_collection = FileCollectionResource(sql_conn, volume)
-        files = FilesResource(sql_conn, volume)
-        bucket_collection = BucketCollectionResource(sql_conn, volume)
-        buckets = BucketResource(sql_conn, volume)
-        data = LocalFileResource(sql_conn, volume)
-        # If GETting a file, id is [file].id, if POSTing, if is [local_file].id
-        # e.g. on GET it is a uuid.v4, on POST it is a md5 sum
-        self.add_route("/buckets/{bucket}/files", file_collection)
-        self.add_route("/buckets/{bucket}/files/{file}/data/{checksum}", data)
-        self.add_route("/buckets/{bucket}/files/{file}", files)
-        self.add_route("/buckets", bucket_collection)
-        self.add_route("/buckets/{bucket}", buckets)
+    # If GETting a file, id is [file].id, if POSTing, if is [local_file].id
+    # e.g. on GET it is a uuid.v4, on POST it is a md5 sum
+    routes = {
+        "/buckets/{bucket}/files": FileCollectionResource,
+        "/buckets/{bucket}/files/{file}/data/{checksum}": LocalFileResource,
+        "/buckets/{bucket}/files/{file}/uploads": UploadCollectionResource,
+        "/buckets/{bucket}/files/{file}/uploads/{upload}": UploadResource,
+        "/buckets/{bucket}/files/{file}/uploads/{upload}/parts/{number:int}": UploadPartResource,
+        "/buckets/{bucket}/files/{file}/copy": FileCopyResource,
+        "/buckets/{bucket}/files/{file}/move": FileMoveResource,
+        "/buckets/{bucket}/files/{file}": FilesResource,
+        "/buckets/{bucket}/batch": FileBatchResource,
+        "/buckets/{bucket}/archive": ArchiveResource,
+        "/buckets": BucketCollectionResource,
+        "/buckets/{bucket}": BucketResource,
+        "/metrics": MetricsResource,
+        "/metrics/profile": ProfileResource,
+    }
+
+    def __init__(self, db: ConnectionPool, volume: typing.Union[str, Volumes], config: Config = None):
+        """ volume is the volumes blobs are stored in, or the root of the only one. The app runs no background
+        services of its own: start those of background_services once per node, e.g. with serve(background=...) """
+        super().__init__(middleware=[MetricsMiddleware(metrics)])
+        volumes = Volumes.of(volume)
+        for route, resource in self.routes.items():
+            self.add_route(route, resource(db, volumes, config))
+
+
+def background_services(db: ConnectionPool, volume: typing.Union[str, Volumes], config: Config = None
+                        ) -> typing.List[Periodic]:
+    """ The threads which expire abandoned uploads and, unless config.gc_interval is 0, collect unused blobs, not yet
+    started. One set is enough per node: each service only acts from one process at a time anyway """
+    volumes = Volumes.of(volume)
+    config = config or Config()
+    gc = collector(db, volumes, config)
+    return [upload_expiry(db, volumes, config)] + ([gc] if gc is not None else [])
@@ -1,7 +1,8 @@
 import pytest
 import json
-from .test import headers_json, client, headers_binary, db
+from .test import headers_json, client, headers_binary, db, pool, tempd
 from hashlib import md5
+from .collector import Collector
 from .models.local_file import LocalFile
 
 
@@ -80,6 +81,42 @@ def test_list_files(client, file_id):
     assert result.json[0]['id'] == file_id
 
 
+def test_list_files_paginated(client, file_id):
+    for name in ("a.txt", "b.txt"):
+        file = {"name": name, "mime": "text/plaintext", "path": "test/path"}
+        result = client.simulate_post("/buckets/default/files", body=json.dumps(file), headers=headers_json)
+        assert result.status_code == 201
+    ids = []
+    after = None
+    while True:
+        params = {"limit": 2}
+        if after is not None:
+            params["after"] = after
+        result = client.simulate_get("/buckets/default/files", params=params, headers=headers_json)
+        assert result.status_code == 200
+        assert len(result.json) <= 2
+        ids += [each['id'] for each in result.json]
+        after = result.headers.get("X-Next-Cursor")
+        if after is None:
+            break
+    assert len(ids) == 3
+    assert ids == sorted(ids)
+    assert file_id in ids
+
+
+def test_list_files_streamed(client):
+    result = client.simulate_get("/buckets/default/files", params={"stream": "json"}, headers=headers_json)
+    assert result.status_code == 200
+    assert len(result.json) == 3
+    result = client.simulate_get("/buckets/default/files", params={"stream": "ndjson"}, headers=headers_json)
+    assert result.status_code == 200
+    assert result.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in result.text.splitlines()]
+    assert len(rows) == 3
+    result = client.simulate_get("/buckets/default/files", params={"stream": "xml"}, headers=headers_json)
+    assert result.status_code == 400
+
+
 def test_get_bucket_missing(client):
     result = client.simulate_get("/buckets/0", headers=headers_json)
     assert result.status_code == 404
@@ -95,6 +132,17 @@ def test_get_local_file_missing(client, file_id):
     assert result.status_code == 404
 
 
+def test_create_local_file_bad_checksum(client, file_id):
+    data = b"test bytes"
+    result = client.simulate_post(f"/buckets/default/files/{file_id}/data/{md5(b'other').hexdigest()}", body=data,
+                                  headers=headers_binary)
+    assert result.status_code == 400
+    result = client.simulate_post(f"/buckets/default/files/{file_id}/data/..", body=data, headers=headers_binary)
+    assert result.status_code == 400
+    result = client.simulate_get(f"/buckets/default/files/{file_id}", headers=headers_json)
+    assert result.json['pending']
+
+
 def test_create_local_file(client, file_id):
     global created_file_data_id
     data = b"test bytes"
@@ -118,11 +166,72 @@ def test_get_local_file(client, file_id, local_file_id):
     assert hash.hexdigest() == local_file_id
 
 
+def test_get_local_file_conditional(client, file_id, local_file_id):
+    url = f"/buckets/default/files/{file_id}/data/{local_file_id}"
+    result = client.simulate_get(url)
+    assert result.headers["etag"] == f'"{local_file_id}"'
+    result = client.simulate_get(url, headers={"If-None-Match": f'"{local_file_id}"'})
+    assert result.status_code == 304
+    assert result.content == b""
+    result = client.simulate_get(url, headers={"If-None-Match": '"other"'})
+    assert result.status_code == 200
+    result = client.simulate_get(url, headers={"If-Modified-Since": "Fri, 31 Dec 9999 23:59:59 GMT"})
+    assert result.status_code == 304
+
+
+def test_get_local_file_ranges(client, file_id, local_file_id):
+    url = f"/buckets/default/files/{file_id}/data/{local_file_id}"
+    result = client.simulate_get(url, headers={"Range": "bytes=5-"})
+    assert result.status_code == 206
+    assert result.content == b"bytes"
+    assert result.headers["content-range"] == "bytes 5-9/10"
+    result = client.simulate_get(url, headers={"Range": "bytes=0-3,-5"})
+    assert result.status_code == 206
+    assert result.headers["content-type"].startswith("multipart/byteranges")
+    assert int(result.headers["content-length"]) == len(result.content)
+    assert b"Content-Range: bytes 0-3/10\r\n\r\ntest\r\n" in result.content
+    assert b"Content-Range: bytes 5-9/10\r\n\r\nbytes\r\n" in result.content
+    result = client.simulate_get(url, headers={"Range": "bytes=10-"})
+    assert result.status_code == 416
+    # a stale If-Range gets the whole, current blob
+    result = client.simulate_get(url, headers={"Range": "bytes=5-", "If-Range": '"other"'})
+    assert result.status_code == 200
+    assert result.content == b"test bytes"
+
+
+def test_dedup_local_file(client, local_file_id):
+    result = client.simulate_head(f"/buckets/default/files/{created_file_id}/data/{md5(b'other').hexdigest()}")
+    assert result.status_code == 404
+    file = {"name": "copy.txt", "mime": "text/plaintext", "path": "test/path"}
+    result = client.simulate_post("/buckets/default/files", body=json.dumps(file), headers=headers_json)
+    copy_id = result.json['id']
+    result = client.simulate_head(f"/buckets/default/files/{copy_id}/data/{local_file_id}")
+    assert result.status_code == 200
+    assert result.headers["content-length"] == str(len(b"test bytes"))
+    # the blob is already stored, so it is attached without a body
+    result = client.simulate_post(f"/buckets/default/files/{copy_id}/data/{local_file_id}", headers=headers_binary)
+    assert result.status_code == 204
+    result = client.simulate_get(f"/buckets/default/files/{copy_id}", headers=headers_json)
+    assert result.json['local_file_id'] == local_file_id
+    assert not result.json['pending']
+    result = client.simulate_get(f"/buckets/default/files/{copy_id}/data/{local_file_id}", headers=headers_binary)
+    assert result.content == b"test bytes"
+    result = client.simulate_delete(f"/buckets/default/files/{copy_id}", headers=headers_json)
+    assert result.status_code == 204
+    # the original file still references the blob
+    result = client.simulate_head(f"/buckets/default/files/{created_file_id}/data/{local_file_id}")
+    assert result.status_code == 200
+
+
 def test_delete_file(client, file_id, local_file_id):
     result = client.simulate_delete(f"/buckets/default/files/{file_id}", headers=headers_json)
     assert result.status_code == 204
-    # Make sure file data was also deleted. This isn't exposed in the API (trying to access data without a File)
+    # Make sure file data is deleted by the collector. This isn't exposed in the API (trying to access data without a
+    # File)
     cursor = db.cursor()
     stmt = LocalFile.find_by_id_statement()
+    assert LocalFile.from_db_row(cursor.execute(stmt, [local_file_id]).fetchone()).refs.value == 0
+    Collector(pool, tempd).run()
+    stmt = LocalFile.find_by_id_statement()
     rows = cursor.execute(stmt, [local_file_id])
     assert rows.fetchone() is None
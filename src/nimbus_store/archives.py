@@ -0,0 +1,253 @@
+import calendar
+import falcon
+import tarfile
+import time
+import typing
+import zipfile
+from datetime import datetime
+from functools import lru_cache
+from .buckets import validate_bucket
+from .compression import IDENTITY, Decompressed
+from .files import DELIMITER, FOLDER, successor
+from .local_files import CHUNK_SIZE
+from .models.file import File
+from .models.local_file import LocalFile
+from .resource import ApiResource
+
+
+# The most files looked up per query while archiving
+ARCHIVE_PAGE = 200
+# The PAX header of each tar entry holding its blob's checksum, so archives can be verified without the service
+CHECKSUM_HEADER = "NIMBUS.checksum"
+# Zip timestamps can't be before 1980
+ZIP_EPOCH = 315532800
+
+# (folder with a trailing DELIMITER, name, rowid), the position in FileBucketFolder order a scan continues after
+Position = typing.Tuple[str, str, int]
+
+
+@lru_cache(maxsize=None)
+def folder_page_statement() -> str:
+    """ Selects the rowid and columns of the files in one folder after a name and rowid, in that order. Parameters
+    are, in order: the bucket id, the folder with a trailing DELIMITER, the name and rowid to continue after, and the
+    maximum number of files """
+    return f"SELECT rowid, {File.select_columns()} FROM [{File.table_name}] WHERE [{File.bucket_id.name}] = ? AND " \
+           f"{FOLDER} = ? AND ([{File.name.name}], rowid) > (?, ?) ORDER BY [{File.name.name}], rowid LIMIT ?"
+
+
+@lru_cache(maxsize=None)
+def tree_page_statement(inclusive: bool, bounded: bool) -> str:
+    """ Selects the rowid and columns of the files in a range of folders, ordered by folder, name and rowid.
+    Parameters are, in order: the bucket id, the folder to start at (if inclusive) or after, the folder to stop before
+    (if bounded) and the maximum number of files """
+    where = [f"[{File.bucket_id.name}] = ?", f"{FOLDER} {'>=' if inclusive else '>'} ?"]
+    if bounded:
+        where.append(f"{FOLDER} < ?")
+    return f"SELECT rowid, {File.select_columns()} FROM [{File.table_name}] WHERE {' AND '.join(where)} " \
+           f"ORDER BY {FOLDER}, [{File.name.name}], rowid LIMIT ?"
+
+
+def archive_scans(prefix: str) -> typing.List[typing.Tuple[str, typing.Optional[str], typing.Optional[Position],
+                                                           typing.Optional[str]]]:
+    """ The scans which find every file whose key starts with prefix: of the folder prefix ends in, for the files
+    whose name starts with the rest of it, if there is a rest, and of the folders under prefix. Each is the range of
+    folders, from and before, the position to start after and the start of the names it is limited to """
+    base = prefix[:prefix.rfind(DELIMITER) + 1]
+    rest = prefix[len(base):]
+    scans = []
+    if rest and base != DELIMITER:
+        folder = base or DELIMITER
+        scans.append((folder, folder + "\0", (folder, rest, 0), rest))
+    scans.append((prefix, successor(prefix), None, None))
+    return scans
+
+
+def file_key(file: File) -> str:
+    return f"{file.path.value}{DELIMITER}{file.name.value}" if file.path.value else file.name.value
+
+
+def archive_name(file: File) -> str:
+    """ The name of a file in an archive, its key without empty, "." or ".." segments, so it always extracts under
+    the directory it is extracted to """
+    return "/".join(part for part in file_key(file).split(DELIMITER) if part not in ("", ".", ".."))
+
+
+def modified(file: File) -> int:
+    """ When the file was last updated, as a unix timestamp """
+    try:
+        return calendar.timegm(datetime.strptime(file.last_updated.value, "%Y-%m-%d %H:%M:%S").timetuple())
+    except ValueError:
+        return 0
+
+
+class TarStream:
+    """ Encodes a tar archive, in the PAX format, a piece at a time. Each method returns the bytes to send next """
+
+    content_type = "application/x-tar"
+    extension = "tar"
+
+    def __init__(self):
+        self._size = 0
+
+    def entry(self, name: str, size: int, mtime: int, checksum: str) -> bytes:
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = size, mtime, 0o644
+        info.pax_headers = {CHECKSUM_HEADER: checksum}
+        self._size = size
+        return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+    def data(self, chunk: bytes) -> bytes:
+        return chunk
+
+    def end_entry(self) -> bytes:
+        return tarfile.NUL * (-self._size % tarfile.BLOCKSIZE)
+
+    def close(self) -> bytes:
+        return tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+class Sink:
+    """ A write only file which keeps what is written to it until it is taken """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipStream:
+    """ Encodes a zip archive a piece at a time. Each method returns the bytes to send next. Entries are stored as
+    is, with their CRC and sizes in a data descriptor after their data, and in ZIP64 form where they need it. The
+    central directory at the end lists every entry, so it is held in memory until then """
+
+    content_type = "application/zip"
+    extension = "zip"
+
+    def __init__(self):
+        self._sink = Sink()
+        self._zip = zipfile.ZipFile(self._sink, "w", zipfile.ZIP_STORED)
+        self._entry = None
+
+    def entry(self, name: str, size: int, mtime: int, checksum: str) -> bytes:
+        info = zipfile.ZipInfo(name, time.gmtime(max(mtime, ZIP_EPOCH))[:6])
+        info.file_size = size
+        info.external_attr = 0o644 << 16
+        self._entry = self._zip.open(info, "w")
+        return self._sink.take()
+
+    def data(self, chunk: bytes) -> bytes:
+        self._entry.write(chunk)
+        return self._sink.take()
+
+    def end_entry(self) -> bytes:
+        self._entry.close()
+        return self._sink.take()
+
+    def close(self) -> bytes:
+        self._zip.close()
+        return self._sink.take()
+
+
+FORMATS = {"tar": TarStream, "zip": ZipStream}
+
+
+class ArchiveResource(ApiResource):
+    """ Streams every file of a bucket, or every file whose key starts with a prefix, as one archive """
+
+    @validate_bucket
+    def on_get(self, req: falcon.Request, resp: falcon.Response):
+        """ Sends a tar, or with ?format=zip a zip, of the bucket's files whose key starts with ?prefix=, all of them
+        by default. Files are looked up a page at a time and their blobs read one after another as the archive is
+        sent, so it is never held in memory or on disk. Compressed blobs are archived decompressed, and files without
+        data are left out """
+        prefix, archive = self._archive_params(req, resp)
+        resp.stream = self._archive(req.context.bucket.id.value, prefix, archive)
+
+    def _archive_params(self, req: falcon.Request, resp: falcon.Response):
+        format = req.get_param("format", default="tar")
+        if format not in FORMATS:
+            raise falcon.HTTPBadRequest(title="Invalid archive format",
+                                        description=f"format must be one of {', '.join(FORMATS)}")
+        prefix = req.get_param("prefix", default="")
+        archive = FORMATS[format]()
+        name = "-".join(filter(None, [req.context.bucket.name.value] + prefix.split(DELIMITER)))
+        resp.content_type = archive.content_type
+        resp.downloadable_as = f"{name}.{archive.extension}"
+        return prefix, archive
+
+    def _archive_page(self, bucket_id: int, start: str, end: typing.Optional[str], after: typing.Optional[Position]
+                      ) -> typing.Tuple[typing.List[typing.Tuple[File, LocalFile]], typing.Optional[Position]]:
+        """ The next files, with their local_file, of those in the folders from start and before end after the
+        position after, and the position to continue after, or None once there are none left. Files without data are
+        left out. The rest of the folder of after is fetched before moving on, which keeps each query a seek """
+        cursor = self._db.cursor()
+        rows = []
+        if after is not None:
+            rows = cursor.execute(folder_page_statement(), [bucket_id, *after, ARCHIVE_PAGE]).fetchall()
+        if not rows:
+            inclusive = after is None
+            params = [bucket_id, start if inclusive else after[0]] + ([end] if end is not None else [])
+            rows = cursor.execute(tree_page_statement(inclusive, end is not None), params + [ARCHIVE_PAGE]).fetchall()
+        if not rows:
+            return [], None
+        files = [File.from_db_row(row[1:]) for row in rows]
+        last = files[-1]
+        after = (last.path.value + DELIMITER, last.name.value, rows[-1][0])
+        ids = list({file.local_file_id.value for file in files if file.local_file_id.value})
+        local_files = {}
+        if ids:
+            stmt = f"{LocalFile.find_statement()} WHERE [{LocalFile.id.name}] IN ({','.join('?' * len(ids))})"
+            local_files = {row[0]: LocalFile.from_db_row(row) for row in cursor.execute(stmt, ids)}
+        return [(file, local_files[file.local_file_id.value]) for file in files
+                if file.local_file_id.value in local_files], after
+
+    def _archived(self, bucket_id: int, prefix: str) -> typing.Iterator[typing.Tuple[File, LocalFile]]:
+        for start, end, after, names in archive_scans(prefix):
+            while True:
+                entries, after = self._archive_page(bucket_id, start, end, after)
+                if after is None:
+                    break
+                # the files with an empty path, whose keys have no folder, are in the scan of the prefix "/"
+                yield from ((file, local_file) for file, local_file in entries if file_key(file).startswith(prefix))
+                if names is not None and not after[1].startswith(names):
+                    break
+
+    def _archive(self, bucket_id: int, prefix: str, archive) -> typing.Iterator[bytes]:
+        for file, local_file in self._archived(bucket_id, prefix):
+            yield from self._archive_entry(file, local_file, archive)
+        yield archive.close()
+
+    def _archive_entry(self, file: File, local_file: LocalFile, archive) -> typing.Iterator[bytes]:
+        try:
+            f, length = self._open_data(local_file)
+        except falcon.HTTPNotFound:
+            return  # deleted and collected since it was looked up
+        body, size = self._archive_body(f, length, local_file)
+        try:
+            yield archive.entry(archive_name(file), size, modified(file), local_file.id.value)
+            remaining = size
+            while remaining:
+                chunk = body.read(min(CHUNK_SIZE, remaining))
+                if not chunk:  # the archive can't be finished correctly, so it is cut short
+                    raise OSError(f"Blob {local_file.id.value} is shorter than its recorded size")
+                remaining -= len(chunk)
+                yield archive.data(chunk)
+            yield archive.end_entry()
+        finally:
+            body.close()
+
+    def _archive_body(self, f, length: int, local_file: LocalFile):
+        """ A readable of an open blob's original data, and its length """
+        if local_file.encoding.value == IDENTITY:
+            return f, length
+        return Decompressed(f, local_file.encoding.value), local_file.size.value
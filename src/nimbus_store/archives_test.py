@@ -0,0 +1,68 @@
+import io
+import json
+import pytest
+import tarfile
+import zipfile
+from falcon import testing
+from hashlib import md5
+from tempfile import mkdtemp
+from . import API
+from . import archives
+from .archives import CHECKSUM_HEADER
+from .config import Config
+from .test import headers_json, headers_binary, migrated_pool
+
+
+files = {
+    "top.txt": b"at the top",
+    "docs/a.txt": b"a" * 5000,
+    "docs/b.json": b'{"b": 1}' * 200,
+    "docs/deep/c.bin": bytes(range(256)) * 1000,
+    "docsx/d.txt": b"not in docs",
+}
+
+
+@pytest.fixture(scope="module")
+def client():
+    pool = migrated_pool()
+    config = Config(pack_threshold=1024, compression={"application/json": "gzip"})
+    client = testing.TestClient(API(pool, mkdtemp(), config))
+    client.simulate_post("/buckets", body=json.dumps({"name": "export", "desc": ""}), headers=headers_json)
+    for key, data in files.items():
+        path, _, name = key.rpartition("/")
+        mime = "application/json" if name.endswith(".json") else "application/octet-stream"
+        file = {"name": name, "mime": mime, "path": path}
+        id = client.simulate_post("/buckets/export/files", body=json.dumps(file), headers=headers_json).json["id"]
+        client.simulate_post(f"/buckets/export/files/{id}/data/{md5(data).hexdigest()}", body=data,
+                             headers=headers_binary)
+    file = {"name": "pending.txt", "mime": "text/plain", "path": "docs"}
+    client.simulate_post("/buckets/export/files", body=json.dumps(file), headers=headers_json)
+    return client
+
+
+def test_tar(client):
+    result = client.simulate_get("/buckets/export/archive")
+    assert result.status_code == 200
+    assert result.headers["Content-Type"] == "application/x-tar"
+    with tarfile.open(fileobj=io.BytesIO(result.content)) as tar:
+        members = tar.getmembers()
+        assert sorted(member.name for member in members) == sorted(files)
+        for member in members:
+            assert tar.extractfile(member).read() == files[member.name]
+            assert member.pax_headers[CHECKSUM_HEADER] == md5(files[member.name]).hexdigest()
+
+
+@pytest.mark.parametrize("prefix", ["docs/", "docs", "docs/d", "t", "nothing/"])
+def test_zip_prefix(client, monkeypatch, prefix):
+    monkeypatch.setattr(archives, "ARCHIVE_PAGE", 1)
+    result = client.simulate_get("/buckets/export/archive", params={"prefix": prefix, "format": "zip"})
+    assert result.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(result.content)) as archive:
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == sorted(key for key in files if key.startswith(prefix))
+        for name in archive.namelist():
+            assert archive.read(name) == files[name]
+
+
+def test_invalid_format(client):
+    assert client.simulate_get("/buckets/export/archive", params={"format": "rar"}).status_code == 400
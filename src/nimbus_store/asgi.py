@@ -0,0 +1,472 @@
+import asyncio
+import falcon
+import falcon.asgi
+import typing
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from .archives import ArchiveResource, archive_name, archive_scans, file_key, modified
+from .compression import IDENTITY, Decompressed
+from .config import Config
+from .copies import FileCopyResource, FileMoveResource
+from .db import ConnectionPool
+from .batch import FileBatchResource
+from .buckets import BucketCollectionResource, BucketResource, validate_bucket
+from .files import FileCollectionResource, FilesResource, browse_params, validate_file
+from .ingest import IngestError
+from .local_files import LocalFileResource, CHUNK_SIZE
+from .metrics import MetricsMiddleware, metrics
+from .models.bucket import Bucket
+from .models.file import File
+from .models.model import Field
+from .monitoring import MetricsResource, ProfileResource
+from .layout import is_packed
+from .ranges import Byteranges, FileRange
+from .uploads import UploadCollectionResource, UploadPartResource, UploadResource, validate_upload
+from .util import require, page_params, encode_row, DEFAULT_PAGE_SIZE, STREAM_FORMATS
+from .volumes import Volumes
+
+
+class ClosingStream:
+    """ An async generator as a response stream which falcon closes once it is done sending, whether or not it ran to
+    the end. A bare async generator is only closed when garbage collected, which would hold a blob open for a while
+    after its client disconnects """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __aiter__(self):
+        return self._stream
+
+    async def close(self):
+        await self._stream.aclose()
+
+
+class AsyncApiResource:
+    """ Mixin adapting an ApiResource to asyncio. Blocking work is never done on the event loop: sqlite access runs on
+    a database executor (each of its threads keeping its own connection from the pool) and blob reads and writes run
+    on a separate, bounded I/O executor, so slow disks can't starve metadata requests or vice versa """
+
+    def __init__(self, db: ConnectionPool, volumes: Volumes, config: Config, db_executor: Executor,
+                 io_executor: Executor):
+        super().__init__(db, volumes, config)
+        self._db_executor = db_executor
+        self._io_executor = io_executor
+
+    async def _run(self, fn, *args):
+        """ Runs fn, which may use the database, on the database executor """
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, partial(fn, *args))
+
+    async def _io(self, fn, *args):
+        """ Runs fn, which may block on file I/O, on the I/O executor """
+        return await asyncio.get_running_loop().run_in_executor(self._io_executor, partial(fn, *args))
+
+    async def _open_data(self, local_file):
+        """ Opens a blob as stored, with its segment, if it is packed, looked up on the database executor """
+        if not is_packed(local_file):
+            return await self._io(super()._open_data, local_file)
+        for retry in (True, False):
+            packs, location = await self._run(self._packed_location, local_file)
+            try:
+                data = await self._io(packs.read, *location)
+            except FileNotFoundError:
+                if not retry:
+                    raise falcon.HTTPNotFound(description="Invalid checksum or missing data")
+                continue
+            return BytesIO(data), len(data)
+
+    async def _list(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, model, key: Field,
+                    field: Field=None, value=None):
+        """ As ApiResource._list. Streamed listings are fetched a page at a time, since a sqlite cursor can't be
+        carried between executor threads """
+        limit, after, stream = page_params(req, key.type)
+        if stream is None:
+            rows, next = await self._run(self._page, model, key, field, value, after, limit)
+            if next is not None:
+                resp.set_header("X-Next-Cursor", str(next))
+            resp.media = rows
+            return
+        resp.content_type = STREAM_FORMATS[stream]
+        resp.stream = self._stream_pages(model, key, field, value, after, limit, stream)
+
+    async def _stream_pages(self, model, key: Field, field: Field, value, after, limit, stream: str):
+        if stream == "json":
+            yield b"["
+        first = True
+        while limit is None or limit > 0:
+            size = DEFAULT_PAGE_SIZE if limit is None else min(limit, DEFAULT_PAGE_SIZE)
+            rows, after = await self._run(self._page, model, key, field, value, after, size)
+            for row in rows:
+                yield encode_row(row, stream, first)
+                first = False
+            if after is None:
+                break
+            if limit is not None:
+                limit -= len(rows)
+        if stream == "json":
+            yield b"]"
+
+
+class AsyncBucketResource(AsyncApiResource, BucketResource):
+
+    @validate_bucket
+    @require("application/json")
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        resp.media = req.context.bucket.to_dict()
+
+
+class AsyncBucketCollectionResource(AsyncApiResource, BucketCollectionResource):
+
+    @require("application/json")
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        await self._list(req, resp, Bucket, Bucket.id)
+
+    @require("application/json")
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        bucket = Bucket.from_dict(await req.get_media())
+        bucket = await self._run(self._create_bucket, bucket)
+        resp.status = falcon.HTTP_201
+        resp.media = bucket.to_dict()
+
+
+class AsyncFilesResource(AsyncApiResource, FilesResource):
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        resp.media = req.context.file.to_dict()
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    async def on_delete(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        await self._run(self._delete_file, req.context.file)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+
+class AsyncFileCollectionResource(AsyncApiResource, FileCollectionResource):
+
+    @require("application/json")
+    @validate_bucket
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        if req.get_param("delimiter") is None and req.get_param("prefix") is None:
+            await self._list(req, resp, File, File.id, File.bucket_id, req.context.bucket.id.value)
+            return
+        self._browsed(resp, *await self._run(self._browse, req.context.bucket.id.value, *browse_params(req)))
+
+    @require("application/json")
+    @validate_bucket
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        file = File.from_dict(await req.get_media())
+        file = await self._run(self._create_file, req.context.bucket, file)
+        resp.status = falcon.HTTP_201
+        resp.media = file.to_dict()
+
+
+class AsyncFileCopyResource(AsyncApiResource, FileCopyResource):
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        spec = await req.get_media(default_when_empty={})
+        resp.status = falcon.HTTP_201
+        resp.media = await self._run(self._copy, req.context.bucket, req.context.file, spec or {})
+
+
+class AsyncFileMoveResource(AsyncApiResource, FileMoveResource):
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        spec = await req.get_media(default_when_empty={})
+        resp.media = await self._run(self._move, req.context.bucket, req.context.file, spec or {})
+
+
+class AsyncFileBatchResource(AsyncApiResource, FileBatchResource):
+
+    @require("application/json")
+    @validate_bucket
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        resp.media = await self._run(self._batch, req.context.bucket, await req.get_media())
+
+
+class AsyncLocalFileResource(AsyncApiResource, LocalFileResource):
+    """ Uploads and downloads blobs without tying up a thread for the duration of the transfer. The request and
+    response bodies are read and written on the event loop, and only disk access goes to the I/O executor """
+
+    @require("application/octet-stream")
+    @validate_bucket
+    @validate_file
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, checksum: str):
+        self._check_checksum(checksum)
+        if await self._run(self._attach_existing, req.context.file, checksum):
+            resp.status = falcon.HTTP_NO_CONTENT
+            return
+        if req.content_length is None:
+            raise falcon.HTTPLengthRequired(description="Uploads must have a Content-Length")
+        volume = await self._io(self._volumes.place, checksum)
+        ingest = await self._io(self._ingest, req, volume)
+        try:
+            while True:
+                chunk = await req.stream.read(self._config.buffer_size)
+                if not chunk:
+                    break
+                await self._io(ingest.write, chunk)
+            digest = await self._io(ingest.verify, checksum)
+            await self._run(self._store_local_file, req.context.file, digest, ingest.place, ingest.encoding,
+                            ingest.size, ingest.data, volume)
+        except IngestError as e:
+            raise falcon.HTTPBadRequest(title="Invalid upload", description=str(e))
+        finally:
+            await self._io(ingest.close)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+    @validate_bucket
+    @validate_file
+    async def on_head(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, checksum: str):
+        local_file = await self._run(self._find_local_file, checksum)
+        fname = None if local_file is None else await self._io(self._locate, local_file)
+        if fname is None:
+            raise falcon.HTTPNotFound()
+        resp.content_length = await self._io(self._original_length, local_file, fname)
+
+    @validate_bucket
+    @validate_file
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, checksum: str):
+        file = req.context.file
+        local_file = await self._run(self._file_data, file, checksum)
+        encoding = self._negotiate(req, resp, local_file)
+        if self._not_modified(req, resp, file, checksum if encoding is None else f"{checksum}-{encoding}"):
+            return
+        f, length = await self._open_data(local_file)
+        resp.content_type = file.mime.value
+        resp.downloadable_as = file.name.value
+        if encoding is not None:
+            resp.content_length = length
+            resp.stream = ClosingStream(self._read(f, 0, length))
+            return
+        if local_file.encoding.value != IDENTITY:
+            resp.content_length = local_file.size.value
+            resp.stream = ClosingStream(self._read_decompressed(f, local_file.encoding.value))
+            return
+        try:
+            ranges = self._ranges(req, file, checksum, length)
+        except BaseException:
+            f.close()
+            raise
+        if ranges is None:
+            resp.content_length = length
+            resp.stream = ClosingStream(self._read(f, 0, length))
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            resp.status = falcon.HTTP_PARTIAL_CONTENT
+            resp.content_range = (first, last, length)
+            resp.content_length = last - first + 1
+            resp.stream = ClosingStream(self._read(f, first, last - first + 1))
+        else:
+            body = Byteranges(ranges, length, file.mime.value)
+            resp.status = falcon.HTTP_PARTIAL_CONTENT
+            resp.content_type = body.content_type
+            resp.content_length = body.content_length
+            resp.stream = ClosingStream(self._read_byteranges(f, body))
+
+    async def _read(self, f, offset: int, length: int):
+        try:
+            async for chunk in self._read_range(f, offset, length):
+                yield chunk
+        finally:
+            f.close()
+
+    async def _read_decompressed(self, f, encoding: str):
+        body = Decompressed(f, encoding)
+        try:
+            while True:
+                chunk = await self._io(body.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    async def _read_byteranges(self, f, body: Byteranges):
+        try:
+            for header, first, last in body.parts:
+                yield header
+                async for chunk in self._read_range(f, first, last - first + 1):
+                    yield chunk
+            yield body.closing
+        finally:
+            f.close()
+
+    async def _read_range(self, f, offset: int, length: int):
+        part = await self._io(FileRange, f, offset, length)
+        while part.remaining:
+            chunk = await self._io(part.read, CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+class AsyncArchiveResource(AsyncApiResource, ArchiveResource):
+
+    @validate_bucket
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        prefix, archive = self._archive_params(req, resp)
+        resp.stream = ClosingStream(self._archive(req.context.bucket.id.value, prefix, archive))
+
+    async def _archive(self, bucket_id: int, prefix: str, archive):
+        for start, end, after, names in archive_scans(prefix):
+            while True:
+                entries, after = await self._run(self._archive_page, bucket_id, start, end, after)
+                if after is None:
+                    break
+                for file, local_file in entries:
+                    if file_key(file).startswith(prefix):
+                        async for chunk in self._archive_entry(file, local_file, archive):
+                            yield chunk
+                if names is not None and not after[1].startswith(names):
+                    break
+        yield archive.close()
+
+    async def _archive_entry(self, file: File, local_file, archive):
+        try:
+            f, length = await self._open_data(local_file)
+        except falcon.HTTPNotFound:
+            return
+        body, size = self._archive_body(f, length, local_file)
+        try:
+            yield archive.entry(archive_name(file), size, modified(file), local_file.id.value)
+            remaining = size
+            while remaining:
+                chunk = await self._io(body.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise OSError(f"Blob {local_file.id.value} is shorter than its recorded size")
+                remaining -= len(chunk)
+                yield archive.data(chunk)
+            yield archive.end_entry()
+        finally:
+            await self._io(body.close)
+
+
+class AsyncUploadCollectionResource(AsyncApiResource, UploadCollectionResource):
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        body = await req.get_media(default_when_empty={})
+        upload = await self._run(self._create_upload, req.context.file, body or {})
+        resp.status = falcon.HTTP_201
+        resp.media = upload.to_dict()
+
+
+class AsyncUploadResource(AsyncApiResource, UploadResource):
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    @validate_upload
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        resp.media = await self._run(self._describe, req.context.upload)
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    @validate_upload
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        checksum = (await req.get_media(default_when_empty={}) or {}).get("checksum", "")
+        upload = req.context.upload
+        parts = await self._run(self._check_parts, upload, checksum)
+        digest = await self._io(self._upload_digest, upload, parts)
+        await self._run(self._complete, req.context.file, upload, parts, checksum, digest)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    @validate_upload
+    async def on_delete(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        await self._run(self._abort, req.context.upload)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+
+class AsyncUploadPartResource(AsyncApiResource, UploadPartResource):
+
+    @require("application/octet-stream")
+    @validate_bucket
+    @validate_file
+    @validate_upload
+    async def on_put(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, number: int):
+        upload = req.context.upload
+        length = self._check_part(upload, number, req.content_length)
+        attempt = await self._run(self._begin_part, upload)
+        part = await self._io(self._start_part, upload, number, attempt)
+        try:
+            received = 0
+            while received < length:
+                chunk = await req.stream.read(min(self._config.buffer_size, length - received))
+                if not chunk:
+                    raise IngestError(f"Request body ended {length - received} bytes short of its length")
+                received += len(chunk)
+                await self._io(part.write, chunk)
+            await self._io(part.finish)
+        except IngestError as e:
+            raise falcon.HTTPBadRequest(title="Invalid upload", description=str(e))
+        finally:
+            await self._io(part.close)
+        await self._run(self._record_part, upload, number, length, attempt)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+
+class AsyncMetricsResource(AsyncApiResource, MetricsResource):
+
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        MetricsResource.on_get(self, req, resp)
+
+
+class AsyncProfileResource(AsyncApiResource, ProfileResource):
+
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        ProfileResource.on_get(self, req, resp)
+
+    async def on_put(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        ProfileResource.on_put(self, req, resp)
+
+    async def on_delete(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        ProfileResource.on_delete(self, req, resp)
+
+
+class AsyncAPI(falcon.asgi.App):
+    """ The HTTP REST API for the storage service, as an ASGI app. Serves the same routes as API, but a slow client
+    only costs a coroutine rather than a whole thread """
+
+    routes = {
+        "/buckets/{bucket}/files": AsyncFileCollectionResource,
+        "/buckets/{bucket}/files/{file}/data/{checksum}": AsyncLocalFileResource,
+        "/buckets/{bucket}/files/{file}/uploads": AsyncUploadCollectionResource,
+        "/buckets/{bucket}/files/{file}/uploads/{upload}": AsyncUploadResource,
+        "/buckets/{bucket}/files/{file}/uploads/{upload}/parts/{number:int}": AsyncUploadPartResource,
+        "/buckets/{bucket}/files/{file}/copy": AsyncFileCopyResource,
+        "/buckets/{bucket}/files/{file}/move": AsyncFileMoveResource,
+        "/buckets/{bucket}/files/{file}": AsyncFilesResource,
+        "/buckets/{bucket}/batch": AsyncFileBatchResource,
+        "/buckets/{bucket}/archive": AsyncArchiveResource,
+        "/buckets": AsyncBucketCollectionResource,
+        "/buckets/{bucket}": AsyncBucketResource,
+        "/metrics": AsyncMetricsResource,
+        "/metrics/profile": AsyncProfileResource,
+    }
+
+    def __init__(self, db: ConnectionPool, volume: typing.Union[str, Volumes], config: Config = None,
+                 db_threads: int = 8, io_threads: int = 32):
+        """ db_threads bounds the number of concurrent database operations, and io_threads that of blob reads or
+        writes per volume """
+        super().__init__(middleware=[MetricsMiddleware(metrics)])
+        volumes = Volumes.of(volume)
+        db_executor = ThreadPoolExecutor(db_threads, thread_name_prefix="nimbus-db")
+        io_executor = ThreadPoolExecutor(io_threads * len(volumes), thread_name_prefix="nimbus-io")
+        for route, resource in self.routes.items():
+            self.add_route(route, resource(db, volumes, config, db_executor, io_executor))
@@ -0,0 +1,132 @@
+import io
+import json
+import pytest
+import tarfile
+from falcon import testing
+from hashlib import md5
+from os.path import join, dirname
+from tempfile import mkdtemp
+from .asgi import AsyncAPI
+from .db import ConnectionPool
+from .migrations import Migration
+from .test import headers_json, headers_binary
+
+
+@pytest.fixture(scope="module")
+def client():
+    # executor threads each open their own connection, so this can't be an in-memory database
+    pool = ConnectionPool(join(mkdtemp(), "db.sqlite"))
+    Migration(join(dirname(__file__), "../../db/sqlite/migrations"), pool.connection())()
+    return testing.TestClient(AsyncAPI(pool, mkdtemp()))
+
+
+def test_async_round_trip(client):
+    result = client.simulate_post("/buckets", body=json.dumps({"name": "async", "desc": ""}), headers=headers_json)
+    assert result.status_code == 201
+    result = client.simulate_post("/buckets", body=json.dumps({"name": "async", "desc": ""}), headers=headers_json)
+    assert result.status_code == 409
+    file = {"name": "test.bin", "mime": "application/octet-stream", "path": "a"}
+    result = client.simulate_post("/buckets/async/files", body=json.dumps(file), headers=headers_json)
+    assert result.status_code == 201
+    file_id = result.json["id"]
+    data = b"x" * 1000000
+    digest = md5(data).hexdigest()
+    result = client.simulate_post(f"/buckets/async/files/{file_id}/data/{digest}", body=data, headers=headers_binary)
+    assert result.status_code == 204
+    result = client.simulate_get(f"/buckets/async/files/{file_id}/data/{digest}", headers=headers_binary)
+    assert result.status_code == 200
+    assert result.content == data
+    result = client.simulate_get(f"/buckets/async/files/{file_id}/data/{digest}", headers={"Range": "bytes=-10"})
+    assert result.status_code == 206
+    assert result.content == data[-10:]
+    result = client.simulate_get(f"/buckets/async/files/{file_id}/data/{digest}", headers={"If-None-Match": digest})
+    assert result.status_code == 304
+    result = client.simulate_delete(f"/buckets/async/files/{file_id}", headers=headers_json)
+    assert result.status_code == 204
+    result = client.simulate_get(f"/buckets/async/files/{file_id}", headers=headers_json)
+    assert result.status_code == 404
+
+
+def test_async_upload_without_length(client):
+    client.simulate_post("/buckets", body=json.dumps({"name": "unsized", "desc": ""}), headers=headers_json)
+    file = {"name": "test.bin", "mime": "application/octet-stream", "path": "a"}
+    file_id = client.simulate_post("/buckets/unsized/files", body=json.dumps(file), headers=headers_json).json["id"]
+    result = client.simulate_post(f"/buckets/unsized/files/{file_id}/data/{md5(b'unsized').hexdigest()}",
+                                  headers=headers_binary)
+    assert result.status_code == 411
+
+
+def test_async_listing(client):
+    for i in range(5):
+        file = {"name": f"{i}.txt", "mime": "text/plain", "path": "a"}
+        client.simulate_post("/buckets/async/files", body=json.dumps(file), headers=headers_json)
+    result = client.simulate_get("/buckets/async/files", params={"limit": 3}, headers=headers_json)
+    assert len(result.json) == 3
+    assert "X-Next-Cursor" in result.headers
+    result = client.simulate_get("/buckets/async/files", params={"stream": "json", "limit": 4}, headers=headers_json)
+    assert len(result.json) == 4
+    result = client.simulate_get("/buckets/async/files", params={"stream": "ndjson"}, headers=headers_json)
+    assert len(result.text.splitlines()) == 5
+    result = client.simulate_get("/buckets/async/files", params={"prefix": "a/", "delimiter": "/", "limit": 3},
+                                 headers=headers_json)
+    assert [file["name"] for file in result.json["files"]] == ["0.txt", "1.txt", "2.txt"]
+    assert result.headers["X-Next-Cursor"] == "a/2.txt"
+
+
+def test_async_copy_and_move(client):
+    file = {"name": "original.txt", "mime": "text/plain", "path": "a"}
+    file_id = client.simulate_post("/buckets/async/files", body=json.dumps(file), headers=headers_json).json["id"]
+    result = client.simulate_post(f"/buckets/async/files/{file_id}/copy", body=json.dumps({"name": "copy.txt"}),
+                                  headers=headers_json)
+    assert result.status_code == 201
+    assert result.json["name"] == "copy.txt" and result.json["id"] != file_id
+    result = client.simulate_post(f"/buckets/async/files/{file_id}/move", body=json.dumps({"path": "b"}),
+                                  headers=headers_json)
+    assert result.status_code == 200
+    assert result.json["path"] == "b"
+
+
+def test_async_archive(client):
+    file = {"name": "archived.txt", "mime": "text/plain", "path": "archived"}
+    file_id = client.simulate_post("/buckets/async/files", body=json.dumps(file), headers=headers_json).json["id"]
+    data = b"archive me " * 100
+    client.simulate_post(f"/buckets/async/files/{file_id}/data/{md5(data).hexdigest()}", body=data,
+                         headers=headers_binary)
+    result = client.simulate_get("/buckets/async/archive", params={"prefix": "archived/"})
+    assert result.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(result.content)) as tar:
+        assert tar.getnames() == ["archived/archived.txt"]
+        assert tar.extractfile("archived/archived.txt").read() == data
+
+
+def test_async_multipart_upload(client):
+    file = {"name": "parts.bin", "mime": "application/octet-stream", "path": "a"}
+    file_id = client.simulate_post("/buckets/async/files", body=json.dumps(file), headers=headers_json).json["id"]
+    result = client.simulate_post(f"/buckets/async/files/{file_id}/uploads", body=json.dumps({"part_size": 65536}),
+                                  headers=headers_json)
+    url = f"/buckets/async/files/{file_id}/uploads/{result.json['id']}"
+    data = b"y" * 100000
+    for number in (2, 1):
+        part = data[(number - 1) * 65536:number * 65536]
+        result = client.simulate_put(f"{url}/parts/{number}", body=part, headers=headers_binary)
+        assert result.status_code == 204
+    digest = md5(data).hexdigest()
+    result = client.simulate_post(url, body=json.dumps({"checksum": digest}), headers=headers_json)
+    assert result.status_code == 204
+    result = client.simulate_get(f"/buckets/async/files/{file_id}/data/{digest}")
+    assert result.content == data
+
+
+def test_async_batch(client):
+    files = [{"name": f"{i}.bin", "mime": "application/octet-stream", "path": "b"} for i in range(2)]
+    result = client.simulate_post("/buckets/async/batch", body=json.dumps({"create": files}), headers=headers_json)
+    ids = [each["file"]["id"] for each in result.json["create"]]
+    result = client.simulate_post("/buckets/async/batch", body=json.dumps({"delete": ids}), headers=headers_json)
+    assert [each["status"] for each in result.json["delete"]] == [204, 204]
+
+
+def test_async_metrics(client):
+    client.simulate_get("/buckets", headers=headers_json)
+    result = client.simulate_get("/metrics")
+    assert result.status_code == 200
+    assert 'nimbus_request_duration_seconds_count{route="/buckets",method="GET",status="200"}' in result.text
@@ -0,0 +1,23 @@
+import threading
+import traceback
+
+
+class Periodic(threading.Thread):
+    """ Runs task every interval seconds on a daemon thread. A task using the database gets this thread's own
+    connection from the pool. An exception from one run is printed, and doesn't stop the next """
+
+    def __init__(self, interval: float, task, name: str = None):
+        super().__init__(name=name, daemon=True)
+        self._interval = interval
+        self._task = task
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self._task()
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,150 @@
+import falcon
+import sqlite3
+import typing
+from uuid import uuid4
+from .models.bucket import Bucket
+from .models.file import File
+from .buckets import validate_bucket
+from .copies import check_target, copy_file, move_file, target_bucket
+from .util import require
+from .resource import ApiResource
+
+
+# The most items, across all operations, one batch may have
+MAX_BATCH_SIZE = 10000
+# The most ids looked up by one SELECT. Older versions of sqlite allow at most 999 parameters per statement
+LOOKUP_SIZE = 500
+OPERATIONS = ("create", "copy", "move", "get", "delete")
+
+
+class FileBatchResource(ApiResource):
+    """ Creates, copies, moves, fetches and deletes many files of a bucket in one request, and one transaction """
+
+    @require("application/json")
+    @validate_bucket
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        """ The body may have a "create" list of new files, "copy" and "move" lists of targets, each the "id" of a file
+        and the "bucket", "path" and "name" to copy or move it to, a "get" list of file ids and a "delete" list of file
+        ids, which are done in that order. The response has a list of results under each of the same keys, one per
+        item in the same order, each with the status the item would have had as a request of its own """
+        resp.media = self._batch(req.context.bucket, req.media)
+
+    def _batch(self, bucket: Bucket, body) -> dict:
+        self._check_batch(body)
+        try:
+            if set(body) <= {"get"}:
+                results = self._apply_batch(bucket, body)
+            else:
+                # the write transaction is begun before the files copied are looked up, so their blobs can't be
+                # collected in between
+                results = self._write(self._apply_batch, bucket, body)
+        except sqlite3.Error as e:
+            raise falcon.HTTPBadRequest(title="Batch failed", description=str(e))
+        if "delete" in body or "move" in body:
+            self._cache.files.invalidate(*body.get("delete", ()),
+                                         *(each["file"]["id"] for each in results.get("move", ()) if "file" in each))
+        return results
+
+    def _apply_batch(self, bucket: Bucket, body: dict) -> dict:
+        results = {}
+        if "create" in body:
+            results["create"] = self._create_files(bucket, body["create"])
+        if "copy" in body:
+            results["copy"] = self._transfer_files(bucket, body["copy"], copy_file, 201)
+        if "move" in body:
+            results["move"] = self._transfer_files(bucket, body["move"], move_file, 200)
+        if "get" in body:
+            results["get"] = self._get_files(bucket, body["get"])
+        if "delete" in body:
+            results["delete"] = self._delete_files(bucket, body["delete"])
+        return results
+
+    def _check_batch(self, body):
+        if not isinstance(body, dict) or not set(body) <= set(OPERATIONS) or \
+                not all(isinstance(items, list) for items in body.values()):
+            raise falcon.HTTPBadRequest(title="Invalid batch",
+                                        description=f"A batch is an object of lists keyed by {', '.join(OPERATIONS)}")
+        if sum(len(items) for items in body.values()) > MAX_BATCH_SIZE:
+            raise falcon.HTTPPayloadTooLarge(description=f"A batch may have at most {MAX_BATCH_SIZE} items")
+        for op in ("get", "delete"):
+            if not all(isinstance(id, str) for id in body.get(op, ())):
+                raise falcon.HTTPBadRequest(title="Invalid batch", description=f"{op} must be a list of file ids")
+
+    def _find_files(self, bucket: typing.Optional[Bucket], ids: typing.List[str]) -> typing.Dict[str, File]:
+        """ The files of the bucket, or of any bucket if it is None, with the given ids, by id """
+        cursor = self._db.cursor()
+        files = {}
+        ids = list(set(ids))
+        for i in range(0, len(ids), LOOKUP_SIZE):
+            chunk = ids[i:i + LOOKUP_SIZE]
+            if bucket is None:
+                stmt = f"{File.find_statement()} WHERE [{File.id.name}] IN ({','.join('?' * len(chunk))})"
+            else:
+                stmt = f"{File.find_statement(File.bucket_id)} AND [{File.id.name}] IN ({','.join('?' * len(chunk))})"
+            for row in cursor.execute(stmt, ([] if bucket is None else [bucket.id.value]) + chunk):
+                file = File.from_db_row(row)
+                files[file.id.value] = file
+        return files
+
+    def _create_files(self, bucket: Bucket, specs: list) -> typing.List[dict]:
+        stmt = None
+        rows = []
+        results = []
+        for spec in specs:
+            try:
+                if not isinstance(spec, dict):
+                    raise TypeError("A file must be an object")
+                file = File.from_dict(spec)
+            except (TypeError, ValueError) as e:
+                results.append({"status": 400, "error": str(e)})
+                continue
+            file.bucket_id.value = bucket.id.value
+            file.id.value = str(uuid4())
+            stmt, params = file.insert_statement(file.id, file.bucket_id)
+            rows.append(params)
+            results.append(file.id.value)
+        if stmt is not None:
+            self._db.cursor().executemany(stmt, rows)
+        # read back, for the values the database fills in
+        created = self._find_files(bucket, [id for id in results if isinstance(id, str)])
+        return [{"status": 201, "file": created[id].to_dict()} if isinstance(id, str) else id for id in results]
+
+    def _transfer_files(self, bucket: Bucket, specs: list, transfer, status: int) -> typing.List[dict]:
+        """ Copies or moves, as transfer does, the files of the bucket each spec names by id """
+        ids = [spec.get("id") for spec in specs if isinstance(spec, dict)]
+        files = self._find_files(bucket, [id for id in ids if isinstance(id, str)])
+        buckets = {}
+        results = []
+        for spec in specs:
+            try:
+                spec = check_target(spec)
+                if not isinstance(spec.get("id"), str):
+                    raise ValueError("id must be a file id")
+            except ValueError as e:
+                results.append({"status": 400, "error": str(e)})
+                continue
+            file = files.get(spec["id"])
+            try:
+                target = buckets.get(spec.get("bucket")) or target_bucket(self, bucket, spec)
+            except falcon.HTTPNotFound as e:
+                results.append({"status": 404, "error": e.description})
+                continue
+            buckets[spec.get("bucket")] = target
+            id = None if file is None else transfer(self, file, target, spec)
+            results.append(id if id is not None else self._missing(spec["id"]))
+        # read back, for the values the database fills in
+        done = self._find_files(None, [id for id in results if isinstance(id, str)])
+        return [{"status": status, "file": done[id].to_dict()} if isinstance(id, str) else id for id in results]
+
+    def _get_files(self, bucket: Bucket, ids: typing.List[str]) -> typing.List[dict]:
+        files = self._find_files(bucket, ids)
+        return [{"status": 200, "file": files[id].to_dict()} if id in files else self._missing(id) for id in ids]
+
+    def _delete_files(self, bucket: Bucket, ids: typing.List[str]) -> typing.List[dict]:
+        files = self._find_files(bucket, ids)
+        cursor = self._db.cursor()
+        cursor.executemany(File.delete_statement(File.id), [[id] for id in files])
+        return [{"status": 204} if id in files else self._missing(id) for id in ids]
+
+    def _missing(self, id: str) -> dict:
+        return {"status": 404, "error": f"No file with id '{id}' found"}
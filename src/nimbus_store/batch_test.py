@@ -0,0 +1,67 @@
+import falcon
+import json
+from hashlib import md5
+from os.path import exists, join
+from .batch import FileBatchResource
+from .collector import Collector
+from .test import client, headers_json, headers_binary, pool, tempd
+
+
+def test_batch(client):
+    client.simulate_post("/buckets", body=json.dumps({"name": "batch", "desc": ""}), headers=headers_json)
+    files = [{"name": f"{i}.txt", "mime": "text/plain", "path": "batch"} for i in range(3)]
+    result = client.simulate_post("/buckets/batch/batch", body=json.dumps({"create": files + ["0.txt"]}),
+                                  headers=headers_json)
+    assert result.status_code == 200
+    created = result.json["create"]
+    assert [each["status"] for each in created] == [201, 201, 201, 400]
+    assert [each["file"]["name"] for each in created[:3]] == ["0.txt", "1.txt", "2.txt"]
+    ids = [each["file"]["id"] for each in created[:3]]
+
+    data = b"batched"
+    digest = md5(data).hexdigest()
+    for id in ids[:2]:
+        client.simulate_post(f"/buckets/batch/files/{id}/data/{digest}", body=data, headers=headers_binary)
+    result = client.simulate_post("/buckets/batch/batch", body=json.dumps({"get": [ids[0], "missing"]}),
+                                  headers=headers_json)
+    assert result.json["get"][0]["file"]["local_file_id"] == digest
+    assert result.json["get"][1]["status"] == 404
+
+    # the blob is only collected once the last of the files using it is deleted
+    result = client.simulate_post("/buckets/batch/batch", body=json.dumps({"delete": [ids[0], ids[2], "missing"]}),
+                                  headers=headers_json)
+    assert [each["status"] for each in result.json["delete"]] == [204, 204, 404]
+    Collector(pool, tempd).run()
+    assert exists(join(tempd, digest))
+    result = client.simulate_post("/buckets/batch/batch", body=json.dumps({"delete": [ids[1]]}), headers=headers_json)
+    assert exists(join(tempd, digest))
+    Collector(pool, tempd).run()
+    assert not exists(join(tempd, digest))
+    result = client.simulate_post("/buckets/batch/batch", body=json.dumps({"get": ids}), headers=headers_json)
+    assert [each["status"] for each in result.json["get"]] == [404, 404, 404]
+
+
+def test_batch_invalid(client):
+    for body in ([], {"create": {}}, {"update": []}, {"get": [1]}):
+        result = client.simulate_post("/buckets/batch/batch", body=json.dumps(body), headers=headers_json)
+        assert result.status_code == 400
+
+
+def test_batch_error_rolls_back(client, monkeypatch):
+    file = {"name": "kept.txt", "mime": "text/plain", "path": ""}
+    created = client.simulate_post("/buckets/batch/batch", body=json.dumps({"create": [file]}), headers=headers_json)
+    id = created.json["create"][0]["file"]["id"]
+    result = client.simulate_post("/buckets/batch/batch", body=json.dumps({"copy": [{"id": id, "bucket": "missing"}]}),
+                                  headers=headers_json)
+    assert result.json["copy"][0]["status"] == 404
+
+    def fail(*args):
+        raise falcon.HTTPForbidden()
+    monkeypatch.setattr(FileBatchResource, "_delete_files", fail)
+    result = client.simulate_post("/buckets/batch/batch", body=json.dumps({"copy": [{"id": id}], "delete": [id]}),
+                                  headers=headers_json)
+    assert result.status_code == 403
+    assert not pool.connection().in_transaction
+    monkeypatch.undo()
+    result = client.simulate_post("/buckets/batch/batch", body=json.dumps({"delete": [id]}), headers=headers_json)
+    assert [each["status"] for each in result.json["delete"]] == [204]
@@ -0,0 +1,115 @@
+""" Compares the server's CPU cost of sending blob downloads with sendfile against reading them through userspace.
+
+    python -m src.nimbus_store.bench.download --size 4096 --rounds 3 --dir /srv/nimbus-bench
+
+The blob is read once before timing, so both paths serve it from the page cache and the comparison is of CPU, not
+disk. Put --dir on the storage nodes' filesystem; tmpfs behaves differently """
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import time
+from falcon import testing
+from os.path import dirname, join
+from tempfile import mkdtemp
+from .. import API, ConnectionPool
+from ..migrations import Migration
+from ..models.file import File
+from ..models.local_file import LocalFile
+from ..server import WSGIServer
+
+MIGRATIONS = join(dirname(__file__), "../../../db/sqlite/migrations")
+MIB = 1 << 20
+
+
+def make_volume(root: str, size: int):
+    """ Creates a volume holding one blob of size MiB. Returns the path of its database and the blob's URL """
+    db = join(root, "db.sqlite")
+    volume = join(root, "volume")
+    os.mkdir(volume)
+    pool = ConnectionPool(db)
+    Migration(MIGRATIONS, pool.connection())()
+    client = testing.TestClient(API(pool, volume))
+    headers = {"content-type": "application/json"}
+    client.simulate_post("/buckets", body=json.dumps({"name": "bench", "desc": ""}), headers=headers)
+    file = {"name": "blob.bin", "mime": "application/octet-stream", "path": "bench"}
+    file_id = client.simulate_post("/buckets/bench/files", body=json.dumps(file), headers=headers).json["id"]
+    # written directly rather than uploaded, which for multi-GB blobs would take longer than the benchmark
+    chunk = os.urandom(MIB)
+    hash = hashlib.md5()
+    tmp = join(volume, "blob")
+    with open(tmp, "wb") as f:
+        for _ in range(size):
+            f.write(chunk)
+            hash.update(chunk)
+    digest = hash.hexdigest()
+    os.rename(tmp, join(volume, digest))
+    conn = sqlite3.connect(db)
+    conn.execute(f"INSERT INTO [{LocalFile.table_name}] ([{LocalFile.id.name}], [{LocalFile.path.name}]) VALUES (?, ?)",
+                 [digest, digest])
+    conn.execute(f"UPDATE [{File.table_name}] SET [{File.local_file_id.name}]=?, [{File.pending.name}]=0 "
+                 f"WHERE [{File.id.name}]=?", [digest, file_id])
+    conn.commit()
+    conn.close()
+    pool.close()
+    return db, volume, f"/buckets/bench/files/{file_id}/data/{digest}"
+
+
+def measure(db: str, volume: str, url: str, rounds: int, sendfile: bool):
+    """ Serves url rounds times from a forked server process. Returns the wall time taken and the server's CPU time """
+    server = WSGIServer(("127.0.0.1", 0), keep_alive=1, sendfile=sendfile)
+    server.RequestHandlerClass.log_message = lambda *args: None
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        server.set_app(API(ConnectionPool(db), volume))
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        for _ in range(rounds):
+            server.handle_request()
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+        os.write(w, str(cpu).encode())
+        os._exit(0)
+    os.close(w)
+    buffer = bytearray(4 * MIB)
+    start = time.monotonic()
+    for _ in range(rounds):
+        conn = http.client.HTTPConnection(*server.server_address)
+        conn.request("GET", url)
+        resp = conn.getresponse()
+        assert resp.status == 200, resp.status
+        while resp.readinto(buffer):
+            pass
+        conn.close()
+    wall = time.monotonic() - start
+    cpu = float(os.read(r, 64))
+    os.close(r)
+    os.waitpid(pid, 0)
+    server.server_close()
+    return wall, cpu
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares downloads sent with sendfile against userspace reads")
+    parser.add_argument("--size", help="the size of the blob downloaded, in MiB", type=int, default=2048)
+    parser.add_argument("--rounds", help="the number of times each path downloads the blob", type=int, default=3)
+    parser.add_argument("--dir", help="where to create the benchmark volume", default=None)
+    args = parser.parse_args()
+    root = mkdtemp(dir=args.dir)
+    try:
+        db, volume, url = make_volume(root, args.size)
+        with open(join(volume, url.rsplit("/", 1)[1]), "rb") as f:  # warm the page cache
+            while f.read(16 * MIB):
+                pass
+        gib = args.size * args.rounds / 1024
+        print(f"{'path':<10} {'GiB/s':>8} {'server CPU s/GiB':>18}")
+        for name, sendfile in (("sendfile", True), ("userspace", False)):
+            wall, cpu = measure(db, volume, url, args.rounds, sendfile)
+            print(f"{name:<10} {gib / wall:>8.2f} {cpu / gib:>18.3f}")
+    finally:
+        shutil.rmtree(root)
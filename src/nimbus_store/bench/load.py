@@ -0,0 +1,345 @@
+""" Load tests the HTTP API, either in-process through falcon.testing or over a real socket against start.py, and
+compares the results against a saved baseline.
+
+    python -m src.nimbus_store.bench.load --target socket --server threaded --rows 1000 1000000 --save base.json
+    python -m src.nimbus_store.bench.load --target socket --server threaded --rows 1000 1000000 --baseline base.json
+
+Scenarios:
+ - listing-N: fetching one page of a bucket holding N files, after a random cursor
+ - small-upload: creating a file and uploading a small blob for it
+ - small-download: downloading one of many small blobs
+ - large-download: streaming one large blob
+ - mixed: mostly reading file metadata and small blobs, with some uploads among them
+
+Each reports throughput and p50/p99 latency. With --baseline, the run fails if a scenario's throughput drops, or its
+p99 latency grows, by more than --threshold. Compare runs made on the same machine only """
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import typing
+from collections import namedtuple
+from falcon import testing
+from hashlib import md5
+from os.path import dirname, join
+from tempfile import mkdtemp
+from uuid import uuid4
+from .. import API, ConnectionPool
+from ..migrations import Migration
+from ..models.bucket import Bucket
+from ..models.file import File
+
+MIGRATIONS = join(dirname(__file__), "../../../db/sqlite/migrations")
+START = join(dirname(__file__), "../../../start.py")
+MIB = 1 << 20
+JSON = {"content-type": "application/json"}
+BINARY = {"content-type": "application/octet-stream"}
+
+Response = namedtuple("Response", ("status", "headers", "body"))
+
+
+class InProcess:
+    """ Sends requests straight to an app in this process """
+
+    def __init__(self, app):
+        self._client = testing.TestClient(app)
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None) -> Response:
+        result = self._client.simulate_request(method, path, body=body, headers=headers)
+        return Response(result.status_code, {k.lower(): v for k, v in result.headers.items()}, result.content)
+
+    def close(self):
+        pass
+
+
+class OverSocket:
+    """ Sends requests over one keep-alive HTTP connection, reconnecting when the server closes it """
+
+    def __init__(self, address: typing.Tuple[str, int]):
+        self._conn = http.client.HTTPConnection(*address)
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None) -> Response:
+        for attempt in (1, 2):
+            try:
+                self._conn.request(method, path, body=body, headers=headers or {})
+                resp = self._conn.getresponse()
+                return Response(resp.status, {k.lower(): v for k, v in resp.getheaders()}, resp.read())
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._conn.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        self._conn.close()
+
+
+def expect(resp: Response, status: int) -> Response:
+    if resp.status != status:
+        raise AssertionError(f"expected {status}, got {resp.status}: {resp.body[:200]!r}")
+    return resp
+
+
+def create_file(client, bucket: str, name: str) -> str:
+    file = {"name": name, "mime": "application/octet-stream", "path": "bench"}
+    return json.loads(expect(client.request("POST", f"/buckets/{bucket}/files", json.dumps(file).encode(), JSON),
+                             201).body)["id"]
+
+
+def upload(client, bucket: str, data: bytes) -> str:
+    """ Creates a file holding data. Returns the URL of its data """
+    id = create_file(client, bucket, "blob.bin")
+    url = f"/buckets/{bucket}/files/{id}/data/{md5(data).hexdigest()}"
+    expect(client.request("POST", url, data, BINARY), 204)
+    return url
+
+
+class Volume:
+    """ A fresh volume and database for a run, and the data the scenarios need in it """
+
+    def __init__(self, root: str, args):
+        self.db = join(root, "db.sqlite")
+        self.volume = join(root, "volume")
+        os.mkdir(self.volume)
+        self._pool = ConnectionPool(self.db)
+        Migration(MIGRATIONS, self._pool.connection())()
+        self.client = InProcess(API(self._pool, self.volume))
+        self._args = args
+        self.state = {}
+
+    def bucket(self, name: str) -> str:
+        expect(self.client.request("POST", "/buckets", json.dumps({"name": name, "desc": ""}).encode(), JSON), 201)
+        return name
+
+    def listing(self, rows: int):
+        """ A bucket of rows files, inserted straight into the database since creating a million through the API
+        would take longer than the benchmark """
+        bucket = self.bucket(f"listing-{rows}")
+        conn = sqlite3.connect(self.db)
+        bucket_id = conn.execute(f"SELECT [{Bucket.id.name}] FROM [{Bucket.table_name}] "
+                                 f"WHERE [{Bucket.name.name}] = ?", [bucket]).fetchone()[0]
+        ids = sorted(str(uuid4()) for _ in range(rows))
+        stmt = f"INSERT INTO [{File.table_name}] ([{File.id.name}], [{File.name.name}], [{File.mime.name}], " \
+               f"[{File.path.name}], [{File.bucket_id.name}]) VALUES (?, ?, 'text/plain', 'bench', ?)"
+        for i in range(0, rows, 10000):
+            conn.executemany(stmt, ([id, f"{id}.txt", bucket_id] for id in ids[i:i + 10000]))
+        conn.commit()
+        conn.close()
+        self.state[f"listing-{rows}"] = (bucket, ids)
+
+    def small(self):
+        bucket = self.bucket("small")
+        urls = [upload(self.client, bucket, os.urandom(self._args.small_size)) for _ in range(self._args.small_blobs)]
+        self.state["small"] = (bucket, urls, self._args.small_size)
+
+    def large(self):
+        bucket = self.bucket("large")
+        self.state["large"] = upload(self.client, bucket, os.urandom(self._args.large_size * MIB))
+
+    def close(self):
+        self._pool.close()
+
+
+def list_page(rows: int):
+    def op(client, state, rng: random.Random):
+        bucket, ids = state[f"listing-{rows}"]
+        after = rng.choice(ids)
+        expect(client.request("GET", f"/buckets/{bucket}/files?limit=100&after={after}", headers=JSON), 200)
+    return op
+
+
+def upload_small(client, state, rng: random.Random):
+    bucket, _, size = state["small"]
+    upload(client, bucket, rng.getrandbits(size * 8).to_bytes(size, "little"))
+
+
+def download_small(client, state, rng: random.Random):
+    expect(client.request("GET", rng.choice(state["small"][1])), 200)
+
+
+def download_large(client, state, rng: random.Random):
+    expect(client.request("GET", state["large"]), 200)
+
+
+def mixed(client, state, rng: random.Random):
+    """ 80% metadata reads, 15% small downloads and 5% small uploads """
+    roll = rng.random()
+    if roll < 0.05:
+        upload_small(client, state, rng)
+    elif roll < 0.2:
+        download_small(client, state, rng)
+    else:
+        file_url = rng.choice(state["small"][1]).rsplit("/data/", 1)[0]
+        expect(client.request("GET", file_url, headers=JSON), 200)
+
+
+def run(connect, op, state, requests: int, concurrency: int) -> dict:
+    """ Makes requests calls of op, from concurrency threads each with its own client. Returns the throughput and
+    latency percentiles """
+    counter = itertools.count()
+    latencies = []
+    errors = []
+
+    def worker(seed: int):
+        client = connect()
+        rng = random.Random(seed)
+        try:
+            while next(counter) < requests:
+                start = time.perf_counter()
+                try:
+                    op(client, state, rng)
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                latencies.append(time.perf_counter() - start)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f"  {len(errors)} errors, the first: {errors[0]}", file=sys.stderr)
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "ops_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def percentile(values: typing.List[float], q: float) -> float:
+    """ The q-th quantile of sorted values """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> typing.List[str]:
+    """ The regressions of results from baseline beyond threshold (a fraction), as messages """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["ops_per_second"] < base["ops_per_second"] * (1 - threshold):
+            regressions.append(f"{name}: {result['ops_per_second']:.1f} ops/s, "
+                               f"down from {base['ops_per_second']:.1f}")
+        if result["p99_ms"] > base["p99_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p99 {result['p99_ms']:.2f} ms, up from {base['p99_ms']:.2f}")
+    return regressions
+
+
+def start_server(volume: Volume, args) -> typing.Tuple[subprocess.Popen, typing.Tuple[str, int]]:
+    """ Runs start.py serving the volume on a free port, and waits for it to accept connections """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    cmd = [sys.executable, START, volume.volume, volume.db, "--server", args.server, "--host", "127.0.0.1",
+           "--port", str(port), "--threads", str(args.threads), "--workers", str(args.workers)]
+    server = subprocess.Popen(cmd, cwd=dirname(START), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server, ("127.0.0.1", port)
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError(f"{' '.join(cmd)} didn't start")
+            time.sleep(0.1)
+
+
+def scenarios(args) -> typing.Dict[str, typing.Tuple[typing.Callable, int]]:
+    """ The op and the number of requests of each scenario to run, by name """
+    chosen = {f"listing-{rows}": (list_page(rows), args.requests) for rows in args.rows}
+    chosen.update({
+        "small-upload": (upload_small, args.requests),
+        "small-download": (download_small, args.requests),
+        "large-download": (download_large, args.large_requests),
+        "mixed": (mixed, args.requests),
+    })
+    return {name: each for name, each in chosen.items()
+            if not args.scenarios or any(name.startswith(prefix) for prefix in args.scenarios)}
+
+
+def main(args) -> int:
+    root = mkdtemp(dir=args.dir)
+    server = None
+    try:
+        volume = Volume(root, args)
+        chosen = scenarios(args)
+        for name in chosen:
+            if name.startswith("listing-"):
+                volume.listing(int(name[len("listing-"):]))
+        volume.small()
+        if "large-download" in chosen:
+            volume.large()
+        if args.target == "socket":
+            server, address = start_server(volume, args)
+            connect = lambda: OverSocket(address)  # noqa: E731
+        else:
+            app = API(ConnectionPool(volume.db), volume.volume)
+            connect = lambda: InProcess(app)  # noqa: E731
+        results = {}
+        print(f"{'scenario':<16} {'requests':>9} {'errors':>7} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+        for name, (op, requests) in chosen.items():
+            result = results[name] = run(connect, op, volume.state, requests, args.concurrency)
+            print(f"{name:<16} {result['requests']:>9} {result['errors']:>7} {result['ops_per_second']:>10.1f} "
+                  f"{result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}")
+        volume.close()
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump({"target": args.target, "results": results}, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)["results"]
+            regressions = compare(results, baseline, args.threshold)
+            for each in regressions:
+                print(f"REGRESSION {each}", file=sys.stderr)
+            if regressions:
+                return 1
+        return 0
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests the HTTP API and compares the results to a baseline")
+    parser.add_argument("--target", help="drive the app in this process, or start.py over a socket",
+                        choices=("inprocess", "socket"), default="inprocess")
+    parser.add_argument("--server", help="start.py's --server mode, with --target socket", default="threaded")
+    parser.add_argument("--workers", help="start.py's --workers, with --server prefork", type=int, default=2)
+    parser.add_argument("--threads", help="start.py's --threads", type=int, default=8)
+    parser.add_argument("--scenarios", help="run only the scenarios starting with these names", nargs="*")
+    parser.add_argument("--rows", help="the number of files in the listed buckets, one listing scenario each",
+                        type=int, nargs="+", default=[1000, 100000])
+    parser.add_argument("--requests", help="the number of requests made by each scenario", type=int, default=2000)
+    parser.add_argument("--large-requests", help="the number of large blob downloads", type=int, default=20)
+    parser.add_argument("--concurrency", help="the number of clients making requests at once", type=int, default=8)
+    parser.add_argument("--small-size", help="the size of small blobs, in bytes", type=int, default=4096)
+    parser.add_argument("--small-blobs", help="the number of small blobs downloaded from", type=int, default=200)
+    parser.add_argument("--large-size", help="the size of the large blob, in MiB", type=int, default=64)
+    parser.add_argument("--save", help="save the results as a baseline to this JSON file")
+    parser.add_argument("--baseline", help="fail if the results regress from the baseline in this JSON file")
+    parser.add_argument("--threshold", help="the fraction by which results may regress from the baseline",
+                        type=float, default=0.2)
+    parser.add_argument("--dir", help="where to create the benchmark volume", default=None)
+    sys.exit(main(parser.parse_args()))
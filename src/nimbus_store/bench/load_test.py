@@ -0,0 +1,17 @@
+from .load import compare, percentile
+
+
+def test_percentile():
+    values = [i / 100 for i in range(100)]
+    assert percentile(values, 0.5) == 0.5
+    assert percentile(values, 0.99) == 0.99
+    assert percentile([], 0.5) == 0.0
+
+
+def test_compare():
+    baseline = {"a": {"ops_per_second": 100, "p99_ms": 10}, "b": {"ops_per_second": 100, "p99_ms": 10}}
+    results = {"a": {"ops_per_second": 85, "p99_ms": 11.5}, "b": {"ops_per_second": 70, "p99_ms": 13},
+               "new": {"ops_per_second": 1, "p99_ms": 1000}}
+    regressions = compare(results, baseline, 0.2)
+    assert len(regressions) == 2
+    assert all(each.startswith("b:") for each in regressions)
@@ -0,0 +1,105 @@
+""" Times the round trips of Bucket, File and LocalFile rows through the model layer, per row.
+
+    python -m src.nimbus_store.bench.models --rows 10000 --rounds 5
+
+"objects" is a row loaded as a model object and rendered with to_dict, as single-entity requests do. "dicts" is a row
+rendered with dict_from_db_row, as listings do. "insert" builds the INSERT statement and parameters for a new row.
+The "baseline" columns do the objects and insert round trips the way the model layer did before rows kept their
+values in a list: a Field built per field of every row, rows matched to fields by column name and statements built
+afresh. Rows are made in memory, so this measures the Python overhead only, not sqlite """
+import argparse
+import time
+from ..models.bucket import Bucket
+from ..models.file import File
+from ..models.local_file import LocalFile
+from ..models.model import Field
+
+ROWS = {
+    Bucket: (1, "images", "Pictures uploaded by users"),
+    File: ("1b4e28ba-2fa1-11d2-883f-0016d3cca427", "cat.jpg", "image/jpeg", "pets/cats", 0, "2024-01-01 00:00:00",
+           "2024-01-01 00:00:00", "d41d8cd98f00b204e9800998ecf8427e", 1),
+    LocalFile: ("d41d8cd98f00b204e9800998ecf8427e", "d41d8cd98f00b204e9800998ecf8427e", 1, "identity", 0,
+                "5f1c2e7a9b3d4c6e8f0a1b2c3d4e5f60"),
+}
+
+
+class Baseline:
+    """ A model object as the model layer used to make one, kept here to measure against """
+
+    def __init__(self, model, row):
+        self.model = model
+        values = {}
+        for name, value in zip(model.cols(), row):
+            for key, field in model.fields.items():
+                if field.name == name:
+                    values[key] = value
+                    break
+        self.fields = {}
+        for key, field in model.fields.items():
+            copy = Field(field.desc, field.type, name=field.name, writable=field.writable)
+            if key in values:
+                copy.value = values[key]
+            self.fields[key] = copy
+
+    def to_dict(self) -> dict:
+        return {key: field.value for key, field in self.fields.items()}
+
+    def insert_statement(self, *extra_fields: Field):
+        writable = [field for field in self.fields.values() if field.writable]
+        placeholders = ",".join(["?"] * (len(writable) + len(extra_fields)))
+        columns = ", ".join(f"[{field.name}]" for field in writable + list(extra_fields))
+        stmt = f"INSERT INTO {self.model.table_name}({columns}) VALUES ({placeholders})"
+        return stmt, [field.value for field in writable] + [field.value for field in extra_fields]
+
+
+def baseline_objects(model, rows):
+    for row in rows:
+        Baseline(model, row).to_dict()
+
+
+def baseline_insert(model, rows):
+    for row in rows:
+        obj = Baseline(model, row)
+        obj.insert_statement(obj.fields["id"])
+
+
+def objects(model, rows):
+    for row in rows:
+        model.from_db_row(row).to_dict()
+
+
+def dicts(model, rows):
+    for row in rows:
+        model.dict_from_db_row(row)
+
+
+def insert(model, rows):
+    for row in rows:
+        obj = model.from_db_row(row)
+        obj.insert_statement(obj.id)
+
+
+def measure(fn, model, rows, rounds: int) -> float:
+    """ The best time of rounds runs of fn over rows, in microseconds per row """
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(model, rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(rows) * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times model round trips of Bucket, File and LocalFile rows")
+    parser.add_argument("--rows", help="the number of rows converted per round", type=int, default=10000)
+    parser.add_argument("--rounds", help="the number of rounds, of which the best is reported", type=int, default=5)
+    args = parser.parse_args()
+    fns = (baseline_objects, objects, dicts, baseline_insert, insert)
+    names = ("baseline objects", "objects", "dicts", "baseline insert", "insert")
+    print(f"{'model':<10} " + " ".join(f"{name + ' us/row':>22}" for name in names))
+    for model, row in ROWS.items():
+        assert len(row) == len(model.fields), f"the sample {model.__name__} row must have a value per field"
+        rows = [row] * args.rows
+        times = [measure(fn, model, rows, args.rounds) for fn in fns]
+        print(f"{model.__name__:<10} " + " ".join(f"{each:>22.2f}" for each in times))
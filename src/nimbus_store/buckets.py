@@ -1,19 +1,44 @@
 import falcon
+from .cache import READ_METHODS
 from .models.bucket import Bucket
 from .util import require
 from .resource import ApiResource
+from inspect import iscoroutinefunction
 import sqlite3
+import typing
+
+
+def find_bucket(resource: ApiResource, name: str) -> Bucket:
+    cache = resource._cache.buckets
+    generation = cache.generation
+    cursor = resource._db.cursor()
+    stmt = cursor.execute(Bucket.find_statement(Bucket.name), [name])
+    row = stmt.fetchone()
+    if row is None:
+        raise falcon.HTTPNotFound(description=f"No bucket with name '{name}' found")
+    cache.put(name, row, generation)
+    return Bucket.from_db_row(row)
+
+
+def cached_bucket(resource: ApiResource, req: falcon.Request, name: str) -> typing.Optional[Bucket]:
+    """ The bucket with the given name from the cache, if it is there and the request only reads """
+    if req.method not in READ_METHODS:
+        return None
+    resource._cache.sync(resource._db)
+    row = resource._cache.buckets.get(name)
+    return None if row is None else Bucket.from_db_row(row)
 
 
 def validate_bucket(next):
+    if iscoroutinefunction(next):
+        async def f(self, req: falcon.Request, resp: falcon.Response, bucket: str, **kwargs):
+            # a cached bucket is used without a trip to the database executor
+            req.context.bucket = cached_bucket(self, req, bucket) or await self._run(find_bucket, self, bucket)
+            await next(self, req, resp, **kwargs)
+        return f
+
     def f(self, req: falcon.Request, resp: falcon.Response, bucket: str, **kwargs):
-        cursor = self._db.cursor()
-        stmt = cursor.execute(Bucket.find_statement(Bucket.name), [bucket])
-        row = stmt.fetchone()
-        if row is None:
-            raise falcon.HTTPNotFound(description=f"No bucket with name '{bucket}' found")
-        bucket = Bucket.from_db_row(row)
-        req.context.bucket = bucket
+        req.context.bucket = cached_bucket(self, req, bucket) or find_bucket(self, bucket)
         next(self, req, resp, **kwargs)
     return f
 
@@ -38,34 +63,24 @@ class BucketCollectionResource(ApiResource):
 
     @require("application/json")
     def on_get(self, req: falcon.Request, resp: falcon.Response):
-        """ List all buckets visible to the user """
-        cursor = self._db.cursor()
-        stmt = Bucket.find_statement()
-        rows = cursor.execute(stmt)
-        resources = rows.fetchall()  # If this is likely to ever be large, we should paginate this
-        buckets = []
-        for res in resources:
-            buckets.append(Bucket.from_db_row(res).to_dict())
-        resp.media = buckets
+        """ List buckets visible to the user, a page at a time or streamed """
+        self._list(req, resp, Bucket, Bucket.id)
 
-    @require("application/json")
-    def on_post(self, req: falcon.Request, resp: falcon.Response):
-        bucket = Bucket.from_dict(req.media)
-        cursor = self._db.cursor()
+    def _create_bucket(self, bucket: Bucket) -> Bucket:
         try:
-            stmt = cursor.execute(f"""SELECT {Bucket.select_columns()} FROM {Bucket.table_name}
-                WHERE {Bucket.name.name} = '{bucket.name.value}'""")
-            if stmt.fetchone() is not None:
-                raise falcon.HTTPConflict(description="A bucket with that name already exists")
+            self._write(self._execute, *bucket.insert_statement())
+            return self._get_bucket(bucket.name.value)
+        except sqlite3.IntegrityError:
+            # bucket names are enforced unique by the BucketName index
+            raise falcon.HTTPConflict(description="A bucket with that name already exists")
         except sqlite3.Error as e:
             raise falcon.HTTPInternalServerError(description=str(e))
-        try:
-            stmt, params = bucket.insert_statement()
-            cursor.execute(stmt, params)
-            self._db.commit()
-            bucket = self._get_bucket(bucket.name.value)
         except TypeError as e:
             # this is probably an invalid value for a field
-            raise falcon.HTTPBadRequest("Invalid value for bucket", str(e))
+            raise falcon.HTTPBadRequest(title="Invalid value for bucket", description=str(e))
+
+    @require("application/json")
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        bucket = self._create_bucket(Bucket.from_dict(req.media))
         resp.status = falcon.HTTP_201
         resp.media = bucket.to_dict()
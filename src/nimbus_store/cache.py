@@ -0,0 +1,114 @@
+import sqlite3
+import threading
+import time
+import typing
+import weakref
+from collections import OrderedDict
+from .config import Config
+from .db import ConnectionPool
+from .metrics import metrics
+
+
+# Requests which only read, and so may be served from the cache
+READ_METHODS = ("GET", "HEAD")
+
+
+class LRUCache:
+    """ A thread-safe mapping of at most maxsize entries, each kept for at most ttl seconds, which evicts the least
+    recently used entry when full. Counts its hits and misses """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._maxsize > 0 and self._ttl > 0
+
+    @property
+    def generation(self) -> int:
+        """ Changes on every invalidation. Take it before reading a value from the database, and pass it to put, so a
+        value read before a concurrent write is never cached after that write's invalidation """
+        return self._generation
+
+    def get(self, key):
+        """ The value cached for key, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, generation: int):
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class MetadataCache:
+    """ The rows of buckets by name and of files by id most recently looked up by requests, shared by every resource
+    of a process using the same database. Only requests which read use them, after calling sync """
+
+    def __init__(self, config: Config):
+        self.buckets = LRUCache(config.cache_size, config.cache_ttl)
+        self.files = LRUCache(config.cache_size, config.cache_ttl)
+        self._seen = threading.local()
+
+    def sync(self, db: sqlite3.Connection):
+        """ Drops every cached row if another connection, maybe of another process, has committed since the calling
+        thread's connection db last looked. Writes of this process invalidate what they change themselves """
+        if not self.buckets.enabled and not self.files.enabled:
+            return
+        seen = (db, db.execute("PRAGMA data_version").fetchone()[0])
+        if getattr(self._seen, "version", None) != seen:
+            self.buckets.clear()
+            self.files.clear()
+            self._seen.version = seen
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {f"{name}_cache_{stat}": getattr(cache, stat)
+                for name, cache in (("bucket", self.buckets), ("file", self.files)) for stat in ("hits", "misses")}
+
+
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def metadata_cache(db: ConnectionPool, config: Config) -> MetadataCache:
+    """ The cache of the given database, made with config on first use """
+    with _caches_lock:
+        cache = _caches.get(db)
+        if cache is None:
+            cache = _caches[db] = MetadataCache(config)
+            metrics.add_source("", cache.stats)
+        return cache
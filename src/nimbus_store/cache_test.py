@@ -0,0 +1,63 @@
+import json
+import time
+from falcon import testing
+from hashlib import md5
+from . import API
+from .cache import LRUCache, metadata_cache
+from .config import Config
+from .db import ConnectionPool
+from .test import client, headers_binary, headers_json, pool, tempd
+
+
+def test_lru_cache():
+    cache = LRUCache(2, 60)
+    for key in "abc":
+        cache.put(key, key.upper(), cache.generation)
+    assert cache.get("a") is None
+    assert cache.get("b") == "B"
+    cache.put("d", "D", cache.generation)  # evicts c, as b was used more recently
+    assert cache.get("c") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+    # a value read before an invalidation isn't cached
+    generation = cache.generation
+    cache.invalidate("b")
+    cache.put("b", "stale", generation)
+    assert cache.get("b") is None
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(2, 0.01)
+    cache.put("a", "A", cache.generation)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+
+
+def test_file_cache(client):
+    client.simulate_post("/buckets", body=json.dumps({"name": "cached", "desc": ""}), headers=headers_json)
+    file = {"name": "a.txt", "mime": "text/plain", "path": "cached"}
+    id = client.simulate_post("/buckets/cached/files", body=json.dumps(file), headers=headers_json).json["id"]
+    cache = metadata_cache(pool, Config()).files
+    assert client.simulate_get(f"/buckets/cached/files/{id}", headers=headers_json).status_code == 200
+    hits = cache.hits
+    assert client.simulate_get(f"/buckets/cached/files/{id}", headers=headers_json).status_code == 200
+    assert cache.hits == hits + 1
+    assert client.simulate_delete(f"/buckets/cached/files/{id}", headers=headers_json).status_code == 204
+    assert client.simulate_get(f"/buckets/cached/files/{id}", headers=headers_json).status_code == 404
+
+
+def test_file_deleted_by_another_process(client):
+    other = testing.TestClient(API(ConnectionPool(pool.path), tempd))  # a worker with a pool and cache of its own
+    client.simulate_post("/buckets", body=json.dumps({"name": "shared", "desc": ""}), headers=headers_json)
+    file = {"name": "a.txt", "mime": "text/plain", "path": "shared"}
+    ids = [client.simulate_post("/buckets/shared/files", body=json.dumps(file), headers=headers_json).json["id"]
+           for _ in range(2)]
+    digest = md5(b"shared").hexdigest()
+    for id in ids:  # the second keeps the blob from being collected by other tests
+        client.simulate_post(f"/buckets/shared/files/{id}/data/{digest}", body=b"shared", headers=headers_binary)
+    id = ids[0]
+    for _ in range(2):  # the second from the cache
+        assert other.simulate_get(f"/buckets/shared/files/{id}", headers=headers_json).status_code == 200
+        assert other.simulate_get(f"/buckets/shared/files/{id}/data/{digest}").content == b"shared"
+    assert client.simulate_delete(f"/buckets/shared/files/{id}", headers=headers_json).status_code == 204
+    assert other.simulate_get(f"/buckets/shared/files/{id}", headers=headers_json).status_code == 404
+    assert other.simulate_get(f"/buckets/shared/files/{id}/data/{digest}").status_code == 404
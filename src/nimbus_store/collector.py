@@ -0,0 +1,307 @@
+import fcntl
+import os
+import sqlite3
+import time
+import typing
+from collections import Counter
+from os.path import join
+from uuid import uuid4
+from .background import Periodic
+from .cache import metadata_cache
+from .config import Config
+from .db import ConnectionPool
+from .ingest import valid_checksum
+from .layout import PACK_DIR, is_packed, locate
+from .metrics import metrics
+from .models.file import File
+from .models.local_file import LocalFile
+from .models.segment import PackedBlob, Segment
+from .models.upload import Upload
+from .packs import pack_store
+from .volumes import Volume, Volumes
+
+
+# The most rows deleted per transaction
+BATCH_SIZE = 500
+# Temporary files and unrecorded blobs younger than this may belong to an upload in progress, so are left alone
+GRACE_PERIOD = 3600
+# The volume is reconciled against the database on every this many passes
+RECONCILE_EVERY = 12
+# Prefixes of the temporary files kept in the volume root
+TEMPORARY = (".ingest-", ".trash-")
+# A batch of the local_files no file refers to
+UNREFERENCED = f"SELECT {LocalFile.select_columns()} FROM [{LocalFile.table_name}] WHERE [{LocalFile.refs.name}] = 0 " \
+               f"LIMIT ?"
+# Deletes a local_file, unless a file was attached to it since it was selected
+DELETE_UNREFERENCED = f"DELETE FROM [{LocalFile.table_name}] WHERE [{LocalFile.id.name}] = ? AND " \
+                      f"[{LocalFile.refs.name}] = 0"
+# Deletes a batch of the files created before a time relative to now which never received data, and aren't uploading
+EXPIRE_PENDING = f"DELETE FROM [{File.table_name}] WHERE [{File.id.name}] IN (" \
+                 f"SELECT [{File.id.name}] FROM [{File.table_name}] " \
+                 f"WHERE [{File.pending.name}] = 1 AND [{File.created.name}] < datetime('now', ?) AND NOT EXISTS " \
+                 f"(SELECT 1 FROM [{Upload.table_name}] WHERE [{Upload.file_id.name}] = [{File.table_name}].[id]) " \
+                 f"LIMIT ?)"
+
+
+class Collector:
+    """ Deletes blobs no file uses, files left pending for longer than config.pending_ttl and mostly deleted segments,
+    in the background and at most config.gc_rate per second """
+
+    def __init__(self, db: ConnectionPool, volumes: typing.Union[str, Volumes], config: Config = None):
+        self._pool = db
+        self._volumes = Volumes.of(volumes)
+        self._root = self._volumes.primary.root
+        self._config = config or Config()
+        self._packs = [pack_store(volume, self._config) for volume in self._volumes]
+        self._passes = 0
+        self.stats = Counter()
+        metrics.add_source("collector", self.counts)
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return self._pool.connection()
+
+    def counts(self) -> typing.Dict[str, float]:
+        return dict(self.stats)
+
+    def run(self, reconcile: bool = None) -> bool:
+        """ Makes one pass, reconciling every RECONCILE_EVERY passes or as reconcile says, unless another process
+        is. Returns whether it did """
+        for packs in self._packs:
+            packs.prune()
+        with open(join(self._root, ".collector.lock"), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            start = time.monotonic()
+            self.collect_blobs()
+            self.expire_pending()
+            for packs in self._packs:
+                packs.compact(self._db, self._throttle)
+            if self._passes % RECONCILE_EVERY == 0 if reconcile is None else reconcile:
+                self.reconcile()
+            self._passes += 1
+            self.stats["passes"] += 1
+            self.stats["last_pass_seconds"] = time.monotonic() - start
+            return True
+
+    def _throttle(self, count: int):
+        """ Sleeps long enough that count deletions keep to the rate limit """
+        if count and self._config.gc_rate > 0:
+            time.sleep(count / self._config.gc_rate)
+
+    def collect_blobs(self):
+        """ Deletes the blobs whose local_file has no refs, moving each out of the way in the transaction deleting its
+        row """
+        cursor = self._db.cursor()
+        while True:
+            local_files = [LocalFile.from_db_row(row) for row in cursor.execute(UNREFERENCED, [BATCH_SIZE]).fetchall()]
+            if not local_files:
+                return
+            self._db.execute("BEGIN IMMEDIATE")
+            trash = []
+            packed = 0
+            try:
+                for local_file in local_files:
+                    r = cursor.execute(DELETE_UNREFERENCED, [local_file.id.value])
+                    if r.rowcount != 1:  # attached to a file since it was selected
+                        continue
+                    if is_packed(local_file):
+                        cursor.execute(PackedBlob.delete_statement(PackedBlob.id), [local_file.id.value])
+                        packed += 1
+                        continue
+                    fname = self._locate(local_file)
+                    if fname is not None:
+                        volume = self._volumes.get(local_file.volume.value)
+                        trashed = join(volume.root, f".trash-{uuid4()}")
+                        os.rename(fname, trashed)
+                        trash.append((fname, trashed))
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                for fname, trashed in trash:
+                    os.rename(trashed, fname)
+                raise
+            for _, trashed in trash:
+                self.stats["bytes_collected"] += os.stat(trashed).st_size
+                os.remove(trashed)
+            self.stats["blobs_collected"] += len(trash) + packed
+            self._throttle(len(local_files))
+
+    def expire_pending(self):
+        """ Deletes files which never received any data """
+        cursor = self._db.cursor()
+        while True:
+            r = cursor.execute(EXPIRE_PENDING, [f"-{int(self._config.pending_ttl)} seconds", BATCH_SIZE])
+            self._db.commit()
+            if r.rowcount:
+                metadata_cache(self._pool, self._config).files.clear()
+            self.stats["pending_expired"] += r.rowcount
+            if r.rowcount < BATCH_SIZE:
+                return
+            self._throttle(r.rowcount)
+
+    def reconcile(self):
+        """ Deletes blobs, segments and temporary files on disk which aren't recorded, and counts missing blobs """
+        cutoff = time.time() - GRACE_PERIOD
+        upload_ids = None
+        for volume in self._volumes:
+            for dirpath, dirnames, filenames in os.walk(volume.root):
+                if dirpath == join(volume.root, PACK_DIR):
+                    self._reconcile_segments(volume, filenames, cutoff)
+                    continue
+                blobs = []
+                for name in filenames:
+                    path = join(dirpath, name)
+                    if name.startswith(TEMPORARY) or name.startswith(".upload-"):
+                        if dirpath != volume.root or not self._old(path, cutoff):
+                            continue
+                        if name.startswith(".upload-"):
+                            if upload_ids is None:
+                                upload_ids = self._upload_ids()
+                            if name[len(".upload-"):] in upload_ids:
+                                continue
+                        self._remove(path, "temporary_removed")
+                    elif valid_checksum(self._config.digest, name):
+                        blobs.append(name)
+                recorded = self._recorded(volume, blobs)
+                for name in blobs:
+                    if name not in recorded and self._old(join(dirpath, name), cutoff):
+                        self._remove(join(dirpath, name), "orphans_removed")
+        self.stats["missing_blobs"] = self._count_missing()
+
+    def _reconcile_segments(self, volume: Volume, filenames: typing.List[str], cutoff: float):
+        """ Deletes segments which aren't recorded, e.g. because the transaction which would have was rolled back """
+        cursor = self._db.cursor()
+        recorded = {path for path, in cursor.execute(
+            f"SELECT [{Segment.path.name}] FROM [{Segment.table_name}] "
+            f"WHERE [{Segment.volume.name}] IN ({','.join('?' * len(volume.ids))})", volume.ids)}
+        for name in filenames:
+            path = join(PACK_DIR, name)
+            if path not in recorded and self._old(join(volume.root, path), cutoff):
+                self._remove(join(volume.root, path), "orphans_removed")
+
+    def _old(self, path: str, cutoff: float) -> bool:
+        try:
+            return os.stat(path).st_mtime < cutoff
+        except FileNotFoundError:
+            return False
+
+    def _remove(self, path: str, stat: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        self.stats[stat] += 1
+        self._throttle(1)
+
+    def _locate(self, local_file: LocalFile) -> typing.Optional[str]:
+        volume = self._volumes.get(local_file.volume.value)
+        return None if volume is None else locate(volume.root, self._config.layout, local_file)
+
+    def _upload_ids(self) -> typing.Set[str]:
+        cursor = self._db.cursor()
+        return {id for id, in cursor.execute(f"SELECT [{Upload.id.name}] FROM [{Upload.table_name}]")}
+
+    def _recorded(self, volume: Volume, checksums: typing.List[str]) -> typing.Set[str]:
+        """ Which of the checksums have a local_file in volume """
+        cursor = self._db.cursor()
+        recorded = set()
+        for i in range(0, len(checksums), BATCH_SIZE):
+            chunk = checksums[i:i + BATCH_SIZE]
+            rows = cursor.execute(f"SELECT [{LocalFile.id.name}], [{LocalFile.volume.name}] "
+                                  f"FROM [{LocalFile.table_name}] "
+                                  f"WHERE [{LocalFile.id.name}] IN ({','.join('?' * len(chunk))})", chunk)
+            recorded.update(id for id, recorded_volume in rows if recorded_volume in volume.ids)
+        return recorded
+
+    def _count_missing(self) -> int:
+        cursor = self._db.cursor()
+        stmt = LocalFile.page_statement(LocalFile.id, after=True, limit=True)
+        missing = 0
+        after = ""
+        while True:
+            local_files = [LocalFile.from_db_row(row) for row in cursor.execute(stmt, [after, BATCH_SIZE])]
+            if not local_files:
+                return missing
+            missing += sum(1 for each in local_files if self._locate(each) is None)
+            after = local_files[-1].id.value
+
+
+def collector(db: ConnectionPool, volumes: typing.Union[str, Volumes], config: Config) -> typing.Optional[Periodic]:
+    """ A thread running the collector every config.gc_interval seconds, or None if that is 0 """
+    if config.gc_interval <= 0:
+        return None
+    return Periodic(config.gc_interval, Collector(db, volumes, config).run, name="nimbus-collector")
+
+
+if __name__ == "__main__":
+    import argparse
+    from .ingest import DIGESTS
+    from .layout import LAYOUTS
+    from .volumes import parse_volume
+    parser = argparse.ArgumentParser(
+        description="Makes one pass of the collector over a node's volumes, e.g. from cron when the server is started "
+                    "with --gc-interval 0"
+    )
+    parser.add_argument(
+        "volume",
+        help="the local system path of the nimbus storage root, the primary volume, optionally as PATH=WEIGHT"
+    )
+    parser.add_argument(
+        "db",
+        help="the path to the local instance of the database file"
+    )
+    parser.add_argument(
+        "--reconcile",
+        help="also reconcile the volumes against the database",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--volume",
+        help="another volume of the node; every volume the server uses must be given",
+        metavar="PATH[=WEIGHT]",
+        dest="volumes",
+        action="append",
+        default=[]
+    )
+    parser.add_argument(
+        "--digest",
+        help="the algorithm blobs are content-addressed by, which must be the server's",
+        choices=tuple(DIGESTS),
+        default="md5"
+    )
+    parser.add_argument(
+        "--layout",
+        help="how blobs are arranged in the volumes, which must be the server's",
+        choices=LAYOUTS,
+        default="flat"
+    )
+    parser.add_argument(
+        "--pending-ttl",
+        help="how many seconds a file can stay without data before it is deleted",
+        type=float,
+        default=7 * 86400
+    )
+    parser.add_argument(
+        "--compact-ratio",
+        help="the fraction of a segment's bytes which must belong to deleted blobs before it is rewritten",
+        type=float,
+        default=0.5
+    )
+    parser.add_argument(
+        "--gc-rate",
+        help="the most deletions made per second",
+        type=float,
+        default=1000
+    )
+    args = parser.parse_args()
+    volumes = Volumes([Volume(root, weight) for root, weight in map(parse_volume, [args.volume] + args.volumes)])
+    config = Config(digest=args.digest, layout=args.layout, pending_ttl=args.pending_ttl,
+                    compact_ratio=args.compact_ratio, gc_rate=args.gc_rate)
+    pass_ = Collector(ConnectionPool(args.db), volumes, config)
+    if not pass_.run(args.reconcile):
+        parser.exit(1, "The volume is being collected by another process\n")
+    for stat, count in sorted(pass_.stats.items()):
+        print(f"{stat}: {count}")
@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+from hashlib import md5
+from os.path import exists, join
+from . import API, background_services
+from .collector import Collector, GRACE_PERIOD
+from .config import Config
+from .models.local_file import LocalFile
+from .test import client, db, headers_json, headers_binary, pool, tempd
+
+
+def create_file(client, name: str) -> str:
+    file = {"name": name, "mime": "text/plain", "path": "gc"}
+    return client.simulate_post("/buckets/gc/files", body=json.dumps(file), headers=headers_json).json["id"]
+
+
+def refs(local_file_id: str) -> int:
+    row = db.cursor().execute(LocalFile.find_by_id_statement(), [local_file_id]).fetchone()
+    return LocalFile.from_db_row(row).refs.value
+
+
+def test_collect_unreferenced(client):
+    client.simulate_post("/buckets", body=json.dumps({"name": "gc", "desc": ""}), headers=headers_json)
+    data = b"collect me"
+    digest = md5(data).hexdigest()
+    ids = [create_file(client, f"{i}.txt") for i in range(2)]
+    for id in ids:
+        client.simulate_post(f"/buckets/gc/files/{id}/data/{digest}", body=data, headers=headers_binary)
+    assert refs(digest) == 2
+    client.simulate_delete(f"/buckets/gc/files/{ids[0]}", headers=headers_json)
+    assert refs(digest) == 1
+    client.simulate_delete(f"/buckets/gc/files/{ids[1]}", headers=headers_json)
+    assert refs(digest) == 0
+    # deleting doesn't touch the blob, so it can be uploaded again until collected
+    id = create_file(client, "again.txt")
+    result = client.simulate_post(f"/buckets/gc/files/{id}/data/{digest}", headers=headers_binary)
+    assert result.status_code == 204
+    assert refs(digest) == 1
+    client.simulate_delete(f"/buckets/gc/files/{id}", headers=headers_json)
+    collector = Collector(pool, tempd)
+    assert collector.run()
+    assert not exists(join(tempd, digest))
+    assert collector.stats["blobs_collected"] == 1
+    assert collector.stats["bytes_collected"] == len(data)
+    assert not [name for name in os.listdir(tempd) if name.startswith(".trash-")]
+
+
+def test_expire_pending(client):
+    client.simulate_post("/buckets", body=json.dumps({"name": "gc", "desc": ""}), headers=headers_json)
+    old, new = create_file(client, "old.txt"), create_file(client, "new.txt")
+    db.execute("UPDATE file SET created = datetime('now', '-8 days') WHERE id = ?", [old])
+    db.commit()
+    collector = Collector(pool, tempd)
+    collector.expire_pending()
+    assert collector.stats["pending_expired"] == 1
+    assert client.simulate_get(f"/buckets/gc/files/{old}", headers=headers_json).status_code == 404
+    assert client.simulate_get(f"/buckets/gc/files/{new}", headers=headers_json).status_code == 200
+
+
+def test_reconcile(client):
+    orphan, recent, temporary = md5(b"orphan").hexdigest(), md5(b"recent").hexdigest(), ".ingest-crashed"
+    for name in (orphan, recent, temporary):
+        with open(join(tempd, name), "wb") as f:
+            f.write(name.encode())
+    old = time.time() - GRACE_PERIOD - 60
+    for name in (orphan, temporary):
+        os.utime(join(tempd, name), (old, old))
+    collector = Collector(pool, tempd)
+    collector.reconcile()
+    assert not exists(join(tempd, orphan))
+    assert not exists(join(tempd, temporary))
+    assert exists(join(tempd, recent))
+    assert collector.stats["orphans_removed"] == 1
+    assert collector.stats["temporary_removed"] == 1
+    os.remove(join(tempd, recent))
+
+
+def test_run_without_reconciling():
+    orphan = join(tempd, md5(b"kept").hexdigest())
+    with open(orphan, "wb") as f:
+        f.write(b"kept")
+    old = time.time() - GRACE_PERIOD - 60
+    os.utime(orphan, (old, old))
+    collector = Collector(pool, tempd)
+    assert collector.run(reconcile=False)
+    assert exists(orphan)
+    assert collector.run(reconcile=True)
+    assert not exists(orphan)
+
+
+def test_background_services_are_explicit():
+    threads = threading.active_count()
+    API(pool, tempd)
+    assert threading.active_count() == threads
+    services = background_services(pool, tempd)
+    assert [service.name for service in services] == ["nimbus-upload-expiry", "nimbus-collector"]
+    assert not any(service.is_alive() for service in services)
+    assert len(background_services(pool, tempd, Config(gc_interval=0))) == 1
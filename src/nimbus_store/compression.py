@@ -0,0 +1,104 @@
+import lzma
+import typing
+import zlib
+from fnmatch import fnmatch
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional
+    zstandard = None
+
+
+IDENTITY = "identity"
+# The encodings blobs can be compressed with on disk, by their HTTP Content-Encoding name. xz isn't a registered
+# content coding, but clients which ask for it by name get it
+ENCODINGS = ("gzip", "xz") + (("zstd",) if zstandard is not None else ())
+# Size of the reads of a compressed blob which is decompressed for a client
+READ_SIZE = 64 * 1024
+
+
+def compressor(encoding: str):
+    """ A new compressor for the encoding, with compress(data) and flush() methods returning the compressed bytes """
+    if encoding == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 16 + 15: with a gzip header and trailer
+    if encoding == "xz":
+        return lzma.LZMACompressor(lzma.FORMAT_XZ)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def decompressor(encoding: str):
+    """ A new decompressor for the encoding, with a decompress(data) method returning the original bytes """
+    if encoding == "gzip":
+        return zlib.decompressobj(31)
+    if encoding == "xz":
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def check_policy(policy: typing.Dict[str, str]):
+    for encoding in policy.values():
+        if encoding != IDENTITY and encoding not in ENCODINGS:
+            raise ValueError(f"compression encodings must be {IDENTITY} or one of {', '.join(ENCODINGS)}")
+
+
+def choose_encoding(config, bucket: str, mime: str) -> str:
+    """ How a new blob of a file in the given bucket, of the given mime type, is stored: by the bucket's policy if it
+    has one, otherwise by that of the first mime type pattern it matches, otherwise as is """
+    encoding = config.bucket_compression.get(bucket)
+    if encoding is None:
+        encoding = next((each for pattern, each in config.compression.items() if fnmatch(mime, pattern)), IDENTITY)
+    return encoding
+
+
+def accepts(header: typing.Optional[str], encoding: str) -> bool:
+    """ Whether an Accept-Encoding header accepts the encoding """
+    if not header:
+        return False
+    wildcard = False
+    for item in header.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        coding = coding.lower()
+        if coding == encoding:
+            return q > 0
+        if coding == "*":
+            wildcard = q > 0
+    return wildcard
+
+
+class Decompressed:
+    """ A readable view of a compressed blob's original bytes, decompressed as they are read """
+
+    def __init__(self, f, encoding: str):
+        self._f = f
+        self._decompressor = decompressor(encoding)
+        self._buffer = bytearray()
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self._f.read(READ_SIZE)
+            if not chunk:
+                self._eof = True
+                break
+            self._buffer += self._decompressor.decompress(chunk)
+        if size is None or size < 0 or size >= len(self._buffer):
+            data, self._buffer = bytes(self._buffer), bytearray()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def close(self):
+        self._f.close()
@@ -0,0 +1,73 @@
+import gzip
+import json
+import lzma
+import pytest
+from falcon import testing
+from hashlib import md5
+from os.path import getsize, join
+from tempfile import mkdtemp
+from . import API
+from .compression import accepts
+from .config import Config
+from .test import headers_json, headers_binary, migrated_pool
+
+data = b"".join(b"line %d of a very compressible log\n" % i for i in range(10000))
+digest = md5(data).hexdigest()
+
+
+@pytest.fixture(scope="module")
+def client():
+    pool = migrated_pool()
+    volume = mkdtemp()
+    config = Config(compression={"text/*": "gzip"}, bucket_compression={"archive": "xz", "raw": "identity"})
+    client = testing.TestClient(API(pool, volume, config))
+    client.volume = volume
+    return client
+
+
+def upload(client, bucket: str, mime: str, data: bytes = data) -> str:
+    client.simulate_post("/buckets", body=json.dumps({"name": bucket, "desc": ""}), headers=headers_json)
+    file = {"name": "log.txt", "mime": mime, "path": "logs"}
+    id = client.simulate_post(f"/buckets/{bucket}/files", body=json.dumps(file), headers=headers_json).json["id"]
+    url = f"/buckets/{bucket}/files/{id}/data/{md5(data).hexdigest()}"
+    assert client.simulate_post(url, body=data, headers=headers_binary).status_code == 204
+    return url
+
+
+def test_accepts():
+    assert accepts("gzip, deflate, br", "gzip")
+    assert not accepts("gzip;q=0, *", "gzip")
+    assert accepts("*;q=0.5", "xz")
+    assert not accepts("identity", "gzip")
+    assert not accepts(None, "gzip")
+
+
+def test_compressed_by_mime(client):
+    url = upload(client, "logs", "text/plain")
+    assert getsize(join(client.volume, digest)) < len(data) // 10
+    result = client.simulate_get(url, headers={"Accept-Encoding": "gzip"})
+    assert result.headers["Content-Encoding"] == "gzip"
+    assert result.headers["ETag"] == f'"{digest}-gzip"'
+    assert gzip.decompress(result.content) == data
+    result = client.simulate_get(url)
+    assert "Content-Encoding" not in result.headers
+    assert result.headers["ETag"] == f'"{digest}"'
+    assert result.headers["Vary"] == "Accept-Encoding"
+    assert result.content == data
+    # ranges of compressed blobs aren't served
+    result = client.simulate_get(url, headers={"Range": "bytes=0-9"})
+    assert result.status_code == 200
+    assert client.simulate_head(url).headers["Content-Length"] == str(len(data))
+
+
+def test_compressed_by_bucket(client):
+    archived = data.replace(b"log", b"archive")
+    url = upload(client, "archive", "application/octet-stream", archived)
+    result = client.simulate_get(url, headers={"Accept-Encoding": "xz"})
+    assert lzma.decompress(result.content) == archived
+    assert client.simulate_get(url, headers={"Accept-Encoding": "gzip"}).content == archived
+    # the bucket's policy wins over that of the mime type
+    raw = data.replace(b"log", b"raw")
+    url = upload(client, "raw", "text/plain", raw)
+    assert getsize(join(client.volume, md5(raw).hexdigest())) == len(raw)
+    assert client.simulate_get(url, headers={"Accept-Encoding": "gzip"}).content == raw
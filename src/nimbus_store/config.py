@@ -0,0 +1,52 @@
+import typing
+from .compression import check_policy
+from .ingest import DIGESTS
+from .layout import LAYOUTS
+
+
+class Config:
+    """ Tunables shared by every resource of the storage service """
+
+    def __init__(self, digest: str = "md5", buffer_size: int = 1 << 20, layout: str = "flat",
+                 upload_ttl: float = 86400, gc_interval: float = 300, gc_rate: float = 1000,
+                 pending_ttl: float = 7 * 86400, cache_size: int = 10000, cache_ttl: float = 5,
+                 compression: typing.Dict[str, str] = None, bucket_compression: typing.Dict[str, str] = None,
+                 pack_threshold: int = 0, segment_size: int = 64 << 20, compact_ratio: float = 0.5,
+                 commit_batch: int = 1, commit_interval: float = 0.002):
+        """ digest is the algorithm blobs are content-addressed by, one of DIGESTS. Clients must name uploads by a
+        checksum made with the same algorithm. buffer_size is the size of the reads used to ingest uploads. layout is
+        how new blobs are arranged in the volume, one of LAYOUTS. upload_ttl is how many seconds a multipart upload
+        can go without receiving a part before it is abandoned and its data deleted. gc_interval is how many seconds
+        apart the collector deletes unused blobs, or 0 to leave that to a separate process. gc_rate is the most
+        deletions it makes per second. pending_ttl is how many seconds a file can stay pending before it is deleted.
+        cache_size is how many buckets, and how many files, are cached for requests which read, and cache_ttl how many
+        seconds each is used for before being looked up again, or 0 to turn the cache off. compression maps mime type
+        patterns, e.g. text/*, to the encoding new blobs of those types are compressed with on disk, and
+        bucket_compression maps bucket names to the encoding of all their new blobs, overriding compression.
+        pack_threshold is the size in bytes up to which new blobs are appended to shared segment files rather than
+        stored in files of their own, or 0 to store every blob in its own file. Segments are filled up to about
+        segment_size bytes, and rewritten by the collector once compact_ratio of their bytes belong to deleted blobs.
+        commit_batch is how many concurrent writes of requests may be committed together, in one transaction, or 1 to
+        commit each on its own. Writes wait up to commit_interval seconds for others to join them """
+        if digest not in DIGESTS:
+            raise ValueError(f"digest must be one of {', '.join(DIGESTS)}")
+        if layout not in LAYOUTS:
+            raise ValueError(f"layout must be one of {', '.join(LAYOUTS)}")
+        self.digest = digest
+        self.buffer_size = buffer_size
+        self.layout = layout
+        self.upload_ttl = upload_ttl
+        self.gc_interval = gc_interval
+        self.gc_rate = gc_rate
+        self.pending_ttl = pending_ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.compression = compression or {}
+        self.bucket_compression = bucket_compression or {}
+        self.pack_threshold = pack_threshold
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.commit_batch = commit_batch
+        self.commit_interval = commit_interval
+        check_policy(self.compression)
+        check_policy(self.bucket_compression)
@@ -0,0 +1,103 @@
+import falcon
+import typing
+from uuid import uuid4
+from .buckets import find_bucket, validate_bucket
+from .files import validate_file
+from .models.bucket import Bucket
+from .models.file import File
+from .resource import ApiResource
+from .util import require
+
+
+# What a copy or move may change of a file, besides its bucket
+RENAMABLE = ("path", "name")
+
+
+def check_target(spec) -> typing.Dict[str, str]:
+    """ Checks the target of a copy or move, an object which may name a "bucket", "path" and "name" to give the file
+    in place of its current ones """
+    if not isinstance(spec, dict):
+        raise ValueError("A copy or move must be an object")
+    for key in ("bucket",) + RENAMABLE:
+        if key in spec and not isinstance(spec[key], str):
+            raise ValueError(f"{key} must be a string")
+    return spec
+
+
+def copy_file(resource: ApiResource, file: File, bucket: Bucket, spec: dict) -> str:
+    """ Inserts a copy of file into bucket, renamed as spec says, and returns its id. It shares file's blob, if it has
+    one, so no data is copied: the triggers on file count the copy's reference to it. Must be called in a write
+    transaction begun before file was looked up, so its blob can't be collected in between """
+    copy = File(**{**file.to_dict(), **{key: spec[key] for key in RENAMABLE if key in spec}})
+    copy.id.value = str(uuid4())
+    copy.bucket_id.value = bucket.id.value
+    extra = (copy.id, copy.bucket_id, copy.pending) + (() if copy.pending.value else (copy.local_file_id,))
+    resource._db.cursor().execute(*copy.insert_statement(*extra))
+    return copy.id.value
+
+
+def move_file(resource: ApiResource, file: File, bucket: Bucket, spec: dict) -> typing.Optional[str]:
+    """ Moves file into bucket, renamed as spec says, unless it was deleted or moved meanwhile. Its blob stays as it
+    is, and so does its count of references. Returns its id if it was moved, otherwise None """
+    renamed = {key: spec[key] for key in RENAMABLE if key in spec}
+    columns = [File.bucket_id.name] + [getattr(File, key).name for key in renamed]
+    r = resource._db.cursor().execute(
+        f"UPDATE [{File.table_name}] SET {', '.join(f'[{column}] = ?' for column in columns)} "
+        f"WHERE [{File.id.name}] = ? AND [{File.bucket_id.name}] = ?",
+        [bucket.id.value, *renamed.values(), file.id.value, file.bucket_id.value])
+    return file.id.value if r.rowcount == 1 else None
+
+
+def target_bucket(resource: ApiResource, bucket: Bucket, spec: dict) -> Bucket:
+    """ The bucket a copy or move goes to, by default the one the file is in """
+    return find_bucket(resource, spec["bucket"]) if "bucket" in spec else bucket
+
+
+class FileCopyResource(ApiResource):
+    """ Copies a file, to another bucket, path or name, without copying its data """
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        """ The body may name the "bucket", "path" and "name" of the copy, each by default that of the file. Responds
+        with the new file """
+        resp.status = falcon.HTTP_201
+        resp.media = self._copy(req.context.bucket, req.context.file, req.get_media(default_when_empty={}) or {})
+
+    def _copy(self, bucket: Bucket, file: File, spec) -> dict:
+        return self._transfer(bucket, file, spec, copy_file).to_dict()
+
+    def _transfer(self, bucket: Bucket, file: File, spec, transfer) -> File:
+        """ Does a copy or move of the file, in a transaction of its own. Returns the file as it is afterwards """
+        try:
+            spec = check_target(spec)
+        except ValueError as e:
+            raise falcon.HTTPBadRequest(title="Invalid target", description=str(e))
+        file, row = self._write(self._transfer_file, bucket, file, spec, transfer)
+        self._cache.files.invalidate(file.id.value)
+        return File.from_db_row(row)
+
+    def _transfer_file(self, bucket: Bucket, file: File, spec: dict, transfer):
+        # the file is looked up again in the write transaction, so its blob can't be collected before it is copied
+        row = self._db.cursor().execute(File.find_by_id_statement(), [file.id.value]).fetchone()
+        if row is None or File.from_db_row(row).bucket_id.value != bucket.id.value:
+            raise falcon.HTTPNotFound(description=f"No file with id '{file.id.value}' found")
+        file = File.from_db_row(row)
+        id = transfer(self, file, target_bucket(self, bucket, spec), spec)
+        return file, self._db.cursor().execute(File.find_by_id_statement(), [id]).fetchone()
+
+
+class FileMoveResource(FileCopyResource):
+    """ Moves a file to another bucket, path or name, keeping its id and data """
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        """ The body may name the "bucket", "path" and "name" to move the file to, each by default its current one.
+        Responds with the moved file """
+        resp.media = self._move(req.context.bucket, req.context.file, req.get_media(default_when_empty={}) or {})
+
+    def _move(self, bucket: Bucket, file: File, spec) -> dict:
+        return self._transfer(bucket, file, spec, move_file).to_dict()
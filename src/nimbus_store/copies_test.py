@@ -0,0 +1,73 @@
+import json
+from hashlib import md5
+from os.path import exists, join
+from .collector import Collector
+from .test import client, headers_json, headers_binary, pool, tempd
+
+
+def create(client, bucket: str, name: str, data: bytes = None) -> str:
+    file = {"name": name, "mime": "text/plain", "path": "staging"}
+    id = client.simulate_post(f"/buckets/{bucket}/files", body=json.dumps(file), headers=headers_json).json["id"]
+    if data is not None:
+        client.simulate_post(f"/buckets/{bucket}/files/{id}/data/{md5(data).hexdigest()}", body=data,
+                             headers=headers_binary)
+    return id
+
+
+def test_copy_and_move(client):
+    for bucket in ("staging", "production"):
+        client.simulate_post("/buckets", body=json.dumps({"name": bucket, "desc": ""}), headers=headers_json)
+    data = b"published asset"
+    digest = md5(data).hexdigest()
+    id = create(client, "staging", "asset.txt", data)
+
+    result = client.simulate_post(f"/buckets/staging/files/{id}/copy", headers=headers_json,
+                                  body=json.dumps({"bucket": "production", "path": "live"}))
+    assert result.status_code == 201
+    copy = result.json
+    assert copy["id"] != id and copy["path"] == "live" and copy["name"] == "asset.txt"
+    assert copy["local_file_id"] == digest
+    assert client.simulate_get(f"/buckets/production/files/{copy['id']}/data/{digest}").content == data
+
+    result = client.simulate_post(f"/buckets/production/files/{copy['id']}/move", headers=headers_json,
+                                  body=json.dumps({"name": "renamed.txt"}))
+    assert result.status_code == 200
+    assert result.json["id"] == copy["id"] and result.json["name"] == "renamed.txt"
+    result = client.simulate_post(f"/buckets/staging/files/{copy['id']}/move", body=json.dumps({}),
+                                  headers=headers_json)
+    assert result.status_code == 404
+    result = client.simulate_post(f"/buckets/staging/files/{id}/copy", body=json.dumps({"bucket": "missing"}),
+                                  headers=headers_json)
+    assert result.status_code == 404
+
+    # the blob is kept while either file uses it
+    client.simulate_delete(f"/buckets/staging/files/{id}", headers=headers_json)
+    Collector(pool, tempd).run()
+    assert exists(join(tempd, digest))
+    assert client.simulate_get(f"/buckets/production/files/{copy['id']}/data/{digest}").content == data
+    client.simulate_delete(f"/buckets/production/files/{copy['id']}", headers=headers_json)
+    Collector(pool, tempd).run()
+    assert not exists(join(tempd, digest))
+
+
+def test_batch_copy_and_move(client):
+    data = b"bulk asset"
+    ids = [create(client, "staging", f"{i}.txt", data) for i in range(3)]
+    pending = create(client, "staging", "pending.txt")
+    body = {
+        "copy": [{"id": id, "bucket": "production"} for id in ids + [pending]] + [{"id": "missing"}, ["bad"]],
+        "move": [{"id": ids[0], "path": "archive"}, {"id": ids[1], "bucket": "missing"}],
+    }
+    result = client.simulate_post("/buckets/staging/batch", body=json.dumps(body), headers=headers_json)
+    assert result.status_code == 200
+    copies, moves = result.json["copy"], result.json["move"]
+    assert [each["status"] for each in copies] == [201, 201, 201, 201, 404, 400]
+    assert [each["file"]["local_file_id"] for each in copies[:3]] == [md5(data).hexdigest()] * 3
+    assert copies[3]["file"]["pending"]
+    assert pool.connection().execute("SELECT local_file_id FROM file WHERE id = ?", [copies[3]["file"]["id"]]
+                                     ).fetchone() == (None,)
+    assert [each["status"] for each in moves] == [200, 404]
+    assert moves[0]["file"]["path"] == "archive"
+    assert client.simulate_get(f"/buckets/staging/files/{ids[0]}", headers=headers_json).json["path"] == "archive"
+    refs = pool.connection().execute("SELECT refs FROM local_file WHERE id = ?", [md5(data).hexdigest()]).fetchone()
+    assert refs == (6,)
@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+import time
+from .metrics import metrics, statement_label
+
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+class TimedCursor(sqlite3.Cursor):
+    """ A cursor recording how long each statement takes to execute in the process's metrics """
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe("nimbus_sql_duration_seconds", time.perf_counter() - start,
+                            (("statement", statement_label(sql)),))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe("nimbus_sql_duration_seconds", time.perf_counter() - start,
+                            (("statement", statement_label(sql)),))
+
+
+class TimedConnection(sqlite3.Connection):
+    """ A connection whose cursors, and commits, are timed """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            metrics.observe("nimbus_db_commit_duration_seconds", time.perf_counter() - start)
+
+
+class ConnectionPool:
+    """ Provides each thread with its own connection to a sqlite database, so requests on different threads never
+    share a connection. Connections use WAL journaling, which lets any number of readers run alongside the single
+    writer, and keep a cache of prepared statements which is reused across requests on the same thread """
+
+    def __init__(self, path: str, synchronous: str = "NORMAL", cache_size: int = -16000, mmap_size: int = 0,
+                 cached_statements: int = 256, timeout: float = 5.0, timed: bool = True):
+        """ synchronous, cache_size and mmap_size are passed through to the sqlite PRAGMAs of the same name. NORMAL
+        is durable across application crashes in WAL mode, and only syncs the WAL on checkpoints. A negative
+        cache_size is in KiB rather than pages. timeout is how long a writer waits on a locked database. timed
+        connections record how long statements and commits take in the process's metrics """
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"synchronous must be one of {', '.join(SYNCHRONOUS_MODES)}")
+        self._path = path
+        self._synchronous = synchronous.upper()
+        self._cache_size = int(cache_size)
+        self._mmap_size = int(mmap_size)
+        self._cached_statements = cached_statements
+        self._timeout = timeout
+        self._timed = timed
+        self._local = threading.local()
+
+    @property
+    def path(self):
+        return self._path
+
+    def connect(self) -> sqlite3.Connection:
+        """ Opens a new, configured connection to the database. Prefer connection() """
+        conn = sqlite3.connect(self._path, timeout=self._timeout, cached_statements=self._cached_statements,
+                               factory=TimedConnection if self._timed else sqlite3.Connection)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self._synchronous}")
+        conn.execute(f"PRAGMA cache_size={self._cache_size}")
+        conn.execute(f"PRAGMA mmap_size={self._mmap_size}")
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """ The calling thread's connection, opened on first use """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """ Closes the calling thread's connection, if it has one """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
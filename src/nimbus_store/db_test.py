@@ -0,0 +1,26 @@
+import threading
+from os.path import join
+from tempfile import mkdtemp
+from .db import ConnectionPool
+
+
+def test_connection_per_thread():
+    pool = ConnectionPool(join(mkdtemp(), "db.sqlite"))
+    conn = pool.connection()
+    assert pool.connection() is conn
+    other = []
+    t = threading.Thread(target=lambda: other.append(pool.connection()))
+    t.start()
+    t.join()
+    assert other[0] is not conn
+
+
+def test_connection_pragmas():
+    pool = ConnectionPool(join(mkdtemp(), "db.sqlite"), synchronous="full", cache_size=-2000, mmap_size=1 << 20)
+    conn = pool.connection()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+    assert conn.execute("PRAGMA cache_size").fetchone()[0] == -2000
+    assert conn.execute("PRAGMA mmap_size").fetchone()[0] == 1 << 20
+    pool.close()
+    assert pool.connection() is not conn
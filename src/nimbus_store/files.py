@@ -1,28 +1,104 @@
 import falcon
+from .models.bucket import Bucket
 from .models.file import File
-from .models.local_file import LocalFile
 from .buckets import validate_bucket
-from .util import require
+from .cache import READ_METHODS
+from .util import require, page_params
 from .resource import ApiResource
+from functools import lru_cache
+from heapq import merge
+from inspect import iscoroutinefunction
+from itertools import islice
 import sqlite3
+import typing
 from uuid import uuid4
-from os import remove
-from os.path import join
+
+
+# The separator of folders in file paths. A file's key is its path and name joined by it, or just its name if its path
+# is empty. Folders are ranged over by their path with a trailing DELIMITER, which sorts every folder's subfolders
+# right after it and in the order of their keys, and is indexed by FileBucketFolder
+DELIMITER = "/"
+FOLDER = f"[{File.path.name}] || '{DELIMITER}'"
+
+
+def find_file(resource: ApiResource, id: str) -> File:
+    cache = resource._cache.files
+    generation = cache.generation
+    cursor = resource._db.cursor()
+    stmt = cursor.execute(File.find_statement(File.id), [id])
+    row = stmt.fetchone()
+    if row is None:
+        raise falcon.HTTPNotFound(description=f"No file with id '{id}' found")
+    cache.put(id, row, generation)
+    return File.from_db_row(row)
+
+
+def cached_file(resource: ApiResource, req: falcon.Request, id: str) -> typing.Optional[File]:
+    """ The file with the given id from the cache, if it is there and the request only reads """
+    if req.method not in READ_METHODS:
+        return None
+    resource._cache.sync(resource._db)
+    row = resource._cache.files.get(id)
+    return None if row is None else File.from_db_row(row)
 
 
 def validate_file(next):
+    if iscoroutinefunction(next):
+        async def f(self, req: falcon.Request, resp: falcon.Response, file: str, **kwargs):
+            req.context.file = cached_file(self, req, file) or await self._run(find_file, self, file)
+            await next(self, req, resp, **kwargs)
+        return f
+
     def f(self, req: falcon.Request, resp: falcon.Response, file: str, **kwargs):
-        cursor = self._db.cursor()
-        stmt = cursor.execute(File.find_statement(File.id), [file])
-        row = stmt.fetchone()
-        if row is None:
-            raise falcon.HTTPNotFound(description=f"No file with id '{id}' found")
-        file = File.from_db_row(row)
-        req.context.file = file
+        req.context.file = cached_file(self, req, file) or find_file(self, file)
         next(self, req, resp, **kwargs)
     return f
 
 
+def successor(prefix: str) -> typing.Optional[str]:
+    """ The least string greater than every string starting with prefix, or None if there is none """
+    while prefix:
+        last = ord(prefix[-1]) + 1
+        if last <= 0x10FFFF:
+            return prefix[:-1] + chr(0xE000 if 0xD800 <= last < 0xE000 else last)  # UTF-8 has no surrogates
+        prefix = prefix[:-1]
+    return None
+
+
+@lru_cache(maxsize=None)
+def children_statement(inclusive: bool, bounded: bool) -> str:
+    """ Selects the files directly in a folder ordered by name. Parameters are, in order: the bucket id, the folder's
+    path with a trailing DELIMITER, the name to start at (if inclusive) or after, the name to stop before (if bounded)
+    and the maximum number of files """
+    where = [f"[{File.bucket_id.name}] = ?", f"{FOLDER} = ?", f"[{File.name.name}] {'>=' if inclusive else '>'} ?"]
+    if bounded:
+        where.append(f"[{File.name.name}] < ?")
+    return f"SELECT {File.select_columns()} FROM [{File.table_name}] WHERE {' AND '.join(where)} " \
+           f"ORDER BY [{File.name.name}] LIMIT ?"
+
+
+@lru_cache(maxsize=None)
+def next_folder_statement(inclusive: bool, bounded: bool) -> str:
+    """ Selects the first folder path, with a trailing DELIMITER, in a range, which is a single index seek however many
+    files there are. Parameters are, in order: the bucket id, the folder to start at (if inclusive) or after and the
+    folder to stop before (if bounded) """
+    where = [f"[{File.bucket_id.name}] = ?", f"{FOLDER} {'>=' if inclusive else '>'} ?"]
+    if bounded:
+        where.append(f"{FOLDER} < ?")
+    return f"SELECT {FOLDER} FROM [{File.table_name}] WHERE {' AND '.join(where)} ORDER BY {FOLDER} LIMIT 1"
+
+
+def browse_params(req: falcon.Request) -> typing.Tuple[str, typing.Optional[str], int]:
+    """ Reads the ?prefix=, ?after= and ?limit= parameters of a listing by delimiter. Returns (prefix, after, limit) """
+    if req.get_param("delimiter") != DELIMITER:
+        raise falcon.HTTPBadRequest(title="Invalid delimiter",
+                                    description=f"Listings by prefix must have delimiter '{DELIMITER}'")
+    limit, after, stream = page_params(req)
+    if stream is not None:
+        raise falcon.HTTPBadRequest(title="Invalid stream format", description="Listings by prefix can't be streamed")
+    return req.get_param("prefix", default=""), after, limit
+
+
 class FilesResource(ApiResource):
     """ Manages getting, deleting and updating single File resources """
 
@@ -36,29 +112,18 @@ class FilesResource(ApiResource):
     @validate_bucket
     @validate_file
     def on_delete(self, req: falcon.Request, resp: falcon.Response):
-        stmt = File.delete_statement(req.context.file.id)
-        cursor = self._db.cursor()
-        r = cursor.execute(stmt, [req.context.file.id.value])
-        if r.rowcount != 1:
-            self._db.rollback()
-            resp.status = falcon.HTTP_CONFLICT
-            resp.error = {"message": f"{r.rowcount} rows affected upon DELETE execution"}
-        # If this was the only File associated with the related LocalFile, delete that LocalFile
-        self.garbage_collect(req.context.file.local_file_id.value)
-        self._db.commit()
+        self._delete_file(req.context.file)
         resp.status = falcon.HTTP_NO_CONTENT
 
-    def garbage_collect(self, local_file_id):
-        """ A File's data is only deleted if it is the only/last file referencing it when deleted. If it is, delete the
-         local file data from the store """
-        cursor = self._db.cursor()
-        stmt = File.find_statement(File.local_file_id)
-        r = cursor.execute(stmt, [local_file_id])
-        if r.fetchone() is None:  # There are no other Files associated with this LocalFile, so delete the data on disk
-            stmt = LocalFile.delete_statement(LocalFile.id)
-            cursor.execute(stmt, [local_file_id])
-            remove(join(self._root, local_file_id))
-            self._db.commit()
+    def _delete_file(self, file: File):
+        self._write(self._delete_file_row, file)
+        self._cache.files.invalidate(file.id.value)
+
+    def _delete_file_row(self, file: File):
+        r = self._db.cursor().execute(File.delete_statement(File.id), [file.id.value])
+        if r.rowcount != 1:
+            raise falcon.HTTPConflict(description=f"{r.rowcount} rows affected upon DELETE execution")
+        # the triggers on file drop the blob's refs count, and the collector deletes it once no file uses it
 
 
 class FileCollectionResource(ApiResource):
@@ -73,30 +138,82 @@ class FileCollectionResource(ApiResource):
     @require("application/json")
     @validate_bucket
     def on_get(self, req: falcon.Request, resp: falcon.Response):
-        """ Handles requests to list all files in a given bucket """
+        """ Handles requests to list the files in a given bucket, a page at a time or streamed, or with ?delimiter=
+        those in one folder """
+        if req.get_param("delimiter") is None and req.get_param("prefix") is None:
+            self._list(req, resp, File, File.id, File.bucket_id, req.context.bucket.id.value)
+            return
+        self._browsed(resp, *self._browse(req.context.bucket.id.value, *browse_params(req)))
+
+    def _browse(self, bucket_id: int, prefix: str, after: typing.Optional[str], limit: int):
+        """ Lists what is directly under prefix, like an S3 listing with delimiter "/": the files whose key starts with
+        prefix and has no DELIMITER after it, and the distinct common prefixes, ending in DELIMITER, of the keys which
+        do. Both are listed together in key order, up to limit of them after the key after. Returns the files as
+        dicts, the common prefixes, and the cursor of the next page or None if this is the last """
+        end = successor(prefix)
+        if after is not None and after < prefix:
+            after = None
+        if after is not None and end is not None and after >= end:
+            return [], [], None
+        base = prefix[:prefix.rfind(DELIMITER) + 1]
+        files = ((base + file["name"], file) for file in self._children(bucket_id, base, prefix, after, limit + 1))
+        folders = ((folder, None) for folder in self._folders(bucket_id, base, prefix, end, after))
+        entries = list(islice(merge(files, folders, key=lambda entry: entry[0]), limit + 1))
+        next = entries[limit - 1][0] if len(entries) > limit else None
+        entries = entries[:limit]
+        return [file for _, file in entries if file is not None], [key for key, file in entries if file is None], next
+
+    def _children(self, bucket_id: int, base: str, prefix: str, after: typing.Optional[str], limit: int):
+        if base == DELIMITER:
+            return []  # no key is a name with a leading DELIMITER, as a file with an empty path has no folder
+        start, end = prefix[len(base):], successor(prefix[len(base):])
+        inclusive = after is None or after[len(base):] < start
+        if not inclusive:
+            start = after[len(base):]
+        params = [bucket_id, base or DELIMITER, start] + ([end] if end is not None else []) + [limit]
+        rows = self._db.cursor().execute(children_statement(inclusive, end is not None), params)
+        return [File.dict_from_db_row(row) for row in rows]
+
+    def _folders(self, bucket_id: int, base: str, prefix: str, end: typing.Optional[str],
+                 after: typing.Optional[str]) -> typing.Iterator[str]:
+        """ The common prefixes of the folders under prefix in order, seeking from one to the next in the index """
         cursor = self._db.cursor()
-        stmt = File.find_statement(File.bucket_id)
-        rows = cursor.execute(stmt, [req.context.bucket.id.value])
-        files = []
-        for row in rows.fetchall():
-            files.append(File.from_db_row(row).to_dict())
-        resp.media = files
+        start, inclusive = prefix, True
+        if after is not None:
+            start, inclusive = (successor(after), True) if after.endswith(DELIMITER) else (after, False)
+        while True:
+            params = [bucket_id, start] + ([end] if end is not None else [])
+            row = cursor.execute(next_folder_statement(inclusive, end is not None), params).fetchone()
+            if row is None:
+                return
+            if row[0] in (base, DELIMITER):  # of the files listed as children, or with an empty path
+                start, inclusive = row[0], False
+                continue
+            folder = base + row[0][len(base):].split(DELIMITER, 1)[0] + DELIMITER
+            start, inclusive = successor(folder), True
+            if after is None or folder > after:
+                yield folder
 
-    @require("application/json")
-    @validate_bucket
-    def on_post(self, req: falcon.Request, resp: falcon.Response):
-        """ Handles Requests to create new files """
-        file = File.from_dict(req.media)
-        file.bucket_id.value = req.context.bucket.id.value
+    def _browsed(self, resp: falcon.Response, files: typing.List[dict], prefixes: typing.List[str],
+                 next: typing.Optional[str]):
+        if next is not None:
+            resp.set_header("X-Next-Cursor", next)
+        resp.media = {"files": files, "prefixes": prefixes}
+
+    def _create_file(self, bucket: Bucket, file: File) -> File:
+        file.bucket_id.value = bucket.id.value
         file.id.value = str(uuid4())
-        cursor = self._db.cursor()
         stmt, params = file.insert_statement(file.id, file.bucket_id)
         try:
-            cursor.execute(stmt, params)
-            self._db.commit()
-            file = self._get_file(file.id.value)
+            self._write(self._execute, stmt, params)
+            return self._get_file(file.id.value)
         except sqlite3.Error as e:
-            raise falcon.HTTPBadRequest("Invalid value for file", str(e))
+            raise falcon.HTTPBadRequest(title="Invalid value for file", description=str(e))
+
+    @require("application/json")
+    @validate_bucket
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        """ Handles Requests to create new files """
+        file = self._create_file(req.context.bucket, File.from_dict(req.media))
         resp.status = falcon.HTTP_201
         resp.media = file.to_dict()
-
@@ -0,0 +1,76 @@
+import json
+import pytest
+from falcon import testing
+from .files import successor
+from .test import app, headers_json
+
+
+paths = ["", "", "logs", "logs", "logs-old", "logs/2020", "logs/2020", "logs/2021/01", "logs.d", "lo", "m/n", "m"]
+
+
+def key(file: dict) -> str:
+    return f"{file['path']}/{file['name']}" if file["path"] else file["name"]
+
+
+@pytest.fixture(scope="module")
+def client():
+    return testing.TestClient(app)
+
+
+@pytest.fixture(scope="module")
+def keys(client):
+    client.simulate_post("/buckets", body=json.dumps({"name": "folders", "desc": ""}), headers=headers_json)
+    keys = []
+    for i, path in enumerate(paths):
+        file = {"name": f"f{i % 3}{'.txt' if i % 2 else ''}", "mime": "text/plain", "path": path}
+        result = client.simulate_post("/buckets/folders/files", body=json.dumps(file), headers=headers_json)
+        keys.append(key(result.json))
+    return keys
+
+
+def expected(keys, prefix: str):
+    """ What an S3 listing with delimiter "/" returns, worked out from every key """
+    entries = set()
+    for each in keys:
+        if each.startswith(prefix):
+            rest = each[len(prefix):]
+            entries.add(prefix + rest.split("/", 1)[0] + "/" if "/" in rest else each)
+    return sorted(entries)
+
+
+def browse(client, prefix: str, limit: int):
+    entries, after = [], None
+    while True:
+        params = {"prefix": prefix, "delimiter": "/", "limit": limit}
+        if after is not None:
+            params["after"] = after
+        result = client.simulate_get("/buckets/folders/files", params=params, headers=headers_json)
+        assert result.status_code == 200
+        page = [key(file) for file in result.json["files"]] + result.json["prefixes"]
+        assert len(page) <= limit
+        entries += sorted(page)
+        after = result.headers.get("X-Next-Cursor")
+        if after is None:
+            return entries
+
+
+@pytest.mark.parametrize("prefix", ["", "l", "lo", "logs", "logs/", "logs/2", "logs/2021/", "m", "m/", "x", "/"])
+def test_browse(client, keys, prefix):
+    for limit in (1, 2, 1000):
+        assert browse(client, prefix, limit) == expected(keys, prefix)
+
+
+def test_browse_params(client, keys):
+    result = client.simulate_get("/buckets/folders/files", params={"prefix": "logs/", "delimiter": "|"},
+                                 headers=headers_json)
+    assert result.status_code == 400
+    result = client.simulate_get("/buckets/folders/files", params={"delimiter": "/", "stream": "json"},
+                                 headers=headers_json)
+    assert result.status_code == 400
+
+
+def test_successor():
+    assert successor("ab/") == "ab0"
+    assert successor("a\U0010ffff") == "b"
+    assert successor("a퟿") == "a"
+    assert successor("") is None
@@ -0,0 +1,296 @@
+import errno
+import fcntl
+import json
+import mimetypes
+import os
+import sqlite3
+import time
+import typing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from os.path import abspath, dirname, exists, join
+from uuid import uuid4
+from .compression import IDENTITY
+from .config import Config
+from .files import DELIMITER, FOLDER
+from .ingest import DIGESTS, fsync, fsync_dir
+from .layout import blob_path
+from .models.bucket import Bucket
+from .models.file import File
+from .models.local_file import LocalFile
+from .volumes import Volumes, copy_blob
+
+
+# The most checksums looked up per SELECT. Older versions of sqlite allow at most 999 parameters per statement
+LOOKUP_SIZE = 500
+# The mime type of files mimetypes can't guess one for
+DEFAULT_MIME = "application/octet-stream"
+# Whether a bucket has a file at a path with a name
+FILE_EXISTS = f"SELECT 1 FROM [{File.table_name}] WHERE [{File.bucket_id.name}] = ? AND {FOLDER} = ? AND " \
+              f"[{File.name.name}] = ?"
+
+Parts = typing.Tuple[str, ...]
+
+
+def walk(root: str, after: Parts = (), parts: Parts = ()) -> typing.Iterator[Parts]:
+    """ The paths of the regular files under root after the given one, split into their parts and in order """
+    with os.scandir(join(root, *parts)) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        path = parts + (entry.name,)
+        if path < after[:len(path)]:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk(root, after, path)
+        elif entry.is_file(follow_symlinks=False) and path > after:
+            yield path
+
+
+def hash_file(digest: str, buffer_size: int, fname: str) -> typing.Optional[typing.Tuple[str, int]]:
+    """ The checksum and size of a file, or None if it is gone. Run in the worker processes """
+    hash = DIGESTS[digest]()
+    size = 0
+    try:
+        with open(fname, "rb", buffering=0) as f:
+            for chunk in iter(partial(f.read, buffer_size), b""):
+                hash.update(chunk)
+                size += len(chunk)
+    except FileNotFoundError:
+        return None
+    return hash.hexdigest(), size
+
+
+def store_blob(fname: str, root: str, path: str, link: bool):
+    """ Stores a file as the blob at path in the volume at root, unless it is already there. Run in the worker
+    processes """
+    dest = join(root, path)
+    if exists(dest):
+        return
+    if link:
+        os.makedirs(dirname(dest), exist_ok=True)
+        try:
+            os.link(fname, dest)
+            fsync_dir(dirname(dest))
+            return
+        except FileExistsError:
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    copy_blob(fname, root, path)
+
+
+def read_checkpoint(fname: str) -> typing.Optional[dict]:
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(fname: str, state: dict):
+    """ Replaces the checkpoint with state, such that it is never seen half written """
+    tmp = f"{fname}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+        f.flush()
+        fsync(f.fileno())
+    os.replace(tmp, fname)
+    fsync_dir(dirname(abspath(fname)))
+
+
+def import_bucket(db: sqlite3.Connection, name: str) -> int:
+    """ The id of the bucket with the given name, which is created if there is none """
+    cursor = db.cursor()
+    row = cursor.execute(Bucket.find_statement(Bucket.name), [name]).fetchone()
+    if row is None:
+        cursor.execute(*Bucket(name=name, desc="").insert_statement())
+        db.commit()
+        row = cursor.execute(Bucket.find_statement(Bucket.name), [name]).fetchone()
+    return Bucket.from_db_row(row).id.value
+
+
+def bulk_import(db: sqlite3.Connection, volumes: typing.Union[str, Volumes], config: Config, source: str,
+                bucket: str, prefix: str = "", link: bool = False, workers: int = None, batch_size: int = 10000,
+                checkpoint: str = None, progress=print) -> typing.Dict[str, int]:
+    """ Imports every file under source into the bucket, under prefix, batch_size files per transaction, resuming
+    after the checkpoint if one is given. Returns counts of what was imported """
+    volumes = Volumes.of(volumes)
+    workers = workers or os.cpu_count() or 1
+    prefix = prefix.strip(DELIMITER)
+    state = {"source": abspath(source), "bucket": bucket, "prefix": prefix, "after": []}
+    saved = read_checkpoint(checkpoint) if checkpoint else None
+    if saved is not None:
+        if {key: saved.get(key) for key in ("source", "bucket", "prefix")} != \
+                {key: state[key] for key in ("source", "bucket", "prefix")}:
+            raise ValueError(f"the checkpoint {checkpoint} is of another import")
+        state["after"] = saved["after"]
+    bucket_id = import_bucket(db, bucket)
+    stats = Counter()
+    start = time.monotonic()
+    files = walk(source, tuple(state["after"]))
+    # the batch after a checkpoint may have been committed before the checkpoint was saved
+    resumed = bool(state["after"])
+    with open(join(volumes.primary.root, ".collector.lock"), "a") as lock, ProcessPoolExecutor(workers) as executor:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        while True:
+            batch = list(islice(files, batch_size))
+            if not batch:
+                return dict(stats)
+            chunksize = max(1, len(batch) // (4 * workers))
+            _import_batch(db, volumes, config, partial(executor.map, chunksize=chunksize), source, bucket_id, prefix,
+                          link, batch, resumed, stats)
+            resumed = False
+            state["after"] = list(batch[-1])
+            if checkpoint:
+                write_checkpoint(checkpoint, state)
+            progress(f"Imported {stats['files']} files, {stats['blobs']} new blobs of {stats['bytes'] >> 20} MiB, "
+                     f"{stats['files'] / max(time.monotonic() - start, 1e-9):.0f} files/s")
+
+
+def _import_batch(db: sqlite3.Connection, volumes: Volumes, config: Config, pool_map, source: str, bucket_id: int,
+                  prefix: str, link: bool, batch: typing.List[Parts], resumed: bool, stats: Counter):
+    """ Imports a batch of files, hashing and storing them with pool_map, which maps functions over the workers """
+    keys = []
+    for parts in batch:
+        key = (DELIMITER.join(filter(None, (prefix,) + parts[:-1])), parts[-1])
+        try:
+            DELIMITER.join(key).encode()
+        except UnicodeEncodeError:
+            key = None
+        keys.append(key)
+    fnames = [join(source, *parts) for parts in batch]
+    found = []
+    hashes = pool_map(partial(hash_file, config.digest, config.buffer_size), fnames)
+    for key, fname, hashed in zip(keys, fnames, hashes):
+        if key is not None and hashed is not None:
+            found.append((key, fname) + hashed)
+    stats["skipped"] += len(batch) - len(found)
+    known = _recorded(db, list({checksum for _, _, checksum, _ in found}))
+    new = {}
+    for _, fname, checksum, size in found:
+        if checksum not in known and checksum not in new:
+            new[checksum] = (fname, size, volumes.place(checksum))
+    stored = [(fname, volume.root, blob_path(config.layout, checksum), link)
+              for checksum, (fname, size, volume) in new.items()]
+    if stored:
+        list(pool_map(store_blob, *zip(*stored)))
+    cursor = db.cursor()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if new:
+            stmt, _ = LocalFile().insert_statement(LocalFile.id, LocalFile.path, LocalFile.encoding, LocalFile.size,
+                                                   LocalFile.volume, ignore=True)
+            cursor.executemany(stmt, [[checksum, blob_path(config.layout, checksum), IDENTITY, size, volume.id]
+                                      for checksum, (fname, size, volume) in new.items()])
+        if resumed:
+            found = [each for each in found if not _exists(cursor, bucket_id, *each[0])]
+        stmt, _ = File().insert_statement(File.id, File.bucket_id, File.pending, File.local_file_id)
+        cursor.executemany(stmt, [[name, mimetypes.guess_type(name)[0] or DEFAULT_MIME, path, str(uuid4()), bucket_id,
+                                   False, checksum] for (path, name), fname, checksum, size in found])
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    stats["files"] += len(found)
+    stats["blobs"] += len(new)
+    stats["bytes"] += sum(size for fname, size, volume in new.values())
+
+
+def _recorded(db: sqlite3.Connection, checksums: typing.List[str]) -> typing.Set[str]:
+    """ Which of the checksums already have a local_file """
+    cursor = db.cursor()
+    recorded = set()
+    for i in range(0, len(checksums), LOOKUP_SIZE):
+        chunk = checksums[i:i + LOOKUP_SIZE]
+        recorded.update(id for id, in cursor.execute(
+            f"SELECT [{LocalFile.id.name}] FROM [{LocalFile.table_name}] "
+            f"WHERE [{LocalFile.id.name}] IN ({','.join('?' * len(chunk))})", chunk))
+    return recorded
+
+
+def _exists(cursor: sqlite3.Cursor, bucket_id: int, path: str, name: str) -> bool:
+    row = cursor.execute(FILE_EXISTS, [bucket_id, path + DELIMITER, name]).fetchone()
+    return row is not None
+
+
+if __name__ == "__main__":
+    import argparse
+    from .db import ConnectionPool
+    from .layout import LAYOUTS
+    from .volumes import Volume, parse_volume
+    parser = argparse.ArgumentParser(
+        description="Imports a directory tree into a bucket, hashing and storing files in parallel and recording "
+                    "them in large transactions, far faster than uploading each file. Interrupted imports resume from "
+                    "their checkpoint when run again with the same arguments"
+    )
+    parser.add_argument(
+        "db",
+        help="the path to the local instance of the database file"
+    )
+    parser.add_argument(
+        "source",
+        help="the directory whose files are imported"
+    )
+    parser.add_argument(
+        "volumes",
+        help="the volumes of the node, the primary first, as PATH[=WEIGHT]",
+        metavar="PATH[=WEIGHT]",
+        nargs="+"
+    )
+    parser.add_argument(
+        "--bucket",
+        help="the bucket files are imported into, created if need be",
+        required=True
+    )
+    parser.add_argument(
+        "--prefix",
+        help="the folder files are imported under, by default the bucket's root",
+        default=""
+    )
+    parser.add_argument(
+        "--link",
+        help="hard link files into the volumes rather than copying them, where they are on the same filesystem. The "
+             "source files must then never be changed in place",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--workers",
+        help="the number of processes hashing and storing files",
+        type=int,
+        default=os.cpu_count() or 1
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="the number of files imported per transaction",
+        type=int,
+        default=10000
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="the file the progress of the import is saved to, by default next to the database",
+    )
+    parser.add_argument(
+        "--digest",
+        help="the algorithm blobs are content-addressed by, which must be the server's",
+        choices=tuple(DIGESTS),
+        default="md5"
+    )
+    parser.add_argument(
+        "--layout",
+        help="how new blobs are arranged in the volumes, which should be the server's",
+        choices=LAYOUTS,
+        default="flat"
+    )
+    args = parser.parse_args()
+    volumes = Volumes([Volume(root, weight) for root, weight in map(parse_volume, args.volumes)])
+    try:
+        counts = bulk_import(ConnectionPool(args.db).connection(), volumes,
+                             Config(digest=args.digest, layout=args.layout), args.source, args.bucket, args.prefix,
+                             args.link, args.workers, args.batch_size, args.checkpoint or f"{args.db}.import.json")
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Done, imported {counts.get('files', 0)} files, stored {counts.get('blobs', 0)} new blobs and skipped "
+          f"{counts.get('skipped', 0)} files")
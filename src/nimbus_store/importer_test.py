@@ -0,0 +1,86 @@
+import json
+import os
+import pytest
+from falcon import testing
+from hashlib import md5
+from os.path import dirname, join
+from tempfile import mkdtemp
+from . import API
+from .config import Config
+from .importer import bulk_import, walk, write_checkpoint
+from .models.local_file import LocalFile
+from .test import headers_json, migrated_pool
+
+
+TREE = {
+    ("a.txt",): b"shared",
+    ("docs", "b.md"): b"readme",
+    ("docs", "deep", "c.txt"): b"shared",
+    ("docs", "deep", "d.bin"): b"",
+    ("z.json",): b"{}",
+}
+
+
+def make_tree() -> str:
+    source = mkdtemp()
+    for parts, data in TREE.items():
+        os.makedirs(join(source, *parts[:-1]), exist_ok=True)
+        with open(join(source, *parts), "wb") as f:
+            f.write(data)
+    return source
+
+
+def test_walk():
+    source = make_tree()
+    assert list(walk(source)) == sorted(TREE)
+    assert list(walk(source, ("docs", "deep", "c.txt"))) == [("docs", "deep", "d.bin"), ("z.json",)]
+    assert list(walk(source, ("docs", "e"))) == [("z.json",)]
+
+
+def test_resumed_import():
+    pool = migrated_pool()
+    volume, source = mkdtemp(), make_tree()
+    checkpoint = join(mkdtemp(), "import.json")
+
+    def interrupt(message):
+        raise KeyboardInterrupt(message)
+    with pytest.raises(KeyboardInterrupt):
+        bulk_import(pool.connection(), volume, Config(), source, "imported", "seed", workers=2, batch_size=2,
+                    checkpoint=checkpoint, progress=interrupt)
+    counts = bulk_import(pool.connection(), volume, Config(), source, "imported", "seed", workers=2, batch_size=2,
+                         checkpoint=checkpoint, progress=lambda message: None)
+    assert counts["files"] == 3 and counts["blobs"] == 2  # the first batch, and its "shared" blob, were imported
+    with pytest.raises(ValueError):
+        bulk_import(pool.connection(), volume, Config(), source, "other", checkpoint=checkpoint)
+    # as if the last batch was committed, but the import stopped before saving the checkpoint after it
+    with open(checkpoint) as f:
+        state = json.load(f)
+    write_checkpoint(checkpoint, {**state, "after": ["docs", "deep", "c.txt"]})
+    counts = bulk_import(pool.connection(), volume, Config(), source, "imported", "seed", workers=2, batch_size=2,
+                         checkpoint=checkpoint, progress=lambda message: None)
+    assert counts["files"] == 0
+
+    client = testing.TestClient(API(pool, volume))
+    files = client.simulate_get("/buckets/imported/files", headers=headers_json).json
+    assert sorted((file["path"], file["name"]) for file in files) == \
+        sorted(("/".join(("seed",) + parts[:-1]), parts[-1]) for parts in TREE)
+    for file in files:
+        data = TREE[tuple(file["path"].split("/")[1:]) + (file["name"],)]
+        assert file["local_file_id"] == md5(data).hexdigest() and not file["pending"]
+        assert client.simulate_get(f"/buckets/imported/files/{file['id']}/data/{md5(data).hexdigest()}").content == data
+    assert {file["mime"] for file in files if file["name"] == "b.md"} == {"text/markdown"}
+    row = pool.connection().execute(f"SELECT [{LocalFile.refs.name}] FROM [{LocalFile.table_name}] WHERE "
+                                    f"[{LocalFile.id.name}] = ?", [md5(b"shared").hexdigest()]).fetchone()
+    assert row == (2,)
+
+
+def test_linked_import():
+    pool = migrated_pool()
+    source = make_tree()
+    volume = mkdtemp(dir=dirname(source))
+    counts = bulk_import(pool.connection(), volume, Config(layout="sharded"), source, "linked", link=True, workers=1,
+                         progress=lambda message: None)
+    assert counts == {"files": 5, "blobs": 4, "bytes": 14, "skipped": 0}
+    checksum = md5(b"readme").hexdigest()
+    blob = join(volume, checksum[:2], checksum[2:4], checksum)
+    assert os.stat(blob).st_ino == os.stat(join(source, "docs", "b.md")).st_ino
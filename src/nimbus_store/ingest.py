@@ -0,0 +1,256 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os.path import dirname
+from .compression import IDENTITY, compressor
+from .metrics import metrics
+
+
+# Digest algorithms blobs can be content-addressed by. Each produces a hex digest which is the blob's local_file id.
+# blake2b is truncated to 16 bytes so its digests are the same length as md5's
+DIGESTS = {
+    "md5": hashlib.md5,
+    "blake2b": partial(hashlib.blake2b, digest_size=16),
+    "sha256": hashlib.sha256,
+}
+
+# The number of threads writing ingested data to disk, across all uploads in the process
+WRITER_THREADS = 32
+
+_writers = None
+_writers_lock = threading.Lock()
+
+
+def _writer_pool() -> ThreadPoolExecutor:
+    # created on first use, so no threads exist in a process that forks before ingesting anything
+    global _writers
+    with _writers_lock:
+        if _writers is None:
+            _writers = ThreadPoolExecutor(WRITER_THREADS, thread_name_prefix="nimbus-ingest")
+    return _writers
+
+
+def valid_checksum(digest: str, checksum: str) -> bool:
+    """ Whether checksum looks like a hex digest produced by the given algorithm """
+    length = DIGESTS[digest]().digest_size * 2
+    return re.fullmatch(f"[0-9a-f]{{{length}}}", checksum) is not None
+
+
+def fsync(fd: int):
+    """ os.fsync, timed in the process's metrics """
+    start = time.perf_counter()
+    try:
+        os.fsync(fd)
+    finally:
+        metrics.observe("nimbus_fsync_duration_seconds", time.perf_counter() - start)
+
+
+def fsync_dir(path: str):
+    """ Makes a rename or unlink within the directory durable """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class IngestError(ValueError):
+    """ An upload was incomplete or its data didn't match its checksum """
+
+
+class Writer:
+    """ Writes data to a file from a position onwards, hashing it on the way if given a hash, and compressing it after
+    hashing if given a compressor.
+
+    Each chunk is hashed by the caller while the previous one is written to disk by a writer thread, so hashing
+    overlaps with the disk write. Data either comes from a stream via readfrom, which reads into two reused buffers,
+    or is pushed a chunk at a time via write, which is what the async API does as the body arrives """
+
+    def __init__(self, fd: int, offset: int = 0, hash=None, buffer_size: int = 1 << 20, compressor=None):
+        self._fd = fd
+        self._offset = offset
+        self._hash = hash
+        self._buffer_size = buffer_size
+        self._compressor = compressor
+        self._writing = None
+        self.size = 0
+
+    def readfrom(self, stream, length: int):
+        """ Ingests exactly length bytes from stream """
+        buffers = [bytearray(min(self._buffer_size, length)) for _ in range(2)]
+        readinto = getattr(stream, "readinto", None)
+        remaining = length
+        i = 0
+        while remaining:
+            # the write that last used this buffer finished before the previous buffer's write was submitted
+            view = memoryview(buffers[i])[:min(self._buffer_size, remaining)]
+            filled = 0
+            while filled < len(view):
+                if readinto is not None:
+                    count = readinto(view[filled:])
+                else:
+                    data = stream.read(len(view) - filled)
+                    count = len(data)
+                    view[filled:filled + count] = data
+                if not count:
+                    raise IngestError(f"Request body ended {remaining - filled} bytes short of its length")
+                filled += count
+            self._consume(view)
+            remaining -= filled
+            i ^= 1
+
+    def write(self, chunk: bytes):
+        """ Ingests the next chunk of data. The chunk must not be modified afterwards """
+        self._consume(memoryview(chunk))
+
+    def _consume(self, view: memoryview):
+        if self._hash is not None:
+            self._hash.update(view)
+        self.size += len(view)
+        if self._compressor is not None:
+            view = memoryview(self._compressor.compress(view))
+            if not view:
+                return
+        self._submit(view)
+
+    def _submit(self, view: memoryview):
+        # at most one write is in flight, so writes land in order and the other buffer is free to fill
+        self._wait()
+        offset, self._offset = self._offset, self._offset + len(view)
+        self._writing = _writer_pool().submit(self._write_all, view, offset)
+
+    def _write_all(self, view: memoryview, offset: int):
+        while view:
+            written = os.pwrite(self._fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _wait(self):
+        if self._writing is not None:
+            writing, self._writing = self._writing, None
+            writing.result()
+
+
+class Ingest(Writer):
+    """ Writes an uploaded blob to a temporary file in the volume, hashing it on the way, and renames it into place
+    once it is on disk and matches its checksum """
+
+    # the data of a blob stored in a file of its own is never held in memory
+    data = None
+
+    def __init__(self, root: str, digest: str = "md5", buffer_size: int = 1 << 20, encoding: str = IDENTITY):
+        fd, self._tmp = tempfile.mkstemp(dir=root, prefix=".ingest-")
+        super().__init__(fd, 0, DIGESTS[digest](), buffer_size, None if encoding == IDENTITY else compressor(encoding))
+        self.encoding = encoding
+        self._done = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Discards the blob, unless it was finished """
+        if not self._done:
+            self.abort()
+
+    def finish(self, path: str, checksum: str) -> str:
+        """ Flushes the blob to disk and, if its digest is checksum, atomically moves it to path. Returns the digest """
+        digest = self.verify(checksum)
+        self.place(path)
+        return digest
+
+    def verify(self, checksum: str) -> str:
+        """ Flushes the blob to disk if its digest is checksum, ready to be placed. Returns the digest """
+        if self._compressor is not None:
+            tail, self._compressor = self._compressor.flush(), None
+            if tail:
+                self._submit(memoryview(tail))
+        self._wait()
+        digest = self._hash.hexdigest()
+        if digest != checksum:
+            self.abort()
+            raise IngestError(f"Data has checksum {digest}, not {checksum}")
+        os.fchmod(self._fd, 0o644)  # mkstemp creates files only their owner can read
+        fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        return digest
+
+    def place(self, path: str):
+        """ Atomically moves the verified blob to path """
+        os.makedirs(dirname(path), exist_ok=True)
+        os.replace(self._tmp, path)
+        fsync_dir(dirname(path))
+        self._done = True
+
+    def abort(self):
+        """ Discards everything ingested so far """
+        try:
+            self._wait()
+        except OSError:
+            pass
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        os.remove(self._tmp)
+        self._done = True
+
+
+class PackIngest:
+    """ Ingests a blob small enough to be packed into memory, hashing and compressing it like Ingest. Its data is only
+    written to disk once verified, when it is appended to a segment within the transaction recording it """
+
+    # a packed blob isn't placed in a file of its own
+    place = None
+
+    def __init__(self, digest: str = "md5", encoding: str = IDENTITY):
+        self._hash = DIGESTS[digest]()
+        self._compressor = None if encoding == IDENTITY else compressor(encoding)
+        self._chunks = []
+        self.encoding = encoding
+        self.size = 0
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._chunks = []
+
+    def readfrom(self, stream, length: int):
+        """ Ingests exactly length bytes from stream """
+        remaining = length
+        while remaining:
+            chunk = stream.read(remaining)
+            if not chunk:
+                raise IngestError(f"Request body ended {remaining} bytes short of its length")
+            self.write(chunk)
+            remaining -= len(chunk)
+
+    def write(self, chunk: bytes):
+        """ Ingests the next chunk of data """
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        self._chunks.append(chunk if self._compressor is None else self._compressor.compress(chunk))
+
+    def verify(self, checksum: str) -> str:
+        """ Makes data the blob as stored if its digest is checksum. Returns the digest """
+        if self._compressor is not None:
+            self._chunks.append(self._compressor.flush())
+            self._compressor = None
+        digest = self._hash.hexdigest()
+        if digest != checksum:
+            self.close()
+            raise IngestError(f"Data has checksum {digest}, not {checksum}")
+        self.data, self._chunks = b"".join(self._chunks), []
+        return digest
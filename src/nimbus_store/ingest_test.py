@@ -0,0 +1,52 @@
+import hashlib
+import io
+import os
+import pytest
+from os.path import join
+from tempfile import mkdtemp
+from .ingest import DIGESTS, Ingest, IngestError, valid_checksum
+
+
+data = os.urandom(3 * 1024 * 1024 + 123)
+
+
+@pytest.mark.parametrize("digest", DIGESTS)
+def test_ingest_stream(digest):
+    root = mkdtemp()
+    checksum = DIGESTS[digest](data).hexdigest()
+    assert valid_checksum(digest, checksum)
+    with Ingest(root, digest, buffer_size=64 * 1024) as ingest:
+        ingest.readfrom(io.BytesIO(data), len(data))
+        assert ingest.finish(join(root, checksum), checksum) == checksum
+    assert os.listdir(root) == [checksum]
+    with open(join(root, checksum), "rb") as f:
+        assert f.read() == data
+
+
+def test_ingest_chunks():
+    root = mkdtemp()
+    checksum = hashlib.md5(data).hexdigest()
+    with Ingest(root) as ingest:
+        for i in range(0, len(data), 100000):
+            ingest.write(data[i:i + 100000])
+        ingest.finish(join(root, checksum), checksum)
+    with open(join(root, checksum), "rb") as f:
+        assert f.read() == data
+
+
+def test_ingest_mismatch():
+    root = mkdtemp()
+    checksum = hashlib.md5(b"something else").hexdigest()
+    with pytest.raises(IngestError):
+        with Ingest(root) as ingest:
+            ingest.readfrom(io.BytesIO(data), len(data))
+            ingest.finish(join(root, checksum), checksum)
+    assert os.listdir(root) == []
+
+
+def test_ingest_short_body():
+    root = mkdtemp()
+    with pytest.raises(IngestError):
+        with Ingest(root) as ingest:
+            ingest.readfrom(io.BytesIO(data), len(data) + 1)
+    assert os.listdir(root) == []
@@ -0,0 +1,120 @@
+import os
+import sqlite3
+import typing
+from os.path import dirname, exists, join
+from .models.local_file import LocalFile
+if typing.TYPE_CHECKING:
+    from .volumes import Volumes
+
+
+# How blobs are arranged within a volume:
+# - flat: every blob directly in the volume root, named by its checksum
+# - sharded: fanned out over two levels of directories named by checksum prefix, e.g. ab/cd/abcd...
+LAYOUTS = ("flat", "sharded")
+# The directory of the volume small blobs are packed into segments in, whatever the layout
+PACK_DIR = "packs"
+# Records the path a blob has been moved to within its volume
+REPATH_BLOB = f"UPDATE [{LocalFile.table_name}] SET [{LocalFile.path.name}] = ? WHERE [{LocalFile.id.name}] = ?"
+
+
+def blob_path(layout: str, checksum: str) -> str:
+    """ The path of a blob relative to the volume root """
+    if layout == "sharded":
+        return join(checksum[:2], checksum[2:4], checksum)
+    return checksum
+
+
+def is_packed(local_file: LocalFile) -> bool:
+    """ Whether a blob is packed into a segment, in which case its path is that of the segment """
+    return local_file.path.value.startswith(PACK_DIR + "/")
+
+
+def locate(root: str, layout: str, local_file: LocalFile) -> typing.Optional[str]:
+    """ The absolute path of a stored blob, or None if it is missing from disk. Blobs are normally at the path recorded
+    in local_file (or in the root for rows from before paths were recorded). While a volume is being relaid out the
+    recorded path may be a step behind, so the blob's path in the current layout is tried as well """
+    checksum = local_file.id.value
+    for path in (local_file.path.value or checksum, blob_path(layout, checksum)):
+        fname = join(root, path)
+        if exists(fname):
+            return fname
+    return None
+
+
+def relayout(volumes: "Volumes", db: sqlite3.Connection, layout: str, batch_size: int = 1000, progress=print) -> int:
+    """ Moves every blob to its path in layout within its volume, while the server keeps serving. Returns the number
+    of blobs moved """
+    cursor = db.cursor()
+    stmt = LocalFile.page_statement(LocalFile.id, after=True, limit=True)
+    after = ""
+    moved = 0
+    while True:
+        rows = cursor.execute(stmt, [after, batch_size]).fetchall()
+        if not rows:
+            return moved
+        after = rows[-1][LocalFile.cols().index(LocalFile.id.name)]
+        updates = []
+        unlink = []
+        for row in rows:
+            local_file = LocalFile.from_db_row(row)
+            volume = volumes.get(local_file.volume.value)
+            if volume is None or is_packed(local_file):
+                continue
+            root = volume.root
+            checksum = local_file.id.value
+            old = local_file.path.value or checksum
+            new = blob_path(layout, checksum)
+            if old == new:
+                continue
+            if not exists(join(root, new)):
+                if not exists(join(root, old)):
+                    continue  # missing from disk entirely, nothing to move
+                os.makedirs(dirname(join(root, new)), exist_ok=True)
+                os.link(join(root, old), join(root, new))
+            updates.append((new, checksum))
+            unlink.append(join(root, old))
+        cursor.executemany(REPATH_BLOB, updates)
+        db.commit()
+        for fname in unlink:
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+        moved += len(updates)
+        progress(f"Moved {moved} blobs")
+
+
+if __name__ == "__main__":
+    import argparse
+    from .db import ConnectionPool
+    from .volumes import Volume, Volumes, parse_volume
+    parser = argparse.ArgumentParser(
+        description="Moves the blobs of a node's volumes to a new layout, in place, while the server keeps serving. "
+                    "Start the server with the new --layout first, so new uploads are already written to it"
+    )
+    parser.add_argument(
+        "db",
+        help="the path to the local instance of the database file"
+    )
+    parser.add_argument(
+        "volumes",
+        help="the volumes of the node, the primary first, as PATH[=WEIGHT]",
+        metavar="PATH[=WEIGHT]",
+        nargs="+"
+    )
+    parser.add_argument(
+        "--layout",
+        help="the layout to move blobs to",
+        choices=LAYOUTS,
+        default="sharded"
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="the number of blobs moved per transaction",
+        type=int,
+        default=1000
+    )
+    args = parser.parse_args()
+    volumes = Volumes([Volume(root, weight) for root, weight in map(parse_volume, args.volumes)])
+    moved = relayout(volumes, ConnectionPool(args.db).connection(), args.layout, args.batch_size)
+    print(f"Done, moved {moved} blobs")
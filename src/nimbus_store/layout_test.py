@@ -0,0 +1,61 @@
+import json
+from falcon import testing
+from hashlib import md5
+from os import listdir
+from os.path import exists, join, dirname
+from tempfile import mkdtemp
+from . import API, Config, ConnectionPool
+from .layout import relayout
+from .migrations import Migration
+from .test import headers_json, headers_binary
+from .volumes import Volume, Volumes
+
+
+def upload(client, bucket, data):
+    file = {"name": "blob.bin", "mime": "application/octet-stream", "path": "a"}
+    file_id = client.simulate_post(f"/buckets/{bucket}/files", body=json.dumps(file), headers=headers_json).json["id"]
+    digest = md5(data).hexdigest()
+    result = client.simulate_post(f"/buckets/{bucket}/files/{file_id}/data/{digest}", body=data,
+                                  headers=headers_binary)
+    assert result.status_code == 204
+    return file_id, digest
+
+
+def test_relayout():
+    pool = ConnectionPool(join(mkdtemp(), "db.sqlite"))
+    Migration(join(dirname(__file__), "../../db/sqlite/migrations"), pool.connection())()
+    volume = mkdtemp()
+    client = testing.TestClient(API(pool, volume, Config(layout="flat")))
+    client.simulate_post("/buckets", body=json.dumps({"name": "layout", "desc": ""}), headers=headers_json)
+    blobs = [upload(client, "layout", bytes([i]) * 100) for i in range(5)]
+    assert sorted(name for name in listdir(volume) if not name.startswith(".")) == sorted(d for _, d in blobs)
+
+    volumes = Volumes.of(volume)
+    assert relayout(volumes, pool.connection(), "sharded", batch_size=2, progress=lambda _: None) == 5
+    for file_id, digest in blobs:
+        assert not exists(join(volume, digest))
+        assert exists(join(volume, digest[:2], digest[2:4], digest))
+        # served at the recorded path, whichever layout the server was started with
+        result = client.simulate_get(f"/buckets/layout/files/{file_id}/data/{digest}")
+        assert result.status_code == 200
+    assert relayout(volumes, pool.connection(), "sharded", progress=lambda _: None) == 0
+
+    # new uploads under the sharded layout go straight to their shard
+    client = testing.TestClient(API(pool, volume, Config(layout="sharded")))
+    file_id, digest = upload(client, "layout", b"sharded")
+    assert exists(join(volume, digest[:2], digest[2:4], digest))
+    assert client.simulate_get(f"/buckets/layout/files/{file_id}/data/{digest}").content == b"sharded"
+
+
+def test_relayout_volumes():
+    pool = ConnectionPool(join(mkdtemp(), "db.sqlite"))
+    Migration(join(dirname(__file__), "../../db/sqlite/migrations"), pool.connection())()
+    volumes = Volumes([Volume(mkdtemp(), draining=True), Volume(mkdtemp())])  # every blob goes to the second
+    client = testing.TestClient(API(pool, volumes, Config(layout="flat")))
+    client.simulate_post("/buckets", body=json.dumps({"name": "layout", "desc": ""}), headers=headers_json)
+    blobs = [upload(client, "layout", bytes([i]) * 100) for i in range(3)]
+    assert relayout(volumes, pool.connection(), "sharded", progress=lambda _: None) == 3
+    root = list(volumes)[1].root
+    for file_id, digest in blobs:
+        assert exists(join(root, digest[:2], digest[2:4], digest))
+        assert client.simulate_get(f"/buckets/layout/files/{file_id}/data/{digest}").status_code == 200
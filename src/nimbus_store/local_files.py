@@ -1,12 +1,22 @@
 import falcon
+from .compression import IDENTITY, Decompressed, accepts, choose_encoding
 from .models.file import File
 from .models.local_file import LocalFile
 from .buckets import validate_bucket
 from .files import validate_file
 from .util import require
+from .volumes import Volume
 from .resource import ApiResource
-import hashlib
-from os.path import getsize, join
+from .ingest import Ingest, IngestError, PackIngest
+from .layout import is_packed
+from .ranges import Byteranges, Chunks, FileRange, parse_ranges
+import typing
+from datetime import datetime
+from os.path import getsize
+
+
+# Size of the reads used to send blobs that aren't handed to the server as a file
+CHUNK_SIZE = 256 * 1024
 
 
 class LocalFileResource(ApiResource):
@@ -16,46 +26,178 @@ class LocalFileResource(ApiResource):
     @validate_bucket
     @validate_file
     def on_post(self, req: falcon.Request, resp: falcon.Response, checksum: str):
-        """ Upload binary data to a destination file on the local system """
-        # TODO actually validate checksum
-        length = req.content_length
-        read_bytes = 0
-        hash = hashlib.md5()
-        with open(join(self._root, checksum), "wb") as fd:
-            while read_bytes < length:
-                count = min(4096, length-read_bytes)  # TODO make this configurable (read size)
-                read_bytes += 4096
-                segment = req.stream.read(count)
-                hash.update(segment)
-                fd.write(segment)
-        local_file = LocalFile(id=hash.hexdigest(), path="")  # NOTE path is probably pointless for now
-        stmt, params = local_file.insert_statement(local_file.id, local_file.path)
-        cursor = self._db.cursor()
-        cursor.execute(stmt, params)
-        # TODO this should be a method on File
-        cursor.execute(f"UPDATE [{File.table_name}] "
-                       f"SET [{File.local_file_id.name}]=?, "
-                       f"[{File.pending.name}]=0 "
-                       f"WHERE [{File.id.name}]='{req.context.file.id.value}'", [hash.hexdigest()])
-        self._db.commit()
+        """ Upload binary data to a destination file on the local system. If a blob with this checksum is already
+        stored it is attached to the file as is, and the body is never read: a client can send none at all, and one
+        that sent Expect: 100-continue is answered before sending it. The blob is compressed on disk if the
+        compression policy for the bucket or the file's mime type says so, and packed into a segment if small """
+        self._check_checksum(checksum)
+        if self._attach_existing(req.context.file, checksum):
+            resp.status = falcon.HTTP_NO_CONTENT
+            return
+        if req.content_length is None:
+            raise falcon.HTTPLengthRequired(description="Uploads must have a Content-Length")
+        volume = self._volumes.place(checksum)
+        try:
+            with self._ingest(req, volume) as ingest:
+                ingest.readfrom(req.stream, req.content_length)
+                digest = ingest.verify(checksum)
+                self._store_local_file(req.context.file, digest, ingest.place, ingest.encoding, ingest.size,
+                                       ingest.data, volume)
+        except IngestError as e:
+            raise falcon.HTTPBadRequest(title="Invalid upload", description=str(e))
         resp.status = falcon.HTTP_NO_CONTENT
 
+    @validate_bucket
+    @validate_file
+    def on_head(self, req: falcon.Request, resp: falcon.Response, checksum: str):
+        """ Checks whether a blob is already stored, in which case a client can attach it to the file by POSTing to
+        this route with an empty body rather than uploading it again """
+        local_file = self._find_local_file(checksum)
+        fname = None if local_file is None else self._locate(local_file)
+        if fname is None:
+            raise falcon.HTTPNotFound()
+        resp.content_length = self._original_length(local_file, fname)
+
     @validate_bucket
     @validate_file
     def on_get(self, req: falcon.Request, resp: falcon.Response, checksum: str):
-        """ Download binary data associated with a given file object """
-        cursor = self._db.cursor()
-        stmt = LocalFile.find_by_id_statement()
-        r = cursor.execute(stmt, [checksum])
-        row = r.fetchone()
-        if row is None:
+        """ Download binary data associated with a given file object. Supports conditional requests against the
+        blob's checksum (its ETag) and the file's last update, and single or multiple byte ranges. A compressed blob
+        is sent as stored if the client accepts its encoding, and is otherwise decompressed on the way """
+        file = req.context.file
+        local_file = self._file_data(file, checksum)
+        encoding = self._negotiate(req, resp, local_file)
+        if self._not_modified(req, resp, file, checksum if encoding is None else f"{checksum}-{encoding}"):
+            return
+        f, length = self._open_data(local_file)
+        resp.content_type = file.mime.value
+        resp.downloadable_as = file.name.value
+        if encoding is not None:
+            self._send(req, resp, f, length)
+            return
+        if local_file.encoding.value != IDENTITY:
+            self._send(req, resp, Decompressed(f, local_file.encoding.value), local_file.size.value)
+            return
+        try:
+            ranges = self._ranges(req, file, checksum, length)
+        except BaseException:
+            f.close()
+            raise
+        if ranges is None:
+            self._send(req, resp, f, length)
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            resp.status = falcon.HTTP_PARTIAL_CONTENT
+            resp.content_range = (first, last, length)
+            self._send(req, resp, FileRange(f, first, last - first + 1), last - first + 1)
+        else:
+            body = Byteranges(ranges, length, file.mime.value)
+            resp.status = falcon.HTTP_PARTIAL_CONTENT
+            resp.content_type = body.content_type
+            resp.content_length = body.content_length
+            resp.stream = self._byteranges(f, body)
+
+    def _send(self, req: falcon.Request, resp: falcon.Response, body, length: int):
+        """ Makes an open blob, or a FileRange of one, the response body. A server providing wsgi.file_wrapper is
+        handed the file itself, so it can send it without copying it through userspace (ours uses sendfile). Otherwise
+        it is read in large blocks. Either way the server closes it when done, even if the client went away """
+        if "wsgi.file_wrapper" in req.env:
+            resp.set_stream(body, length)
+        else:
+            resp.content_length = length
+            resp.stream = Chunks(body, CHUNK_SIZE)
+
+    def _ingest(self, req: falcon.Request, volume: Volume) -> typing.Union[Ingest, PackIngest]:
+        """ A new ingest of the data of the request's file into volume, compressed as the policy for it says, and
+        packed if it is small enough """
+        encoding = choose_encoding(self._config, req.context.bucket.name.value, req.context.file.mime.value)
+        if self._packs(volume).accepts(req.content_length):
+            return PackIngest(self._config.digest, encoding)
+        return Ingest(volume.root, self._config.digest, self._config.buffer_size, encoding)
+
+    def _file_data(self, file: File, checksum: str) -> LocalFile:
+        """ Returns the local_file of the blob with the given checksum, if it is the data of the given file """
+        self._check_file_data(file, checksum)
+        local_file = self._find_local_file(checksum)
+        if local_file is None:
             raise falcon.HTTPNotFound(description="Invalid checksum or missing data")
-        local_file = LocalFile.from_db_row(row)
-        if local_file.id.value != req.context.file.local_file_id.value:
+        return local_file
+
+    def _original_length(self, local_file: LocalFile, fname: str) -> int:
+        """ The length of a blob's original data, stored at fname. That of a packed or compressed blob is recorded """
+        if local_file.encoding.value == IDENTITY and not is_packed(local_file):
+            return getsize(fname)
+        return local_file.size.value
+
+    def _negotiate(self, req: falcon.Request, resp: falcon.Response, local_file: LocalFile) -> typing.Optional[str]:
+        """ Chooses how to send a blob: a compressed one as stored, with its Content-Encoding, if the client accepts
+        that encoding, and otherwise as its original data. Returns the encoding it is sent with, or None. Byte ranges
+        are only served of blobs stored as is, since those of a compressed one would have to be decompressed from the
+        start """
+        encoding = local_file.encoding.value
+        if encoding == IDENTITY:
+            resp.set_header("Accept-Ranges", "bytes")
+            return None
+        resp.set_header("Accept-Ranges", "none")
+        resp.vary = ("Accept-Encoding",)
+        if not accepts(req.get_header("Accept-Encoding"), encoding):
+            return None
+        resp.set_header("Content-Encoding", encoding)
+        return encoding
+
+    def _check_file_data(self, file: File, checksum: str):
+        if checksum != file.local_file_id.value:
             raise falcon.HTTPNotFound(description="Invalid checksum or missing data")
-        fname = join(self._root, checksum)
-        length = getsize(fname)
-        resp.content_type = req.context.file.mime.value
-        resp.downloadable_as = req.context.file.name.value
-        f = open(fname, "rb")
-        resp.set_stream(f, length)
+
+    def _last_modified(self, file: File) -> typing.Optional[datetime]:
+        """ When the file was last updated, as recorded by sqlite in UTC """
+        try:
+            return datetime.strptime(file.last_updated.value, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+
+    def _not_modified(self, req: falcon.Request, resp: falcon.Response, file: File, etag: str) -> bool:
+        """ Sets the validators of the file's data on resp and, if the client's copy is still current, makes resp a
+        304 and returns True. Blobs are content-addressed, so their checksum is a strong ETag of their original data,
+        and that suffixed with the encoding one of their compressed form. This never needs to touch the blob itself """
+        modified = self._last_modified(file)
+        resp.etag = etag
+        resp.last_modified = modified
+        if req.if_none_match is not None:
+            not_modified = any(tag == "*" or tag == etag for tag in req.if_none_match)
+        else:
+            since = req.if_modified_since
+            not_modified = since is not None and modified is not None and modified <= since
+        if not_modified:
+            resp.status = falcon.HTTP_NOT_MODIFIED
+        return not_modified
+
+    def _ranges(self, req: falcon.Request, file: File, checksum: str, length: int):
+        """ The byte ranges of the blob to serve, or None to serve all of it """
+        header = req.get_header("Range")
+        if header is None or req.method != "GET":
+            return None
+        if_range = req.get_header("If-Range")
+        if if_range is not None:
+            if if_range.startswith(('"', "W/")):
+                current = if_range == f'"{checksum}"'  # If-Range only ever matches strongly
+            else:
+                try:
+                    current = falcon.http_date_to_dt(if_range) == self._last_modified(file)
+                except ValueError:
+                    current = False
+            if not current:
+                return None
+        return parse_ranges(header, length)
+
+    def _byteranges(self, f, body: Byteranges):
+        with f:
+            for header, first, last in body.parts:
+                yield header
+                part = FileRange(f, first, last - first + 1)
+                while part.remaining:
+                    chunk = part.read(CHUNK_SIZE)
+                    if not chunk:
+                        return  # the blob was truncated, so there's nothing correct left to send
+                    yield chunk
+            yield body.closing
@@ -0,0 +1,241 @@
+import bisect
+import falcon
+import re
+import sys
+import threading
+import time
+import typing
+import weakref
+from collections import Counter
+from functools import lru_cache
+
+
+# Upper bounds of the buckets durations are counted into, in seconds
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+HELP = {
+    "nimbus_request_duration_seconds": ("histogram", "Time to handle a request, up to its response starting"),
+    "nimbus_render_duration_seconds": ("histogram", "Time to serialize response bodies"),
+    "nimbus_sql_duration_seconds": ("histogram", "Time to execute SQL statements, up to their first row"),
+    "nimbus_db_commit_duration_seconds": ("histogram", "Time to commit database transactions"),
+    "nimbus_fsync_duration_seconds": ("histogram", "Time to fsync blobs and directories"),
+    "nimbus_group_commit_wait_seconds": ("histogram", "Time writes wait to be committed along with others"),
+    "nimbus_requests_in_flight": ("gauge", "Requests being handled"),
+    "nimbus_request_bytes_total": ("counter", "Bytes of request bodies received"),
+    "nimbus_response_bytes_total": ("counter", "Bytes of response bodies sent"),
+}
+# How often the profiler samples the stacks of every thread by default, in seconds
+PROFILE_INTERVAL = 0.01
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+class Histogram:
+    """ Counts of observed values by the first of DURATION_BUCKETS they fit in, along with their total """
+
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(DURATION_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """ Counters and histograms of what the process spends its time on, rendered in the Prometheus text format. Every
+    update takes one uncontended lock, so they are cheap enough to keep on in production. Each process has its own,
+    so with prefork every worker must be scraped, or their numbers summed.
+
+    Other components report their own statistics by adding a source, a method returning a dict of numbers, which is
+    called on every render. Sources are held weakly, so they don't keep their owner alive """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: typing.Dict[typing.Tuple[str, Labels], Histogram] = {}
+        self._counters: typing.Dict[typing.Tuple[str, Labels], float] = Counter()
+        self._in_flight = 0
+        self._sources = []
+
+    def observe(self, name: str, value: float, labels: Labels = ()):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, labels: Labels = ()):
+        with self._lock:
+            self._counters[(name, labels)] += value
+
+    def in_flight(self, delta: int):
+        with self._lock:
+            self._in_flight += delta
+
+    def add_source(self, prefix: str, stats):
+        """ Reports the numbers returned by the bound method stats as nimbus_<prefix>_<name>. The numbers of sources
+        with the same prefix are summed """
+        with self._lock:
+            self._sources.append((prefix, weakref.WeakMethod(stats)))
+
+    def render(self) -> str:
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+            in_flight = self._in_flight
+            self._sources = [(prefix, ref) for prefix, ref in self._sources if ref() is not None]
+            sources = list(self._sources)
+        lines = []
+        families = {}
+        for (name, labels), value in histograms.items():
+            families.setdefault(name, []).append((labels, value))
+        for name in sorted(families):
+            lines.extend(self._header(name))
+            for labels, (counts, total) in sorted(families[name]):
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {total}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        lines.extend(self._header("nimbus_requests_in_flight"))
+        lines.append(f"nimbus_requests_in_flight {in_flight}")
+        for name in ("nimbus_request_bytes_total", "nimbus_response_bytes_total"):
+            lines.extend(self._header(name))
+            lines.append(f"{name} {counters.get((name, ()), 0)}")
+        reported = Counter()
+        for prefix, ref in sources:
+            stats = ref()
+            if stats is not None:
+                for stat, value in stats().items():
+                    reported["_".join(filter(None, ("nimbus", prefix, stat)))] += value
+        for name in sorted(reported):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {reported[name]}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name: str) -> typing.List[str]:
+        type, help = HELP[name]
+        return [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+@lru_cache(maxsize=1024)
+def statement_label(sql: str) -> str:
+    """ The kind of a SQL statement and the table it acts on, e.g. "SELECT file", so statements which only differ in
+    their number of placeholders are counted together """
+    verb = sql.split(None, 1)[0].upper() if sql.strip() else ""
+    table = re.search(r"\b(?:FROM|INTO|UPDATE)\s+\[?(\w+)", sql, re.IGNORECASE)
+    return f"{verb} {table.group(1)}" if table is not None else verb
+
+
+class Profiler:
+    """ A sampling profiler which can be started and stopped while the server runs. A thread samples the stack of
+    every other thread every interval seconds, and counts each distinct stack. Stacks are reported in the folded
+    format flame graph tools read, one "outermost;...;innermost count" line per stack """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._thread = None
+        self._stopped = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float = PROFILE_INTERVAL):
+        """ Starts sampling afresh, discarding the samples of any previous run """
+        with self._lock:
+            if self._thread is not None:
+                self._stopped.set()
+            self._stacks = Counter()
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._sample, args=(interval, self._stopped, self._stacks),
+                                            name="nimbus-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stops sampling, keeping the samples taken """
+        with self._lock:
+            if self._thread is not None:
+                self._stopped.set()
+                self._thread = None
+
+    def folded(self) -> str:
+        with self._lock:
+            stacks = list(self._stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks))
+
+    def _sample(self, interval: float, stopped: threading.Event, stacks: Counter):
+        me = threading.get_ident()
+        while not stopped.wait(interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+                    frame = frame.f_back
+                with self._lock:
+                    stacks[";".join(reversed(names))] += 1
+
+
+class MetricsMiddleware:
+    """ Times every request by route, and counts requests in flight and the bytes of request and response bodies.
+    Streamed responses are timed until the response starts, and counted if their length is known """
+
+    def __init__(self, metrics: Metrics):
+        self._metrics = metrics
+
+    def process_request(self, req, resp):
+        req.context.metrics_start = time.perf_counter()
+        self._metrics.in_flight(1)
+
+    def process_response(self, req, resp, resource, req_succeeded: bool):
+        if resp.stream is None:
+            start = time.perf_counter()
+            body = resp.render_body()
+            self._metrics.observe("nimbus_render_duration_seconds", time.perf_counter() - start)
+            length = 0 if body is None else len(body)
+        else:
+            length = resp.content_length
+        self._finish(req, resp, length)
+
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded: bool):
+        if resp.stream is None:
+            start = time.perf_counter()
+            body = await resp.render_body()
+            self._metrics.observe("nimbus_render_duration_seconds", time.perf_counter() - start)
+            length = 0 if body is None else len(body)
+        else:
+            length = resp.content_length
+        self._finish(req, resp, length)
+
+    def _finish(self, req, resp, length):
+        start = getattr(req.context, "metrics_start", None)
+        if start is None:
+            return
+        labels = (("route", req.uri_template or "unmatched"), ("method", req.method),
+                  ("status", str(falcon.http_status_to_code(resp.status))))
+        self._metrics.observe("nimbus_request_duration_seconds", time.perf_counter() - start, labels)
+        self._metrics.in_flight(-1)
+        if req.content_length:
+            self._metrics.inc("nimbus_request_bytes_total", req.content_length)
+        if length:
+            self._metrics.inc("nimbus_response_bytes_total", int(length))
+
+
+# The process's metrics and profiler, shared by every app and database connection in it
+metrics = Metrics()
+profiler = Profiler()
@@ -0,0 +1,57 @@
+import json
+import threading
+import time
+from .metrics import Metrics, statement_label
+from .test import client, headers_json
+
+
+def test_statement_label():
+    assert statement_label("SELECT [id] FROM [file] WHERE id IN (?,?,?)") == "SELECT file"
+    assert statement_label("UPDATE [local_file] SET [path]=? WHERE [id]=?") == "UPDATE local_file"
+    assert statement_label("INSERT OR IGNORE INTO local_file([id]) VALUES (?)") == "INSERT local_file"
+    assert statement_label("BEGIN IMMEDIATE") == "BEGIN"
+
+
+def test_render():
+    metrics = Metrics()
+    metrics.observe("nimbus_fsync_duration_seconds", 0.003)
+    metrics.observe("nimbus_fsync_duration_seconds", 20)
+    metrics.inc("nimbus_response_bytes_total", 100)
+
+    class Source:
+        def stats(self):
+            return {"hits": 2}
+    source = Source()
+    metrics.add_source("cache", source.stats)
+    lines = metrics.render().splitlines()
+    assert 'nimbus_fsync_duration_seconds_bucket{le="0.0025"} 0' in lines
+    assert 'nimbus_fsync_duration_seconds_bucket{le="0.005"} 1' in lines
+    assert 'nimbus_fsync_duration_seconds_bucket{le="+Inf"} 2' in lines
+    assert "nimbus_fsync_duration_seconds_count 2" in lines
+    assert "nimbus_response_bytes_total 100" in lines
+    assert "nimbus_cache_hits 2" in lines
+    del source
+    assert "nimbus_cache_hits 2" not in metrics.render().splitlines()
+
+
+def test_metrics_endpoint(client):
+    client.simulate_post("/buckets", body=json.dumps({"name": "metrics", "desc": ""}), headers=headers_json)
+    client.simulate_get("/buckets/metrics", headers=headers_json)
+    result = client.simulate_get("/metrics")
+    assert result.status_code == 200
+    assert 'nimbus_request_duration_seconds_count{route="/buckets/{bucket}",method="GET",status="200"}' in result.text
+    assert 'nimbus_sql_duration_seconds_count{statement="INSERT bucket"}' in result.text
+    assert "nimbus_db_commit_duration_seconds_count" in result.text
+    assert "nimbus_bucket_cache_misses" in result.text
+
+
+def test_profiler(client):
+    stop = threading.Event()
+    threading.Thread(target=stop.wait).start()  # every thread is sampled, not just the one profiling
+    assert client.simulate_put("/metrics/profile", params={"interval": "0.001"}).status_code == 204
+    time.sleep(0.05)
+    assert client.simulate_delete("/metrics/profile").status_code == 204
+    stop.set()
+    result = client.simulate_get("/metrics/profile")
+    assert result.headers["X-Profiling"] == "off"
+    assert "threading:" in result.text
@@ -0,0 +1,27 @@
+import migrate
+import os
+import sqlite3
+
+
+class Migration(migrate.Migration):
+    """ nimbus_migrate applies migration files in directory order, which is arbitrary on most filesystems. Our
+    migrations build on each other, so apply them sorted by name (reversed when migrating down) """
+
+    def run_migration_directory(self):
+        suffix = ".up.sql" if self._up else ".dn.sql"
+        names = sorted(file[:-len(suffix)] for file in os.listdir(self._mig_dir) if file.endswith(suffix))
+        if not self._up:
+            names.reverse()
+        name = None
+        try:
+            for name in names:
+                if (name in self._ran_migrations) == self._up:
+                    continue
+                with open(os.path.join(self._mig_dir, name + suffix)) as f:
+                    self.run_migration(f.read(), name)
+        except sqlite3.Error as e:
+            print(f"Error executing SQL for migration '{name}': {e}")
+        except Exception as e:
+            print(f"Unexpected error occurred opening migration directory or file: {e}")
+        else:
+            print("All migrations ran successfully")
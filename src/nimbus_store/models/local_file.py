@@ -7,4 +7,10 @@ class LocalFile(Model):
     fields = {
         "id": Field("A UUID v4", str, writable=False),
         "path": Field("the virtual path where the file is stored", str, writable=False),
+        "refs": Field("the number of files whose data this is, kept by triggers on file", int, writable=False),
+        "encoding": Field("how the blob is compressed on disk, or identity if it is stored as is", str, writable=False),
+        "size": Field("the size of the blob's original data in bytes, or 0 if stored before sizes were recorded", int,
+                      writable=False),
+        "volume": Field("the id of the volume the blob is stored in, or empty if it is in the primary volume", str,
+                        writable=False),
     }
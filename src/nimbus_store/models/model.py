@@ -1,15 +1,26 @@
 from abc import ABC, ABCMeta, abstractmethod
+from functools import lru_cache
 import typing
 
 
+_UNSET = object()
+
+
 class Field:
-    """ Represents a single field on a data model class """
+    """ Represents a single field on a data model class. Fields are shared by every object of their model: on an
+    object, each is a BoundField of that object's value of it """
+    __slots__ = ("_name", "_desc", "_type", "_writable", "_value", "_index")
+
     def __init__(self, description: str, _type, writable=True, name=None):
         self._name = name
         self._desc = description
         self._type = _type
         self._writable = writable
         self._value = self._type()
+        self._index = None
+
+    def __get__(self, obj, cls=None):
+        return self if obj is None else BoundField(self, obj._values)
 
     @property
     def name(self):
@@ -32,25 +43,71 @@ class Field:
     def writable(self):
         return self._writable
 
-    def copy(self):
-        return Field(self.desc, self._type, name=self.name, writable=self.writable)
+    @property
+    def type(self):
+        """ The python type values of this field are coerced to """
+        return self._type
+
+
+class BoundField:
+    """ A field of one model object, reading and writing its value in the object's list of values, so loading a row
+    only makes that list rather than an object per field """
+    __slots__ = ("_field", "_values")
+
+    def __init__(self, field: Field, values: list):
+        self._field = field
+        self._values = values
+
+    @property
+    def name(self):
+        return self._field._name
+
+    @property
+    def desc(self):
+        return self._field._desc
+
+    @property
+    def value(self):
+        return self._values[self._field._index]
+
+    @value.setter
+    def value(self, new_value):
+        self._values[self._field._index] = self._field._type(new_value)
+
+    @property
+    def writable(self):
+        return self._field._writable
+
+    @property
+    def type(self):
+        return self._field._type
 
 
 class ModelMeta(ABCMeta):
-    """ Metaclass that builds model attributes based on fields dictionary """
+    """ Metaclass that builds model attributes based on fields dictionary, along with the column lists every row
+    conversion and statement uses, so that they are worked out once per model rather than once per row """
     def __init__(cls, name, bases, clsdict):
         super().__init__(name, bases, clsdict)
         if len(cls.mro()) > 2:  # Don't try to treat Model, just subclasses of Model
-            for name, value in cls.fields.items():
+            for index, (name, value) in enumerate(cls.fields.items()):
                 if value.name is None:
                     value._name = name
+                value._index = index
                 setattr(cls, name, value)
+            cls._keys = tuple(cls.fields)
+            cls._types = tuple(field.type for field in cls.fields.values())
+            cls._cols = [field.name for field in cls.fields.values()]
+            cls._writable_cols = [field.name for field in cls.fields.values() if field.writable]
+            cls._writable_indexes = tuple(field._index for field in cls.fields.values() if field.writable)
 
 
 class Model(metaclass=ModelMeta):
 
-    _writable_cols = None
-    _cols = None
+    _keys = ()
+    _types = ()
+    _cols = []
+    _writable_cols = []
+    _writable_indexes = ()
 
     @property
     @abstractmethod
@@ -64,35 +121,29 @@ class Model(metaclass=ModelMeta):
 
     @classmethod
     def writable_cols(cls) -> typing.List[str]:
-        if cls._writable_cols is None:
-            cls._writable_cols = [v.name for k, v in cls.fields.items() if v.writable]
         return cls._writable_cols
 
     @classmethod
     def cols(cls) -> typing.List[str]:
-        if cls._cols is None:
-            cls._cols = [v.name for k, v in cls.fields.items()]
         return cls._cols
 
     def __init__(self, **values):
-        for field_name, field in self.fields.items():
-            instance_field = field.copy()
-            if field_name in values:
-                instance_field.value = values[field_name]
-            setattr(self, field_name, instance_field)
+        """ Values not given are the default of their field's type """
+        self._values = [_type() if values.get(key, _UNSET) is _UNSET else _type(values[key])
+                        for key, _type in zip(self._keys, self._types)]
 
     @classmethod
     def from_db_row(cls, row):
-        values = {}
-        for name, value in zip(cls.cols(), row):
-            if name in cls.fields:
-                values[name] = value
-            else:
-                for key, field in cls.fields.items():
-                    if field.name == name:
-                        values[key] = value
-                        break
-        return cls(**values)
+        """ A model object from a row selected with select_columns """
+        obj = cls.__new__(cls)
+        obj._values = [_type(value) for _type, value in zip(cls._types, row)]
+        return obj
+
+    @classmethod
+    def dict_from_db_row(cls, row) -> dict:
+        """ The same as from_db_row(row).to_dict(), without making a model object and its fields along the way. For
+        rows that are only rendered, e.g. listings """
+        return {key: _type(value) for key, _type, value in zip(cls._keys, cls._types, row)}
 
     @classmethod
     def from_dict(cls, dict):
@@ -101,45 +152,69 @@ class Model(metaclass=ModelMeta):
 
     def to_dict(self) -> dict:
         """ Render the model object into a flat dictionary for marshalling to json, etc. """
-        d = {}
-        for name in self.fields:
-            d[name] = getattr(self, name).value
-        return d
+        return dict(zip(self._keys, self._values))
 
-    # SQL formatting/generation methods. They are escaped and should be sanitized
+    # SQL formatting/generation methods. They are escaped and should be sanitized. The statements only depend on the
+    # model and the arguments, so each is built once and then reused
     @classmethod
     def insert_columns(cls, *extra_fields: Field):
         extra = [field.name for field in extra_fields]
         return ", ".join(f"[{each}]" for each in cls.writable_cols() + extra)
 
     @classmethod
+    @lru_cache(maxsize=None)
     def select_columns(cls):
         return ", ".join(f"[{each}]" for each in cls.cols())
 
     @classmethod
+    @lru_cache(maxsize=None)
     def db_columns(cls):
         return ", ".join(f"[{name}]" for name, field in cls.fields.items())
 
     @classmethod
+    @lru_cache(maxsize=None)
     def find_by_id_statement(cls) -> str:
         return f"SELECT {cls.select_columns()} FROM [{cls.table_name}] WHERE {cls.id.name} = ?"
 
     @classmethod
+    @lru_cache(maxsize=None)
     def find_statement(cls, field: Field=None) -> str:
         where = f"WHERE {field.name} = ?" if field is not None else ""
         return f"SELECT {cls.select_columns()} FROM [{cls.table_name}] {where}"
 
-    def insert_statement(self, *extra_fields: Field) -> typing.Tuple[str, list]:
+    @classmethod
+    @lru_cache(maxsize=None)
+    def page_statement(cls, key: Field, field: Field=None, after=False, limit=False) -> str:
+        """ Returns a keyset-paginated SELECT ordered by key. Parameters are, in order: the value of field (if given),
+        the cursor to start after (if after) and the maximum number of rows (if limit) """
+        where = []
+        if field is not None:
+            where.append(f"[{field.name}] = ?")
+        if after:
+            where.append(f"[{key.name}] > ?")
+        where = f"WHERE {' AND '.join(where)}" if where else ""
+        stmt = f"SELECT {cls.select_columns()} FROM [{cls.table_name}] {where} ORDER BY [{key.name}]"
+        return stmt + " LIMIT ?" if limit else stmt
+
+    def insert_statement(self, *extra_fields: Field, ignore=False, replace=False) -> typing.Tuple[str, list]:
         """ Returns a formatted, simple INSERT INTO VALUES statement and parameters
         By default, only inserts writable fields. If you need to set a non-writable field
-        then provide the fields as variadic parameters. """
-        placeholders = ",".join(["?"] * (len(self.writable_cols()) + len(extra_fields)))
-        stmt = f"INSERT INTO {self.table_name}({self.insert_columns(*extra_fields)})"\
-               f" VALUES ({placeholders})"
-        values = [getattr(self, name).value for name, value in self.fields.items() if value.writable]
+        then provide the fields as variadic parameters. With ignore, a row that would violate a
+        uniqueness constraint is silently skipped, and with replace it replaces the existing row """
+        stmt = self._insert_sql(tuple(field.name for field in extra_fields), ignore, replace)
+        values = [self._values[index] for index in self._writable_indexes]
         return stmt, values + [field.value for field in extra_fields]
 
     @classmethod
+    @lru_cache(maxsize=None)
+    def _insert_sql(cls, extra_cols: typing.Tuple[str, ...], ignore: bool, replace: bool) -> str:
+        placeholders = ",".join(["?"] * (len(cls.writable_cols()) + len(extra_cols)))
+        insert = "INSERT OR IGNORE" if ignore else "INSERT OR REPLACE" if replace else "INSERT"
+        columns = ", ".join(f"[{each}]" for each in cls.writable_cols() + list(extra_cols))
+        return f"{insert} INTO {cls.table_name}({columns}) VALUES ({placeholders})"
+
+    @classmethod
+    @lru_cache(maxsize=None)
     def delete_statement(cls, field: Field) -> str:
         """ Returns a formatted, simple DELETE statement for a given record """
         stmt = f"DELETE FROM [{cls.table_name}] WHERE [{field.name}] = ?"
@@ -0,0 +1,24 @@
+from .file import File
+
+
+def test_dict_from_db_row():
+    row = ("1b4e28ba", "cat.jpg", "image/jpeg", "pets", 1, "2024-01-01 00:00:00", "2024-01-01 00:00:00", None, 1)
+    assert File.dict_from_db_row(row) == File.from_db_row(row).to_dict()
+    assert File.dict_from_db_row(row)["pending"] is True
+
+
+def test_statements_cached():
+    assert File.find_statement(File.bucket_id) is File.find_statement(File.bucket_id)
+    file = File(name="cat.jpg", mime="image/jpeg", path="pets", id="1b4e28ba")
+    stmt, params = file.insert_statement(file.id, ignore=True)
+    assert stmt == "INSERT OR IGNORE INTO file([name], [mime], [path], [id]) VALUES (?,?,?,?)"
+    assert params == ["cat.jpg", "image/jpeg", "pets", "1b4e28ba"]
+
+
+def test_values_per_object():
+    first, second = File(name="a.txt"), File(name="b.txt")
+    first.pending.value = 1
+    first.bucket_id.value = "3"
+    assert first.pending.value is True and first.bucket_id.value == 3
+    assert second.pending.value is False and second.to_dict()["name"] == "b.txt"
+    assert File.name.name == "name" and first.name.name == "name" and not first.id.writable
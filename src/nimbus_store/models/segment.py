@@ -0,0 +1,25 @@
+from .model import Model, Field
+
+
+class Segment(Model):
+    """ A file in the volume which small blobs are appended to, one after another """
+
+    table_name = "segment"
+    fields = {
+        "id": Field("the number of the segment, counting up from 1", int, writable=False),
+        "path": Field("the path of the segment relative to the volume root", str, writable=False),
+        "volume": Field("the id of the volume the segment is in, or empty if it is in the primary volume", str,
+                        writable=False),
+    }
+
+
+class PackedBlob(Model):
+    """ Where in a segment a packed blob is stored """
+
+    table_name = "packed_blob"
+    fields = {
+        "id": Field("the id of the blob's local_file", str, writable=False),
+        "segment_id": Field("the id of the segment the blob is stored in", int, writable=False),
+        "offset": Field("the position of the blob in the segment", int, writable=False),
+        "length": Field("the size of the blob as stored in the segment, after any compression", int, writable=False),
+    }
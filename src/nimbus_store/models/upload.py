@@ -0,0 +1,27 @@
+from .model import Model, Field
+
+
+class Upload(Model):
+    """ A multipart upload session, whose parts are written into place in one file in the volume as they arrive """
+
+    table_name = "upload"
+    fields = {
+        "id": Field("A UUID v4", str, writable=False),
+        "file_id": Field("the id of the file the upload is the data of", str, writable=False),
+        "part_size": Field("the size of every part but the last", int),
+        "created": Field("the time the upload was started, automatically set by DB", str, writable=False),
+        "last_updated": Field("the time a part of the upload was last received", str, writable=False),
+        "attempts": Field("how many times parts of the upload have been sent, counting any still arriving", int,
+                          writable=False),
+    }
+
+
+class UploadPart(Model):
+
+    table_name = "upload_part"
+    fields = {
+        "upload_id": Field("the id of the upload the part belongs to", str, writable=False),
+        "number": Field("the position of the part in the upload, counting from 1", int, writable=False),
+        "size": Field("the size of the part in bytes", int, writable=False),
+        "attempt": Field("the upload's count of attempts when the part was sent", int, writable=False),
+    }
@@ -0,0 +1,30 @@
+import falcon
+from .metrics import PROFILE_INTERVAL, metrics, profiler
+from .resource import ApiResource
+
+
+class MetricsResource(ApiResource):
+    """ The process's metrics, for Prometheus to scrape """
+
+    def on_get(self, req: falcon.Request, resp: falcon.Response):
+        resp.content_type = "text/plain; version=0.0.4"
+        resp.text = metrics.render()
+
+
+class ProfileResource(ApiResource):
+    """ Turns the sampling profiler on and off. PUT starts it, optionally sampling every ?interval= seconds, DELETE
+    stops it, and GET returns the stacks sampled so far in the folded format flame graph tools read """
+
+    def on_get(self, req: falcon.Request, resp: falcon.Response):
+        resp.content_type = falcon.MEDIA_TEXT
+        resp.set_header("X-Profiling", "on" if profiler.running else "off")
+        resp.text = profiler.folded()
+
+    def on_put(self, req: falcon.Request, resp: falcon.Response):
+        interval = req.get_param_as_float("interval", min_value=0.001, max_value=10, default=PROFILE_INTERVAL)
+        profiler.start(interval)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+    def on_delete(self, req: falcon.Request, resp: falcon.Response):
+        profiler.stop()
+        resp.status = falcon.HTTP_NO_CONTENT
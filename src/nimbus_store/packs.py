@@ -0,0 +1,232 @@
+import fcntl
+import os
+import sqlite3
+import threading
+import typing
+from collections import Counter, OrderedDict
+from os.path import join
+from uuid import uuid4
+from .config import Config
+from .ingest import fsync, fsync_dir
+from .layout import PACK_DIR, REPATH_BLOB
+from .metrics import metrics
+from .models.segment import PackedBlob, Segment
+
+
+# The most segments each process keeps open for reading
+OPEN_SEGMENTS = 256
+# The most blobs copied per transaction while compacting a segment
+COMPACT_BATCH = 500
+# The segment a packed blob is in, and its offset and length there
+LOCATE_PACKED = f"SELECT s.[{Segment.path.name}], p.[{PackedBlob.offset.name}], p.[{PackedBlob.length.name}] " \
+                f"FROM [{PackedBlob.table_name}] p JOIN [{Segment.table_name}] s ON s.[{Segment.id.name}] = " \
+                f"p.[{PackedBlob.segment_id.name}] WHERE p.[{PackedBlob.id.name}] = ?"
+# The bytes of each segment which still belong to a blob
+LIVE_BYTES = f"SELECT [{PackedBlob.segment_id.name}], SUM([{PackedBlob.length.name}]) " \
+             f"FROM [{PackedBlob.table_name}] GROUP BY [{PackedBlob.segment_id.name}]"
+# A page of the blobs packed in a segment, after a cursor
+SEGMENT_BLOBS = f"SELECT {PackedBlob.select_columns()} FROM [{PackedBlob.table_name}] " \
+                f"WHERE [{PackedBlob.segment_id.name}] = ? AND [{PackedBlob.id.name}] > ? " \
+                f"ORDER BY [{PackedBlob.id.name}] LIMIT ?"
+# Records where a packed blob has been copied to, unless it was stored again since it was read from where it was
+MOVE_PACKED = f"UPDATE [{PackedBlob.table_name}] SET [{PackedBlob.segment_id.name}] = ?, " \
+              f"[{PackedBlob.offset.name}] = ? WHERE [{PackedBlob.id.name}] = ? AND " \
+              f"[{PackedBlob.segment_id.name}] = ? AND [{PackedBlob.offset.name}] = ?"
+# Deletes a segment, unless a blob was packed into it again meanwhile
+DELETE_SEGMENT = f"DELETE FROM [{Segment.table_name}] WHERE [{Segment.id.name}] = ? AND NOT EXISTS " \
+                 f"(SELECT 1 FROM [{PackedBlob.table_name}] WHERE [{PackedBlob.segment_id.name}] = ?)"
+
+
+class PackStore:
+    """ Stores blobs of at most config.pack_threshold bytes one after another in large segment files, rather than each
+    in a file of its own, recording where each is in packed_blob """
+
+    def __init__(self, volume, config: Config):
+        self._root = volume.root
+        self._volume = volume
+        self._config = config
+        self._lock = threading.Lock()
+        self._segment: typing.Optional[Segment] = None
+        self._fd = None  # of the current segment, locked and open for appending
+        self._size = 0
+        self._readers = OrderedDict()
+        self._readers_lock = threading.Lock()
+        self.stats = Counter()
+        metrics.add_source("pack", self.counts)
+
+    def counts(self) -> typing.Dict[str, float]:
+        return dict(self.stats)
+
+    def accepts(self, length: typing.Optional[int]) -> bool:
+        """ Whether a blob of the given length is packed rather than stored in a file of its own """
+        return self._config.pack_threshold > 0 and length is not None and length <= self._config.pack_threshold
+
+    def append(self, db: sqlite3.Connection, checksum: str, data: bytes) -> typing.Tuple[str, PackedBlob]:
+        """ Appends a blob's bytes to this process's segment, in the transaction recording the blob. Returns the
+        segment's path and where in it the blob is """
+        with self._lock:
+            if self._fd is not None and not self._recorded(db):
+                self._seal()  # the transaction which recorded it was rolled back
+            if self._fd is not None and self._size and self._size + len(data) > self._config.segment_size:
+                self._seal()
+            if self._fd is None:
+                self._open(db)
+            offset = self._size
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self._fd, view, offset + len(data) - len(view))
+                view = view[written:]
+            fsync(self._fd)
+            self._size += len(data)
+            self.stats["appended_blobs"] += 1
+            self.stats["appended_bytes"] += len(data)
+            return self._segment.path.value, PackedBlob(id=checksum, segment_id=self._segment.id.value,
+                                                        offset=offset, length=len(data))
+
+    def _recorded(self, db: sqlite3.Connection) -> bool:
+        row = db.cursor().execute(Segment.find_by_id_statement(), [self._segment.id.value]).fetchone()
+        return row is not None
+
+    def _open(self, db: sqlite3.Connection):
+        path = join(PACK_DIR, f"{uuid4().hex}.seg")
+        os.makedirs(join(self._root, PACK_DIR), exist_ok=True)
+        fd = os.open(join(self._root, path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        fsync_dir(join(self._root, PACK_DIR))
+        segment = Segment(path=path, volume=self._volume.id)
+        stmt, params = segment.insert_statement(segment.path, segment.volume)
+        segment.id.value = db.cursor().execute(stmt, params).lastrowid
+        self._segment, self._fd, self._size = segment, fd, 0
+        self.stats["segments_opened"] += 1
+
+    def _seal(self):
+        """ Stops appending to the current segment, unlocking it for compaction """
+        os.close(self._fd)
+        self._segment, self._fd, self._size = None, None, 0
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                self._seal()
+        with self._readers_lock:
+            self._readers.clear()
+
+    def locate(self, db: sqlite3.Connection, checksum: str) -> typing.Optional[typing.Tuple[str, int, int]]:
+        """ The segment a packed blob is in, and its offset and length there, or None if it isn't packed """
+        row = db.cursor().execute(LOCATE_PACKED, [checksum]).fetchone()
+        return None if row is None else (join(self._root, row[0]), row[1], row[2])
+
+    def read(self, fname: str, offset: int, length: int) -> bytes:
+        """ Reads a packed blob's bytes, or raises FileNotFoundError if its segment was compacted away meanwhile """
+        f = self._reader(fname)
+        data = os.pread(f.fileno(), length, offset)
+        if len(data) != length:
+            raise OSError(f"Segment {fname} is truncated")
+        return data
+
+    def _reader(self, fname: str):
+        # segments are dropped from the cache rather than closed, so one is only closed once no read is using it
+        with self._readers_lock:
+            f = self._readers.get(fname)
+            if f is not None:
+                self._readers.move_to_end(fname)
+                return f
+        f = open(fname, "rb", buffering=0)
+        with self._readers_lock:
+            f = self._readers.setdefault(fname, f)
+            while len(self._readers) > OPEN_SEGMENTS:
+                self._readers.popitem(last=False)
+            return f
+
+    def prune(self):
+        """ Closes the segments which were compacted away, so their space is freed """
+        with self._readers_lock:
+            for fname, f in list(self._readers.items()):
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    del self._readers[fname]
+
+    def compact(self, db: sqlite3.Connection, throttle=lambda count: None):
+        """ Rewrites the segments of the volume which are at least config.compact_ratio dead into the current one """
+        cursor = db.cursor()
+        ids = self._volume.ids
+        segments = [Segment.from_db_row(row) for row in cursor.execute(
+            f"{Segment.find_statement()} WHERE [{Segment.volume.name}] IN ({','.join('?' * len(ids))})", ids)]
+        live = dict(cursor.execute(LIVE_BYTES))
+        for segment in segments:
+            with self._lock:
+                current = self._segment is not None and self._segment.id.value == segment.id.value
+            if current:
+                continue
+            fname = join(self._root, segment.path.value)
+            try:
+                fd = os.open(fname, os.O_RDONLY)
+            except FileNotFoundError:
+                fd = None
+            try:
+                if fd is not None:
+                    size = os.fstat(fd).st_size
+                    if size and live.get(segment.id.value, 0) > size * (1 - self._config.compact_ratio):
+                        continue
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # a process is still appending to it
+                self._compact(db, segment, fd, throttle)
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+    def _compact(self, db: sqlite3.Connection, segment: Segment, fd: typing.Optional[int], throttle):
+        cursor = db.cursor()
+        after = ""
+        copied = 0
+        while fd is not None:
+            blobs = [PackedBlob.from_db_row(row) for row in
+                     cursor.execute(SEGMENT_BLOBS, [segment.id.value, after, COMPACT_BATCH]).fetchall()]
+            if not blobs:
+                break
+            after = blobs[-1].id.value
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for blob in blobs:
+                    data = os.pread(fd, blob.length.value, blob.offset.value)
+                    copied += len(data)
+                    path, moved = self.append(db, blob.id.value, data)
+                    r = cursor.execute(MOVE_PACKED, [moved.segment_id.value, moved.offset.value, blob.id.value,
+                                                     segment.id.value, blob.offset.value])
+                    if r.rowcount == 1:  # unless stored again meanwhile
+                        cursor.execute(REPATH_BLOB, [path, blob.id.value])
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+            self.stats["compacted_blobs"] += len(blobs)
+            throttle(len(blobs))
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            r = cursor.execute(DELETE_SEGMENT, [segment.id.value, segment.id.value])
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        if r.rowcount != 1 or fd is None:
+            return
+        self.stats["bytes_reclaimed"] += os.fstat(fd).st_size - copied
+        os.remove(join(self._root, segment.path.value))
+        fsync_dir(join(self._root, PACK_DIR))
+        self.stats["segments_compacted"] += 1
+        with self._readers_lock:
+            self._readers.pop(join(self._root, segment.path.value), None)
+
+
+_stores: typing.Dict[str, PackStore] = {}
+_stores_lock = threading.Lock()
+
+
+def pack_store(volume, config: Config) -> PackStore:
+    """ The process's store of packed blobs in the volume, made with config on first use """
+    with _stores_lock:
+        store = _stores.get(volume.root)
+        if store is None:
+            store = _stores[volume.root] = PackStore(volume, config)
+        return store
@@ -0,0 +1,77 @@
+import gzip
+import json
+import os
+import pytest
+from falcon import testing
+from hashlib import md5
+from os.path import exists, join
+from tempfile import mkdtemp
+from . import API
+from .collector import Collector
+from .config import Config
+from .layout import PACK_DIR
+from .test import headers_json, headers_binary, migrated_pool
+
+
+@pytest.fixture(scope="module")
+def client():
+    pool = migrated_pool()
+    volume = mkdtemp()
+    config = Config(pack_threshold=1024, segment_size=4096, gc_interval=0, gc_rate=0,
+                    bucket_compression={"zipped": "gzip"})
+    client = testing.TestClient(API(pool, volume, config))
+    client.pool, client.volume, client.config = pool, volume, config
+    for bucket in ("packed", "zipped"):
+        client.simulate_post("/buckets", body=json.dumps({"name": bucket, "desc": ""}), headers=headers_json)
+    return client
+
+
+def upload(client, data: bytes, bucket: str = "packed") -> str:
+    file = {"name": "blob.bin", "mime": "application/octet-stream", "path": "packs"}
+    id = client.simulate_post(f"/buckets/{bucket}/files", body=json.dumps(file), headers=headers_json).json["id"]
+    url = f"/buckets/{bucket}/files/{id}/data/{md5(data).hexdigest()}"
+    assert client.simulate_post(url, body=data, headers=headers_binary).status_code == 204
+    return url
+
+
+def segments(client):
+    return sorted(os.listdir(join(client.volume, PACK_DIR)))
+
+
+def test_small_blobs_are_packed(client):
+    small, large = b"small blob " * 10, b"large blob " * 200
+    small_url, large_url = upload(client, small), upload(client, large)
+    assert not exists(join(client.volume, md5(small).hexdigest()))
+    assert exists(join(client.volume, md5(large).hexdigest()))
+    assert len(segments(client)) == 1
+    assert client.simulate_get(small_url).content == small
+    assert client.simulate_get(large_url).content == large
+    assert client.simulate_head(small_url).headers["Content-Length"] == str(len(small))
+    result = client.simulate_get(small_url, headers={"Range": "bytes=6-9"})
+    assert result.status_code == 206
+    assert result.content == small[6:10]
+
+
+def test_packed_compressed(client):
+    data = b"squeeze " * 100
+    url = upload(client, data, "zipped")
+    assert not exists(join(client.volume, md5(data).hexdigest()))
+    assert gzip.decompress(client.simulate_get(url, headers={"Accept-Encoding": "gzip"}).content) == data
+    assert client.simulate_get(url).content == data
+
+
+def test_compaction(client):
+    blobs = [f"blob {i:02d} ".encode() * 100 for i in range(20)]
+    urls = [upload(client, data) for data in blobs]
+    before = segments(client)
+    assert len(before) > 2
+    # deleting all but every fifth blob leaves the full segments mostly dead
+    for url in urls[1:]:
+        if urls.index(url) % 5:
+            client.simulate_delete(url[:url.index("/data/")], headers=headers_json)
+    collector = Collector(client.pool, client.volume, client.config)
+    assert collector.run()
+    assert collector.stats["blobs_collected"] == 16
+    assert set(before) - set(segments(client))
+    for url, data in list(zip(urls, blobs))[::5]:
+        assert client.simulate_get(url).content == data
@@ -0,0 +1,94 @@
+import importlib
+import inspect
+import itertools
+import pkgutil
+import pytest
+from .test import db
+from .collector import UNREFERENCED
+from .models.bucket import Bucket
+from .models.file import File
+from .models.local_file import LocalFile
+from .models.segment import PackedBlob, Segment
+from .models.upload import Upload, UploadPart
+from .packs import LIVE_BYTES
+
+
+MODELS = (Bucket, File, LocalFile, Segment, PackedBlob, Upload, UploadPart)
+# Fields rows are found by other than ids
+LOOKUPS = (Bucket.name,)
+# The models whose rows are read a page at a time in id order, and the fields pages of them are filtered by
+PAGED = {Bucket: [None], File: [None, File.bucket_id], LocalFile: [None]}
+
+
+def keys(model) -> list:
+    """ The fields rows of model are found by: their id, the ids of the rows they belong to, and LOOKUPS """
+    return [field for name, field in model.fields.items() if name == "id" or name.endswith("_id") or field in LOOKUPS]
+
+
+def model_statements(model) -> list:
+    """ The statements the model builders make for model: finding and deleting rows by each key, and if it is PAGED,
+    its pages, after a cursor or not and LIMITed or not """
+    statements = [model.find_statement()]
+    if "id" in model.fields:
+        statements.append(model.find_by_id_statement())
+    for key in keys(model):
+        statements += [model.find_statement(key), model.delete_statement(key)]
+    for field, after, limit in itertools.product(PAGED.get(model, []), (False, True), (False, True)):
+        statements.append(model.page_statement(model.id, field, after=after, limit=limit))
+    return statements
+
+
+def module_statements() -> list:
+    """ The statements held in the package's module constants, and those built by its functions named *_statement,
+    with every combination of their flags """
+    package = importlib.import_module(__package__)
+    statements = []
+    for module in pkgutil.iter_modules(package.__path__):
+        if module.ispkg or module.name.endswith("_test"):
+            continue
+        module = importlib.import_module(f"{__package__}.{module.name}")
+        for name, value in vars(module).items():
+            if name.isupper() and isinstance(value, str) and value.startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+                statements.append(value)
+            elif name.endswith("_statement") and inspect.isfunction(value) and value.__module__ == module.__name__:
+                flags = len(inspect.signature(value).parameters)
+                statements += [value(*flags) for flags in itertools.product((False, True), repeat=flags)]
+    return statements
+
+
+# Statements built around a list of ids, here of two
+ID_LISTS = [
+    f"{File.find_statement()} WHERE [{File.id.name}] IN (?,?)",
+    f"{File.find_statement(File.bucket_id)} AND [{File.id.name}] IN (?,?)",
+    f"{LocalFile.find_statement()} WHERE [{LocalFile.id.name}] IN (?,?)",
+]
+
+# Every statement the store issues
+statements = list(dict.fromkeys(sum(map(model_statements, MODELS), []) + module_statements() + ID_LISTS))
+
+# The statements which read a whole table or index on purpose, and why. They must still not sort
+EXCEPTIONS = {
+    **{model.find_statement(): "only issued with a list of ids appended, as in ID_LISTS" for model in MODELS},
+    **{model.page_statement(model.id, field, limit=True): "a first page walks the key from its start, stopping after "
+       "LIMIT rows" for model, fields in PAGED.items() for field in fields if field is None},
+    **{model.page_statement(model.id, field): "a ?stream= listing reads every row, in key order"
+       for model, fields in PAGED.items() for field in fields if field is None},
+    **{model.page_statement(model.id, field, after=True): "a ?stream= listing reads every row after the cursor, in key "
+       "order" for model, fields in PAGED.items() for field in fields if field is None},
+    UNREFERENCED: "walks a partial index holding only the local_files to be collected",
+    LIVE_BYTES: "compaction sums the live bytes of every segment, once per run, from a covering index",
+}
+
+
+def test_exceptions_are_issued():
+    assert set(EXCEPTIONS) <= set(statements)
+
+
+@pytest.mark.parametrize("stmt", statements)
+def test_statement_uses_index(stmt):
+    params = [None] * stmt.count("?")
+    plan = db.cursor().execute(f"EXPLAIN QUERY PLAN {stmt}", params).fetchall()
+    for row in plan:
+        detail = row[-1]
+        assert stmt in EXCEPTIONS or not detail.startswith("SCAN"), f"'{stmt}' scans: {detail}"
+        assert "TEMP B-TREE" not in detail, f"'{stmt}' sorts: {detail}"
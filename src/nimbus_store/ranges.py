@@ -0,0 +1,94 @@
+import falcon
+import typing
+from functools import partial
+from uuid import uuid4
+
+
+# Requests for more ranges than this are served the whole blob, rather than a multipart body of many tiny parts
+MAX_RANGES = 16
+
+
+def parse_ranges(header: str, length: int) -> typing.Optional[typing.List[typing.Tuple[int, int]]]:
+    """ Parses a Range header for a blob of the given length into (first, last) byte positions, inclusive. Returns None
+    if the header should be ignored, i.e. it is malformed, not in bytes, or asks for too many ranges, and raises
+    HTTPRangeNotSatisfiable if none of its ranges overlap the blob """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    specs = [each.strip() for each in spec.split(",") if each.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for each in specs:
+        first, sep, last = (part.strip() for part in each.partition("-"))
+        if not sep or not (first.isdigit() or first == "") or not (last.isdigit() or last == "") or first == last == "":
+            return None
+        if first:
+            first = int(first)
+            if last and int(last) < first:
+                return None
+            if first >= length:
+                continue
+            ranges.append((first, min(int(last), length - 1) if last else length - 1))
+        elif int(last) > 0 and length:
+            ranges.append((max(length - int(last), 0), length - 1))
+    if not ranges:
+        raise falcon.HTTPRangeNotSatisfiable(length)
+    return ranges
+
+
+class Byteranges:
+    """ The layout of a multipart/byteranges body serving several ranges of one blob """
+
+    def __init__(self, ranges: typing.List[typing.Tuple[int, int]], length: int, content_type: str):
+        boundary = uuid4().hex
+        self.content_type = f"multipart/byteranges; boundary={boundary}"
+        self.parts = [(f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+                       f"Content-Range: bytes {first}-{last}/{length}\r\n\r\n".encode(), first, last)
+                      for first, last in ranges]
+        self.closing = f"\r\n--{boundary}--\r\n".encode()
+
+    @property
+    def content_length(self) -> int:
+        return sum(len(header) + last - first + 1 for header, first, last in self.parts) + len(self.closing)
+
+
+class FileRange:
+    """ A readable view of length bytes of an open file, starting at offset. It keeps the file's fileno and position
+    visible, so a server can send it with sendfile just like the whole file """
+
+    def __init__(self, f, offset: int, length: int):
+        f.seek(offset)
+        self._f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._f.read(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+    def fileno(self) -> int:
+        return self._f.fileno()
+
+    def tell(self) -> int:
+        return self._f.tell()
+
+
+class Chunks:
+    """ Iterates over a readable body in blocks of block_size, and closes it once the server is done with it. Unlike
+    a bare file, falcon passes this to the server as is, rather than reading it in its own small blocks """
+
+    def __init__(self, body, block_size: int):
+        self._body = body
+        self._block_size = block_size
+
+    def __iter__(self):
+        return iter(partial(self._body.read, self._block_size), b"")
+
+    def close(self):
+        self._body.close()
@@ -0,0 +1,25 @@
+import falcon
+import pytest
+from .ranges import parse_ranges, MAX_RANGES
+
+
+def test_parse_ranges():
+    assert parse_ranges("bytes=0-4", 10) == [(0, 4)]
+    assert parse_ranges("bytes=5-", 10) == [(5, 9)]
+    assert parse_ranges("bytes=-3", 10) == [(7, 9)]
+    assert parse_ranges("bytes=-30", 10) == [(0, 9)]
+    assert parse_ranges("bytes=8-20", 10) == [(8, 9)]
+    assert parse_ranges("bytes=0-0, 20-30, -2", 10) == [(0, 0), (8, 9)]
+
+
+def test_parse_ranges_ignored():
+    for header in ("items=0-4", "bytes=", "bytes=4-2", "bytes=a-b", "bytes=-", "bytes=1"):
+        assert parse_ranges(header, 10) is None
+    assert parse_ranges("bytes=" + ",".join(["0-0"] * (MAX_RANGES + 1)), 10) is None
+
+
+def test_parse_ranges_unsatisfiable():
+    with pytest.raises(falcon.HTTPRangeNotSatisfiable):
+        parse_ranges("bytes=10-", 10)
+    with pytest.raises(falcon.HTTPRangeNotSatisfiable):
+        parse_ranges("bytes=-0", 10)
@@ -1,9 +1,215 @@
+import falcon
+import os
+import sqlite3
+from .cache import MetadataCache, metadata_cache
+from .compression import IDENTITY
+from .config import Config
+from .db import ConnectionPool
+from .ingest import valid_checksum
+from .layout import blob_path, is_packed, locate
+from .models.file import File
+from .models.local_file import LocalFile
+from .models.model import Field
+from .models.segment import PackedBlob
+from .packs import PackStore, pack_store
+import typing
+from io import BytesIO
+from os.path import join
+from .util import page_params, stream_rows, STREAM_FORMATS
+from .volumes import Volume, Volumes
+from .writer import GroupCommitter, group_committer, savepoint
+
+
+# Records where a blob is stored, over what a concurrent upload of it recorded, or a record of it gone from disk
+RECORD_BLOB = f"UPDATE [{LocalFile.table_name}] SET [{LocalFile.path.name}]=?, [{LocalFile.encoding.name}]=?, " \
+              f"[{LocalFile.size.name}]=?, [{LocalFile.volume.name}]=? WHERE [{LocalFile.id.name}]=?"
+# Points a file at a blob, marking it no longer pending, unless the blob's local_file was collected meanwhile
+ATTACH_BLOB = f"UPDATE [{File.table_name}] SET [{File.local_file_id.name}]=?, [{File.pending.name}]=0 " \
+              f"WHERE [{File.id.name}]=? AND EXISTS (SELECT 1 FROM [{LocalFile.table_name}] " \
+              f"WHERE [{LocalFile.id.name}]=?)"
 
 
 class ApiResource:
     """ Base Class for HTTP API resources """
 
-    def __init__(self, db, root_path: str):
-        """ Must provide a database connection """
-        self._db = db
-        self._root = root_path
+    def __init__(self, db: ConnectionPool, volumes: typing.Union[str, Volumes], config: Config = None):
+        """ Must provide a database connection pool, and the volumes blobs are stored in or the root of the only one """
+        self._pool = db
+        self._volumes = Volumes.of(volumes)
+        self._config = config or Config()
+        self._cache: MetadataCache = metadata_cache(db, self._config)
+        self._committer: typing.Optional[GroupCommitter] = group_committer(db, self._config)
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """ The database connection belonging to the thread handling the current request """
+        return self._pool.connection()
+
+    def _write(self, fn, *args):
+        """ Calls fn(*args) in a write transaction, rolled back if it raises, and returns what it returns once that is
+        committed. fn may run on another thread, so must look up self._db itself """
+        db = self._db
+        if db.in_transaction:
+            return savepoint(db, fn, *args)
+        if self._committer is not None:
+            return self._committer.submit(fn, *args)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        return result
+
+    def _execute(self, stmt: str, params) -> sqlite3.Cursor:
+        """ Executes a statement on the current thread's connection, e.g. as a write of one statement """
+        return self._db.cursor().execute(stmt, params)
+
+    def _find_local_file(self, checksum: str) -> typing.Optional[LocalFile]:
+        cursor = self._db.cursor()
+        row = cursor.execute(LocalFile.find_by_id_statement(), [checksum]).fetchone()
+        return None if row is None else LocalFile.from_db_row(row)
+
+    def _locate(self, local_file: LocalFile) -> typing.Optional[str]:
+        """ The absolute path of a stored blob, or None if it is missing from disk or its volume """
+        volume = self._volumes.get(local_file.volume.value)
+        return None if volume is None else locate(volume.root, self._config.layout, local_file)
+
+    def _packs(self, volume: Volume) -> PackStore:
+        """ The store of packed blobs in volume """
+        return pack_store(volume, self._config)
+
+    def _data_path(self, local_file: LocalFile) -> str:
+        fname = self._locate(local_file)
+        if fname is None:
+            raise falcon.HTTPNotFound(description="Invalid checksum or missing data")
+        return fname
+
+    def _open_data(self, local_file: LocalFile) -> typing.Tuple[typing.BinaryIO, int]:
+        """ Opens a blob as stored, returning it and its length. A packed blob is read into memory with one pread of
+        its segment, which stays open across requests """
+        if not is_packed(local_file):
+            f = open(self._data_path(local_file), "rb")
+            return f, os.fstat(f.fileno()).st_size
+        data = self._read_packed(local_file)
+        return BytesIO(data), len(data)
+
+    def _read_packed(self, local_file: LocalFile) -> bytes:
+        for retry in (True, False):
+            packs, location = self._packed_location(local_file)
+            try:
+                return packs.read(*location)
+            except FileNotFoundError:
+                if not retry:  # compacted away twice in a row, or missing from disk
+                    raise falcon.HTTPNotFound(description="Invalid checksum or missing data")
+
+    def _packed_location(self, local_file: LocalFile) -> typing.Tuple[PackStore, typing.Tuple[str, int, int]]:
+        """ The store of the volume a packed blob is in, and the segment it is in and its offset and length there. Its
+        segment is looked up afresh, since it may be compacted into another at any time """
+        volume = self._volumes.get(local_file.volume.value)
+        location = None if volume is None else self._packs(volume).locate(self._db, local_file.id.value)
+        if location is None:
+            raise falcon.HTTPNotFound(description="Invalid checksum or missing data")
+        return self._packs(volume), location
+
+    def _check_checksum(self, checksum: str):
+        if not valid_checksum(self._config.digest, checksum):
+            raise falcon.HTTPBadRequest(title="Invalid checksum",
+                                        description=f"Uploads must be named by their {self._config.digest} hex digest")
+
+    def _blob_path(self, checksum: str) -> str:
+        """ Where a new blob with the given checksum is written, relative to the volume root """
+        return blob_path(self._config.layout, checksum)
+
+    def _stored_path(self, checksum: str) -> typing.Optional[str]:
+        """ The path of the blob with the given checksum if it is stored, otherwise None """
+        local_file = self._find_local_file(checksum)
+        return None if local_file is None else self._locate(local_file)
+
+    def _attach_existing(self, file: File, checksum: str) -> bool:
+        """ Attaches the blob with the given checksum to file if it is already stored. Returns whether it was """
+        if self._stored_path(checksum) is None:
+            return False
+        attached = self._write(self._attach, file, checksum)
+        self._cache.files.invalidate(file.id.value)
+        return attached
+
+    def _store_local_file(self, file: File, digest: str, place=None, encoding: str = IDENTITY, size: int = 0,
+                          data: bytes = None, volume: Volume = None):
+        """ Records a written blob and attaches it to the file it was uploaded for. place, if given, moves the blob to
+        its path holding the write lock, and data, if given, is appended to a segment instead """
+        volume = volume or self._volumes.place(digest)
+        self._write(self._record_local_file, file, digest, place, encoding, size, data, volume)
+        self._cache.files.invalidate(file.id.value)
+
+    def _record_local_file(self, file: File, digest: str, place, encoding: str, size: int, data: typing.Optional[bytes],
+                           volume: Volume):
+        path = self._blob_path(digest)
+        cursor = self._db.cursor()
+        if data is not None:
+            path, packed = self._packs(volume).append(self._db, digest, data)
+            stmt, params = packed.insert_statement(packed.id, packed.segment_id, packed.offset, packed.length,
+                                                   replace=True)
+            cursor.execute(stmt, params)
+        else:
+            if place is not None:
+                place(join(volume.root, path))
+            cursor.execute(PackedBlob.delete_statement(PackedBlob.id), [digest])
+        local_file = LocalFile(id=digest, path=path, encoding=encoding, size=size, volume=volume.id)
+        # the same blob may have been stored by a concurrent upload, or be recorded but have gone missing from disk
+        stmt, params = local_file.insert_statement(local_file.id, local_file.path, local_file.encoding,
+                                                   local_file.size, local_file.volume, ignore=True)
+        cursor.execute(stmt, params)
+        cursor.execute(RECORD_BLOB, [path, encoding, size, volume.id, digest])
+        self._attach(file, digest)
+
+    def _attach(self, file: File, digest: str) -> bool:
+        """ Points file at the blob with the given digest, marking it no longer pending, unless the blob's local_file
+        was collected meanwhile. Returns whether it was attached. The triggers on file keep the blob's refs count """
+        cursor = self._db.cursor()
+        r = cursor.execute(ATTACH_BLOB, [digest, file.id.value, digest])
+        return r.rowcount == 1
+
+    def _page(self, model, key: Field, field: Field, value, after, limit: int):
+        """ Fetches up to limit rows of model ordered by key after the cursor (optionally only those where
+        field = value). Returns the rows as dicts, and the cursor of the next page or None if this is the last """
+        stmt = model.page_statement(key, field, after=after is not None, limit=True)
+        params = []
+        if field is not None:
+            params.append(value)
+        if after is not None:
+            params.append(after)
+        # fetch one extra row to find out whether there is a next page without a COUNT
+        params.append(limit + 1)
+        cursor = self._db.cursor()
+        rows = cursor.execute(stmt, params).fetchall()
+        next = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next = rows[-1][model.cols().index(key.name)]
+        return [model.dict_from_db_row(row) for row in rows], next
+
+    def _list(self, req: falcon.Request, resp: falcon.Response, model, key: Field, field: Field=None, value=None):
+        """ Lists rows of model ordered by key (optionally only those where field = value). Either responds with one
+        page of rows after the ?after= cursor, setting the X-Next-Cursor header if more remain, or, when ?stream= is
+        given, writes rows straight from the database cursor to the response body """
+        limit, after, stream = page_params(req, key.type)
+        if stream is None:
+            rows, next = self._page(model, key, field, value, after, limit)
+            if next is not None:
+                resp.set_header("X-Next-Cursor", str(next))
+            resp.media = rows
+            return
+        stmt = model.page_statement(key, field, after=after is not None, limit=limit is not None)
+        params = []
+        if field is not None:
+            params.append(value)
+        if after is not None:
+            params.append(after)
+        if limit is not None:
+            params.append(limit)
+        cursor = self._db.cursor()
+        rows = cursor.execute(stmt, params)
+        resp.content_type = STREAM_FORMATS[stream]
+        resp.stream = stream_rows(map(model.dict_from_db_row, rows), stream)
@@ -0,0 +1,443 @@
+import os
+import selectors
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from wsgiref import simple_server, util
+
+
+# Bytes of an unread request body we'll read and throw away to keep a connection alive, rather than closing it
+DRAIN_LIMIT = 64 * 1024
+# Socket timeout while a request is being read or its response written, distinct from the keep-alive idle timeout
+REQUEST_TIMEOUT = 60
+# How often, in seconds, an idle kept-alive connection checks whether other connections are waiting for its thread
+IDLE_POLL_INTERVAL = 0.1
+# The smallest reads used to send a wsgi.file_wrapper body that can't be sent with sendfile
+FILE_BLOCK_SIZE = 256 * 1024
+
+
+class RequestBody:
+    """ wsgi.input limited to the request's Content-Length, so a responder can never read into the next request on a
+    kept-alive connection, and whatever it leaves unread can be drained afterwards """
+
+    def __init__(self, rfile, length: int, on_first_read=None):
+        """ on_first_read, if given, is called before the body is first read from, e.g. to send a 100 Continue """
+        self._rfile = rfile
+        self.remaining = length
+        self._on_first_read = on_first_read
+
+    @property
+    def waiting(self) -> bool:
+        """ Whether the client is still waiting to be told to send the body """
+        return self._on_first_read is not None and self.remaining > 0
+
+    def _start(self):
+        if self._on_first_read is not None:
+            self._on_first_read()
+            self._on_first_read = None
+
+    def read(self, size=-1):
+        self._start()
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.read(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def readinto(self, buffer):
+        self._start()
+        view = memoryview(buffer)[:self.remaining]
+        count = self._rfile.readinto(view) if len(view) else 0
+        self.remaining -= count
+        return count
+
+    def readline(self, size=-1):
+        self._start()
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        line = self._rfile.readline(size) if size else b""
+        self.remaining -= len(line)
+        return line
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b""))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def drain(self, limit: int) -> bool:
+        """ Reads and discards the rest of the body if it is no more than limit bytes. Returns whether the body was
+        fully consumed """
+        if self.remaining > limit:
+            return False
+        while self.remaining:
+            if not self.read(min(self.remaining, 8192)):
+                return False
+        return True
+
+
+class FileWrapper(util.FileWrapper):
+    """ wsgi.file_wrapper, reading in blocks of at least FILE_BLOCK_SIZE when iterated, whatever the app asks for """
+
+    def __init__(self, filelike, blksize: int = 8192):
+        super().__init__(filelike, max(blksize, FILE_BLOCK_SIZE))
+
+
+class ServerHandler(simple_server.ServerHandler):
+    """ Responds with HTTP/1.1, telling the client whether the connection will stay open for another request. Files
+    the app returns through wsgi.file_wrapper are sent with sendfile, so their data never passes through userspace """
+
+    http_version = "1.1"
+    wsgi_file_wrapper = FileWrapper
+
+    def sendfile(self):
+        """ Sends the Content-Length bytes from the wrapped file's current position straight from the page cache. A
+        whole blob and a FileRange of one both start at their current position """
+        handler = self.request_handler
+        length = self.headers.get("Content-Length")
+        if not handler.server.sendfile or length is None:
+            return False
+        filelike = self.result.filelike
+        try:
+            filelike.fileno()
+            offset = filelike.tell()
+        except (AttributeError, OSError, ValueError):  # not backed by a file descriptor
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        # socket.sendfile copes with the socket's timeout, unlike a bare os.sendfile
+        sent = handler.connection.sendfile(filelike, offset, int(length))
+        self.bytes_sent += sent
+        if sent < int(length):
+            # the file was truncated under us, so the client has been promised bytes it'll never get
+            handler.close_connection = True
+        return True
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        handler = self.request_handler
+        if "Content-Length" not in self.headers and not self.status.startswith(("1", "204", "304")):
+            # without a length, the end of the body can only be signalled by closing the connection
+            handler.close_connection = True
+        if handler.body.remaining > DRAIN_LIMIT or handler.body.waiting:
+            # the client may or may not send a body it was never asked for, so the connection can't be reused
+            handler.close_connection = True
+        if handler.close_connection:
+            self.headers["Connection"] = "close"
+
+
+class RequestHandler(simple_server.WSGIRequestHandler):
+    """ wsgiref's request handler, extended to serve up to server.keep_alive requests per connection """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, so with Nagle's algorithm the body of a small response waits for the
+    # client's delayed ACK of the headers
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.served = 0
+        self.body = None
+        self.expect_continue = False
+
+    def handle_expect_100(self):
+        """ Defers the 100 Continue until the app first reads the body, so a responder can give a final response
+        without the client ever sending it, e.g. when an uploaded blob is already stored """
+        self.expect_continue = True
+        return True
+
+    def send_continue(self):
+        self.send_response_only(HTTPStatus.CONTINUE)
+        self.end_headers()
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def wait_for_request(self) -> bool:
+        """ Waits up to server.keep_alive_timeout seconds for the client to start sending a request, and returns
+        whether it has. A kept-alive connection stops waiting early once other connections are queued for a thread, so
+        idle clients can't keep the server's threads from busy ones """
+        deadline = time.monotonic() + self.server.keep_alive_timeout
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):  # already received, e.g. pipelined behind the last request
+                return True
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.connection, selectors.EVENT_READ)
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (self.served and self.server.saturated):
+                        return False
+                    if selector.select(min(remaining, IDLE_POLL_INTERVAL)):
+                        return bool(self.rfile.peek(1))  # readable with nothing to read means closed
+        except OSError:  # the client went away
+            return False
+
+    def handle_one_request(self):
+        if not self.wait_for_request():
+            self.close_connection = True
+            return
+        self.connection.settimeout(REQUEST_TIMEOUT)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except OSError:  # the client stopped sending, or went away
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+        self.expect_continue = False
+        if not self.parse_request():  # An error code has been sent, just exit
+            self.close_connection = True
+            return
+        self.served += 1
+        if self.request_version != "HTTP/1.1" or self.served >= self.server.keep_alive or self.server.saturated:
+            self.close_connection = True
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            # wsgiref can't decode chunked bodies, so there's no telling where the next request starts
+            self.close_connection = True
+        environ = self.get_environ()
+        self.body = RequestBody(self.rfile, int(environ.get("CONTENT_LENGTH") or 0),
+                                self.send_continue if self.expect_continue else None)
+        handler = ServerHandler(
+            self.body, self.wfile, self.get_stderr(), environ,
+            multithread=self.server.multithread, multiprocess=self.server.multiprocess
+        )
+        handler.request_handler = self  # backpointer for logging and connection handling
+        handler.run(self.server.get_app())
+        if not self.close_connection and (self.body.waiting or not self.body.drain(DRAIN_LIMIT)):
+            self.close_connection = True
+
+
+class WSGIServer(simple_server.WSGIServer):
+    """ wsgiref's WSGI server, handing each connection to a fixed pool of worker threads. Worker threads live as long
+    as the server, so each keeps its own database connection for its lifetime. With threads=0, connections are
+    handled one at a time on the thread calling serve_forever.
+
+    A connection holds its thread while it is kept alive, so while connections are queued waiting for a thread, kept
+    alive ones are closed after their response, or as soon as they are idle, rather than waiting for another request.
+    Any connection is closed once idle for keep_alive_timeout seconds, including before its first request """
+
+    multiprocess = False
+
+    def __init__(self, address, threads: int = 0, backlog: int = 128, keep_alive: int = 100,
+                 keep_alive_timeout: float = 5.0, sendfile: bool = True):
+        """ sendfile=False sends files by reading them through userspace instead, e.g. to compare the two """
+        self.request_queue_size = backlog
+        self.sendfile = sendfile and hasattr(os, "sendfile")
+        self.threads = threads
+        self.keep_alive = max(keep_alive, 1)
+        self.keep_alive_timeout = keep_alive_timeout
+        self._executor = None
+        self._queued = 0  # connections submitted to the pool which no thread has picked up yet
+        self._queued_lock = threading.Lock()
+        super().__init__(address, RequestHandler)
+
+    @property
+    def multithread(self):
+        return self.threads > 1
+
+    @property
+    def saturated(self) -> bool:
+        """ Whether connections are waiting for a thread to handle them """
+        return self._queued > 0
+
+    def process_request(self, request, client_address):
+        if not self.threads:
+            return super().process_request(request, client_address)
+        if self._executor is None:  # created lazily, so no threads exist yet if the process forks after binding
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix="nimbus-worker")
+        with self._queued_lock:
+            self._queued += 1
+        self._executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        with self._queued_lock:
+            self._queued -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        """ Stops listening, then waits for requests already in progress to finish """
+        super().server_close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+class Arbiter:
+    """ Runs a pre-forked pool of worker processes which all accept connections from one listening socket. The app is
+    built by make_app in each worker after the fork, so every worker opens its own database connections.
+
+    The arbiter restarts workers that die. SIGHUP gracefully reloads: a fresh set of workers is started, and the old
+    ones stop accepting connections and exit once their in-flight requests are done. SIGTERM or SIGINT shut down all
+    workers gracefully, killing any still running after graceful_timeout seconds.
+
+    background, if given, is called in one worker of each generation to get the background services it also runs, so
+    they run once rather than once per worker, and like the app are only made after the fork """
+
+    def __init__(self, server: WSGIServer, make_app, workers: int, graceful_timeout: float = 30, background=None):
+        self._server = server
+        self._server.multiprocess = workers > 1
+        self._make_app = make_app
+        self._background = background
+        self._count = workers
+        self._graceful_timeout = graceful_timeout
+        self._workers = {}  # pid -> (generation, whether it runs the background services)
+        self._generation = 0
+        self._reload = False
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        while not self._stopping:
+            self._reap()
+            if self._reload:
+                self._reload = False
+                self._generation += 1
+                self._signal_workers(signal.SIGTERM)
+            current = [background for gen, background in self._workers.values() if gen == self._generation]
+            for i in range(self._count - len(current)):
+                self._spawn(self._background is not None and not any(current) and i == 0)
+            time.sleep(0.5)
+        self._stop()
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _signal_workers(self, signum):
+        """ Signals every worker that isn't part of the current generation """
+        for pid, (gen, _) in list(self._workers.items()):
+            if gen != self._generation or self._stopping:
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    self._workers.pop(pid, None)
+
+    def _reap(self):
+        while self._workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._workers.clear()
+                return
+            if pid == 0:
+                return
+            self._workers.pop(pid, None)
+
+    def _stop(self):
+        self._signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + self._graceful_timeout
+        while self._workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        self._signal_workers(signal.SIGKILL)
+        self._reap()
+        self._server.server_close()
+
+    def _spawn(self, background: bool = False):
+        pid = os.fork()
+        if pid != 0:
+            self._workers[pid] = (self._generation, background)
+            return
+        status = 0
+        try:
+            self._work(background)
+        except BaseException:
+            status = 1
+            sys.excepthook(*sys.exc_info())
+        finally:
+            os._exit(status)
+
+    def _work(self, background: bool):
+        """ The body of a worker process """
+        def stop(signum, frame):
+            # shutdown() blocks until serve_forever returns, so it can't run on the thread serving
+            threading.Thread(target=self._server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self._server.set_app(self._make_app())
+        services = start_services(self._background if background else None)
+        try:
+            self._server.serve_forever()
+        finally:
+            stop_services(services)
+        self._server.server_close()
+
+
+def start_services(background) -> list:
+    """ Starts the threads the background callable returns, if there is one """
+    services = list(background()) if background is not None else []
+    for service in services:
+        service.start()
+    return services
+
+
+def stop_services(services: list):
+    for service in services:
+        service.stop()
+
+
+def serve(make_app, mode: str = "simple", host: str = "0.0.0.0", port: int = 4242, workers: int = 1,
+          threads: int = 8, backlog: int = 128, keep_alive: int = 100, keep_alive_timeout: float = 5.0,
+          background=None):
+    """ Serves the app returned by make_app until stopped. mode is one of:
+     - simple: one request at a time
+     - threaded: a pool of threads threads in this process
+     - prefork: workers processes, each with a pool of threads threads
+     - asgi: make_app returns an ASGI app, served by uvicorn on one event loop
+
+    background, if given, returns the background services to run alongside, e.g. those of background_services. They
+    are started once, in this process or in prefork mode in one of the workers, and stopped with the server """
+    if mode == "asgi":
+        try:
+            import uvicorn
+        except ImportError:
+            raise RuntimeError("Serving the ASGI app requires uvicorn to be installed")
+        app = make_app()
+        services = start_services(background)
+        try:
+            uvicorn.run(app, host=host, port=port, backlog=backlog, timeout_keep_alive=int(keep_alive_timeout))
+        finally:
+            stop_services(services)
+        return
+    if mode == "simple":
+        # an idle kept-alive connection would block every other client
+        threads, keep_alive = 0, 1
+    server = WSGIServer((host, port), threads=threads, backlog=backlog, keep_alive=keep_alive,
+                        keep_alive_timeout=keep_alive_timeout)
+    if mode == "prefork":
+        Arbiter(server, make_app, workers, background=background).run()
+        return
+    server.set_app(make_app())
+    services = start_services(background)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_services(services)
+        server.server_close()
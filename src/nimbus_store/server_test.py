@@ -0,0 +1,246 @@
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from tempfile import TemporaryFile, mkdtemp
+from .ranges import FileRange
+from .server import WSGIServer
+
+
+def app(environ, start_response):
+    body = environ["wsgi.input"].read()
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body) + 2))])
+    return [b"ok" + body]
+
+
+def unread_app(environ, start_response):
+    start_response("204 No Content", [])
+    return []
+
+
+def file_app(environ, start_response):
+    f = TemporaryFile()
+    f.write(bytes(range(256)) * 4096)
+    f.seek(0)
+    first, _, last = environ.get("QUERY_STRING", "").partition("-")
+    body = FileRange(f, int(first), int(last) - int(first) + 1) if first else f
+    start_response("200 OK", [("Content-Length", str(int(last) - int(first) + 1 if first else 256 * 4096))])
+    return environ["wsgi.file_wrapper"](body, 8192)
+
+
+def serve(app, **kwargs):
+    server = WSGIServer(("127.0.0.1", 0), threads=2, **kwargs)
+    server.set_app(app)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_keep_alive():
+    server = serve(app, keep_alive=3)
+    try:
+        conn = http.client.HTTPConnection(*server.server_address)
+        for i in range(3):
+            conn.request("POST", "/", body=b"abc")
+            resp = conn.getresponse()
+            assert resp.read() == b"okabc"
+            if i < 2:
+                assert resp.getheader("Connection") is None
+        # the keep-alive cap was reached, so the server closes after the third response
+        assert resp.getheader("Connection") == "close"
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_unread_body_is_drained():
+    server = serve(unread_app)
+    try:
+        conn = http.client.HTTPConnection(*server.server_address)
+        for _ in range(2):
+            conn.request("POST", "/", body=b"x" * 1024)
+            resp = conn.getresponse()
+            resp.read()
+            assert resp.status == 204
+            assert resp.getheader("Connection") is None
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_expect_continue_deferred():
+    server = serve(unread_app)
+    try:
+        sock = socket.create_connection(server.server_address)
+        sock.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 1048576\r\nExpect: 100-continue\r\n\r\n")
+        resp = sock.makefile("rb").read()
+        # the app answered without reading the body, so no 100 Continue was sent and the connection is closed
+        assert resp.startswith(b"HTTP/1.1 204")
+        assert b"Connection: close" in resp
+        sock.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_expect_continue_on_read():
+    server = serve(app)
+    try:
+        sock = socket.create_connection(server.server_address)
+        sock.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 3\r\nExpect: 100-continue\r\n"
+                     b"Connection: close\r\n\r\n")
+        stream = sock.makefile("rb")
+        assert stream.readline() == b"HTTP/1.1 100 Continue\r\n"
+        assert stream.readline() == b"\r\n"
+        sock.sendall(b"abc")
+        resp = stream.read()
+        assert resp.startswith(b"HTTP/1.1 200")
+        assert resp.endswith(b"okabc")
+        sock.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_file_wrapper():
+    expected = bytes(range(256)) * 4096
+    for sendfile in (True, False):
+        server = serve(file_app, sendfile=sendfile)
+        try:
+            conn = http.client.HTTPConnection(*server.server_address)
+            conn.request("GET", "/")
+            assert conn.getresponse().read() == expected
+            # the connection is still in step after a body sent around userspace
+            conn.request("GET", "/?1000-300000")
+            assert conn.getresponse().read() == expected[1000:300001]
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_idle_connections_yield_threads():
+    server = serve(app, keep_alive_timeout=30)
+    try:
+        idle = [http.client.HTTPConnection(*server.server_address) for _ in range(2)]
+        for conn in idle:
+            conn.request("POST", "/", body=b"")
+            assert conn.getresponse().read() == b"ok"
+        # both threads are held by idle kept-alive connections, which give them up to the one waiting
+        start = time.monotonic()
+        conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+        conn.request("POST", "/", body=b"abc")
+        assert conn.getresponse().read() == b"okabc"
+        assert time.monotonic() - start < 5
+        conn.close()
+        for conn in idle:
+            conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_idle_timeout_before_first_request():
+    server = serve(app, keep_alive_timeout=0.2)
+    try:
+        sock = socket.create_connection(server.server_address, timeout=5)
+        assert sock.recv(1) == b""  # closed without a request ever being sent
+        sock.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+ARBITER = """
+import os, sys
+from os.path import join
+from {package}.background import Periodic
+from {package}.server import Arbiter, WSGIServer
+
+def make_app():
+    open(join(sys.argv[1], f"worker-{{os.getpid()}}"), "w").close()
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Length", str(len(str(os.getpid()))))])
+        return [str(os.getpid()).encode()]
+    return app
+
+def background():
+    open(join(sys.argv[1], f"background-{{os.getpid()}}"), "w").close()
+    return [Periodic(3600, lambda: None)]
+
+server = WSGIServer(("127.0.0.1", 0), threads=2, keep_alive=1)
+print(server.server_address[1], flush=True)
+Arbiter(server, make_app, 2, graceful_timeout=5, background=background).run()
+"""
+
+
+def started(directory: str, kind: str, count: int) -> list:
+    """ The pids of the workers which have started kind, once at least count have """
+    deadline = time.monotonic() + 10
+    while True:
+        pids = sorted(int(name.split("-")[1]) for name in os.listdir(directory) if name.startswith(kind))
+        if len(pids) >= count or time.monotonic() > deadline:
+            return pids
+        time.sleep(0.05)
+
+
+def exited(pid: int) -> bool:
+    """ Whether the worker has exited and been reaped by the arbiter """
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def get_pid(port: int) -> int:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", "/")
+    pid = int(conn.getresponse().read())
+    conn.close()
+    return pid
+
+
+def test_arbiter():
+    directory = mkdtemp()
+    arbiter = subprocess.Popen([sys.executable, "-c", ARBITER.format(package=__package__), directory],
+                               stdout=subprocess.PIPE, env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+    try:
+        port = int(arbiter.stdout.readline())
+        workers = started(directory, "worker", 2)
+        background = started(directory, "background", 1)
+        assert len(workers) == 2 and len(background) == 1 and background[0] in workers
+        assert get_pid(port) in workers
+
+        # a worker that dies is replaced, and the background services move to its replacement
+        os.kill(background[0], signal.SIGKILL)
+        replaced = started(directory, "worker", 3)
+        assert len(replaced) == 3 and exited(background[0])
+        assert started(directory, "background", 2) == sorted(background + list(set(replaced) - set(workers)))
+        live = set(replaced) - set(background)
+        assert get_pid(port) in live
+
+        # SIGHUP starts a fresh set of workers, and the old ones exit
+        arbiter.send_signal(signal.SIGHUP)
+        reloaded = started(directory, "worker", 5)
+        assert len(reloaded) == 5 and all(exited(pid) for pid in live)
+        assert len(started(directory, "background", 3)) == 3
+        assert get_pid(port) in set(reloaded) - set(replaced)
+
+        # SIGTERM stops them all, then the arbiter
+        arbiter.send_signal(signal.SIGTERM)
+        assert arbiter.wait(timeout=10) == 0
+        assert all(exited(pid) for pid in reloaded)
+    finally:
+        if arbiter.poll() is None:
+            arbiter.kill()
+            arbiter.wait()
+        arbiter.stdout.close()
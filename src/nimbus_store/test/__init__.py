@@ -2,16 +2,26 @@ import pytest
 from falcon import testing
 from os.path import join, dirname
 from .. import API
-from sqlite3 import connect
+from ..db import ConnectionPool
 from tempfile import mkdtemp
-from migrate import Migration
+from ..migrations import Migration
 
 
-db = connect(":memory:")
-tempd = mkdtemp()
-app = API(db, tempd)
 migration_dir = join(dirname(__file__), "../../../db/sqlite/migrations")
-Migration(migration_dir, db)()
+
+
+def migrated_pool() -> ConnectionPool:
+    """ A pool of connections to a new, migrated database in a temporary file. Every connection of it sees the same
+    database, unlike those of ":memory:", which each get an empty one of their own """
+    pool = ConnectionPool(join(mkdtemp(), "nimbus.db"))
+    Migration(migration_dir, pool.connection())()
+    return pool
+
+
+pool = migrated_pool()
+db = pool.connection()
+tempd = mkdtemp()
+app = API(pool, tempd)
 
 headers_json = {"content-type": "application/json"}
 headers_binary = {"content-type": "application/octet-stream"}
@@ -0,0 +1,471 @@
+import falcon
+import os
+import threading
+import time
+import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from inspect import iscoroutinefunction
+from os.path import dirname, exists, join
+from uuid import uuid4
+from .background import Periodic
+from .buckets import validate_bucket
+from .config import Config
+from .db import ConnectionPool
+from .files import validate_file
+from .ingest import DIGESTS, IngestError, Writer, fsync, fsync_dir
+from .models.file import File
+from .models.upload import Upload, UploadPart
+from .resource import ApiResource
+from .util import require
+from .volumes import Volume, Volumes
+
+
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+MIN_PART_SIZE = 64 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+# How often abandoned uploads are looked for, at most
+EXPIRY_INTERVAL = 600
+# The most threads per process hashing parts which arrived before the parts preceding them
+HASH_THREADS = 4
+# The uploads which haven't received a part since a time relative to now, e.g. '-3600 seconds'
+EXPIRED_UPLOADS = f"SELECT [{Upload.id.name}] FROM [{Upload.table_name}] " \
+                  f"WHERE [{Upload.last_updated.name}] < datetime('now', ?)"
+# Records that an upload has just received a part
+TOUCH_UPLOAD = f"UPDATE [{Upload.table_name}] SET [{Upload.last_updated.name}]=CURRENT_TIMESTAMP " \
+               f"WHERE [{Upload.id.name}]=?"
+# The parts an upload has received, in order
+UPLOAD_PARTS = f"{UploadPart.find_statement(UploadPart.upload_id)} ORDER BY [{UploadPart.number.name}]"
+# Counts an attempt at sending a part of an upload
+COUNT_ATTEMPT = f"UPDATE [{Upload.table_name}] SET [{Upload.attempts.name}] = [{Upload.attempts.name}] + 1 " \
+                f"WHERE [{Upload.id.name}] = ?"
+# Records a part an upload has received, or replaces it when sent again, unless the upload has expired meanwhile
+RECORD_PART = f"INSERT OR REPLACE INTO [{UploadPart.table_name}] ([{UploadPart.upload_id.name}], " \
+              f"[{UploadPart.number.name}], [{UploadPart.size.name}], [{UploadPart.attempt.name}]) " \
+              f"SELECT [{Upload.id.name}], ?, ?, ? FROM [{Upload.table_name}] WHERE [{Upload.id.name}] = ?"
+
+
+def upload_path(root: str, upload_id: str) -> str:
+    """ The file in the volume an upload's parts are written into """
+    return join(root, f".upload-{upload_id}")
+
+
+def hash_range(path: str, offset: int, length: int, hash, buffer_size: int = 1 << 20):
+    """ Feeds length bytes of the file at path, from offset, to hash """
+    buffer = memoryview(bytearray(min(buffer_size, length) or 1))
+    with open(path, "rb", buffering=0) as f:
+        f.seek(offset)
+        while length:
+            count = f.readinto(buffer[:min(len(buffer), length)])
+            if not count:
+                raise IngestError(f"Upload data ended {length} bytes short")
+            hash.update(buffer[:count])
+            length -= count
+
+
+class RunningHash:
+    """ The digest of an upload's first parts, hashed as they arrive so completing the upload needn't read them back """
+
+    def __init__(self, digest: str):
+        self.hash = DIGESTS[digest]()
+        self.parts = 0  # the number of parts hashed
+        self.attempts = []  # the attempt each part hashed was sent in
+        self.received = {}  # part number -> (size, attempt), of the parts known to have been received
+        self.used = time.monotonic()
+        self._saved = None
+        self._lock = threading.Lock()
+
+    def claim(self, number: int) -> bool:
+        """ Takes the hash to carry on through part number, if it is the next part. Must be followed by release """
+        if not self._lock.acquire(blocking=False):
+            return False
+        if self.parts == number - 1:
+            self._saved = self.hash.copy()
+            return True
+        self._lock.release()
+        return False
+
+    def release(self, number: int, attempt: int, ok: bool):
+        """ Gives the hash back after part number was written in attempt, or failed to be """
+        if ok:
+            self.parts = number
+            self.attempts.append(attempt)
+        else:
+            self.hash = self._saved
+        self._saved = None
+        self._lock.release()
+
+    def catch_up(self, path: str, part_size: int, buffer_size: int, wait: bool = True):
+        """ Hashes the parts received since the last hashed one, until the first gap """
+        if not self._lock.acquire(blocking=wait):
+            return
+        try:
+            while self.parts + 1 in self.received:
+                size, attempt = self.received[self.parts + 1]
+                hash = self.hash.copy()
+                hash_range(path, self.parts * part_size, size, hash, buffer_size)
+                self.hash = hash
+                self.parts += 1
+                self.attempts.append(attempt)
+        except (OSError, IngestError):
+            pass  # the upload was completed or aborted meanwhile
+        finally:
+            self._lock.release()
+
+    def digest(self, parts: typing.List[UploadPart], attempts: int) -> typing.Optional[str]:
+        """ The digest of the parts, if just they were hashed, as sent in the attempts they record, and none since """
+        with self._lock:
+            if self.attempts != [part.attempt.value for part in parts] or max(self.attempts, default=0) != attempts:
+                return None
+            return self.hash.hexdigest()
+
+
+_running = OrderedDict()  # upload id -> RunningHash, least recently used first
+_running_lock = threading.Lock()
+
+
+def running_hash(upload_id: str, config: Config) -> RunningHash:
+    """ The upload's running hash in this process, dropping those unused for longer than config.upload_ttl """
+    now = time.monotonic()
+    with _running_lock:
+        while _running and next(iter(_running.values())).used < now - config.upload_ttl:
+            _running.popitem(last=False)
+        running = _running.get(upload_id)
+        if running is None:
+            running = _running[upload_id] = RunningHash(config.digest)
+        _running.move_to_end(upload_id)
+        running.used = now
+        return running
+
+
+def forget(upload_id: str):
+    with _running_lock:
+        _running.pop(upload_id, None)
+
+
+_hashers: typing.Optional[ThreadPoolExecutor] = None
+
+
+def hashers() -> ThreadPoolExecutor:
+    """ The threads which catch running hashes up, created on first use """
+    global _hashers
+    with _running_lock:
+        if _hashers is None:
+            _hashers = ThreadPoolExecutor(HASH_THREADS, thread_name_prefix="nimbus-hash")
+        return _hashers
+
+
+class PartIngest(Writer):
+    """ Writes one part of an upload to its place in the upload's file """
+
+    def __init__(self, path: str, part_size: int, number: int, attempt: int, running: RunningHash, buffer_size: int):
+        fd = os.open(path, os.O_WRONLY)
+        self._running = running if running.claim(number) else None
+        super().__init__(fd, (number - 1) * part_size, None if self._running is None else running.hash, buffer_size)
+        self._number = number
+        self._attempt = attempt
+        self._ok = False
+
+    def finish(self):
+        """ Flushes the part to disk """
+        self._wait()
+        fsync(self._fd)
+        self._ok = True
+
+    def close(self):
+        try:
+            self._wait()
+        except OSError:
+            pass
+        os.close(self._fd)
+        if self._running is not None:
+            self._running.release(self._number, self._attempt, self._ok)
+            self._running = None
+
+
+def find_upload(resource: ApiResource, file: File, id: str) -> Upload:
+    cursor = resource._db.cursor()
+    row = cursor.execute(Upload.find_by_id_statement(), [id]).fetchone()
+    upload = None if row is None else Upload.from_db_row(row)
+    if upload is None or upload.file_id.value != file.id.value:
+        raise falcon.HTTPNotFound(description=f"No upload with id '{id}' found")
+    return upload
+
+
+def validate_upload(next):
+    if iscoroutinefunction(next):
+        async def f(self, req: falcon.Request, resp: falcon.Response, upload: str, **kwargs):
+            req.context.upload = await self._run(find_upload, self, req.context.file, upload)
+            await next(self, req, resp, **kwargs)
+        return f
+
+    def f(self, req: falcon.Request, resp: falcon.Response, upload: str, **kwargs):
+        req.context.upload = find_upload(self, req.context.file, upload)
+        next(self, req, resp, **kwargs)
+    return f
+
+
+def expire_uploads(db: ConnectionPool, volumes: typing.Union[str, Volumes], ttl: float) -> int:
+    """ Deletes the uploads which haven't received a part in ttl seconds. Returns how many there were """
+    volumes = Volumes.of(volumes)
+    conn = db.connection()
+    cursor = conn.cursor()
+    rows = cursor.execute(EXPIRED_UPLOADS, [f"-{int(ttl)} seconds"])
+    expired = [id for id, in rows.fetchall()]
+    for id in expired:
+        cursor.execute(UploadPart.delete_statement(UploadPart.upload_id), [id])
+        cursor.execute(Upload.delete_statement(Upload.id), [id])
+        conn.commit()
+        forget(id)
+        for volume in volumes:
+            try:
+                os.remove(upload_path(volume.root, id))
+            except FileNotFoundError:
+                pass
+    return len(expired)
+
+
+def upload_expiry(db: ConnectionPool, volumes: typing.Union[str, Volumes], config: Config) -> Periodic:
+    """ A thread which expires abandoned uploads, to be started by the app """
+    volumes = Volumes.of(volumes)
+    return Periodic(min(config.upload_ttl, EXPIRY_INTERVAL),
+                    lambda: expire_uploads(db, volumes, config.upload_ttl), name="nimbus-upload-expiry")
+
+
+class UploadsResource(ApiResource):
+    """ Shared by the multipart upload resources """
+
+    def _upload_path(self, upload: Upload) -> str:
+        return upload_path(self._upload_volume(upload).root, upload.id.value)
+
+    def _upload_volume(self, upload: Upload) -> Volume:
+        """ The volume an upload's file is in, and so its blob too """
+        placed = self._volumes.place(upload.id.value)
+        for volume in [placed] + [each for each in self._volumes if each is not placed]:
+            if exists(upload_path(volume.root, upload.id.value)):
+                return volume
+        return placed
+
+    def _running(self, upload: Upload) -> RunningHash:
+        return running_hash(upload.id.value, self._config)
+
+    def _parts(self, upload: Upload) -> typing.List[UploadPart]:
+        cursor = self._db.cursor()
+        rows = cursor.execute(UPLOAD_PARTS, [upload.id.value])
+        return [UploadPart.from_db_row(row) for row in rows.fetchall()]
+
+    def _delete_upload(self, upload: Upload):
+        self._write(self._delete_upload_rows, upload)
+        forget(upload.id.value)
+
+    def _delete_upload_rows(self, upload: Upload):
+        cursor = self._db.cursor()
+        cursor.execute(UploadPart.delete_statement(UploadPart.upload_id), [upload.id.value])
+        r = cursor.execute(Upload.delete_statement(Upload.id), [upload.id.value])
+        if r.rowcount != 1:
+            raise falcon.HTTPConflict(description="The upload was already completed or aborted")
+
+
+class UploadCollectionResource(UploadsResource):
+    """ Starts multipart uploads of a file's data, for large blobs which are better sent in parts """
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        """ Starts an upload. The body may give the part_size every part but the last must be """
+        upload = self._create_upload(req.context.file, (req.get_media(default_when_empty={}) or {}))
+        resp.status = falcon.HTTP_201
+        resp.media = upload.to_dict()
+
+    def _create_upload(self, file: File, body: dict) -> Upload:
+        part_size = body.get("part_size", DEFAULT_PART_SIZE)
+        if not isinstance(part_size, int) or not MIN_PART_SIZE <= part_size <= MAX_PART_SIZE:
+            raise falcon.HTTPBadRequest(title="Invalid part size",
+                                        description=f"part_size must be from {MIN_PART_SIZE} to {MAX_PART_SIZE}")
+        upload = Upload(id=str(uuid4()), file_id=file.id.value, part_size=part_size)
+        path = self._upload_path(upload)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        os.close(fd)
+        fsync_dir(dirname(path))
+        try:
+            self._write(self._execute, *upload.insert_statement(upload.id, upload.file_id))
+        except BaseException:
+            os.remove(path)
+            raise
+        row = self._db.cursor().execute(Upload.find_by_id_statement(), [upload.id.value]).fetchone()
+        return Upload.from_db_row(row)
+
+
+class UploadResource(UploadsResource):
+    """ Lists the parts an upload has received, and completes or aborts it """
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    @validate_upload
+    def on_get(self, req: falcon.Request, resp: falcon.Response):
+        resp.media = self._describe(req.context.upload)
+
+    def _describe(self, upload: Upload) -> dict:
+        parts = [{"number": part.number.value, "size": part.size.value} for part in self._parts(upload)]
+        return dict(upload.to_dict(), parts=parts)
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    @validate_upload
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        """ Completes the upload, whose parts must add up to a blob with the checksum given in the body """
+        checksum = (req.get_media(default_when_empty={}) or {}).get("checksum", "")
+        upload = req.context.upload
+        parts = self._check_parts(upload, checksum)
+        digest = self._upload_digest(upload, parts)
+        self._complete(req.context.file, upload, parts, checksum, digest)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+    @require("application/json")
+    @validate_bucket
+    @validate_file
+    @validate_upload
+    def on_delete(self, req: falcon.Request, resp: falcon.Response):
+        """ Aborts the upload, discarding its parts """
+        self._abort(req.context.upload)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+    def _check_parts(self, upload: Upload, checksum: str) -> typing.List[UploadPart]:
+        """ The upload's parts, if they make up a whole blob """
+        self._check_checksum(checksum)
+        parts = self._parts(upload)
+        if not parts:
+            raise falcon.HTTPBadRequest(title="Incomplete upload", description="No parts have been uploaded")
+        for number, part in enumerate(parts, 1):
+            if part.number.value != number:
+                raise falcon.HTTPBadRequest(title="Incomplete upload", description=f"Part {number} is missing")
+            if number < len(parts) and part.size.value != upload.part_size.value:
+                raise falcon.HTTPBadRequest(
+                    title="Incomplete upload",
+                    description=f"Part {number} is {part.size.value} bytes, but only the last part may be smaller than "
+                                f"{upload.part_size.value}"
+                )
+        return parts
+
+    def _upload_digest(self, upload: Upload, parts: typing.List[UploadPart]) -> str:
+        """ The digest of the upload's parts, from its running hash if it can be trusted """
+        path = self._upload_path(upload)
+        running = self._running(upload)
+        running.received.update((part.number.value, (part.size.value, part.attempt.value)) for part in parts)
+        running.catch_up(path, upload.part_size.value, self._config.buffer_size)
+        digest = running.digest(parts, upload.attempts.value)
+        if digest is not None:
+            return digest
+        hash = DIGESTS[self._config.digest]()
+        length = (len(parts) - 1) * upload.part_size.value + parts[-1].size.value
+        try:
+            hash_range(path, 0, length, hash, self._config.buffer_size)
+        except FileNotFoundError:
+            raise falcon.HTTPConflict(description="The upload was already completed or aborted")
+        return hash.hexdigest()
+
+    def _complete(self, file: File, upload: Upload, parts: typing.List[UploadPart], checksum: str, digest: str):
+        """ Moves the upload's data into place as the blob with the given checksum, and attaches it to file """
+        if digest != checksum:
+            raise falcon.HTTPBadRequest(title="Invalid upload",
+                                        description=f"Data has checksum {digest}, not {checksum}")
+        volume = self._upload_volume(upload)
+        path = upload_path(volume.root, upload.id.value)
+        length = (len(parts) - 1) * upload.part_size.value + parts[-1].size.value
+        try:
+            if self._attach_existing(file, checksum):
+                os.remove(path)
+            else:
+                fd = os.open(path, os.O_WRONLY)
+                try:
+                    os.ftruncate(fd, length)
+                    os.fchmod(fd, 0o644)
+                    fsync(fd)
+                finally:
+                    os.close(fd)
+                self._store_local_file(file, checksum, partial(self._place, path), size=length, volume=volume)
+        except FileNotFoundError:
+            raise falcon.HTTPConflict(description="The upload was already completed or aborted")
+        self._delete_upload(upload)
+
+    def _place(self, path: str, dest: str):
+        os.makedirs(dirname(dest), exist_ok=True)
+        os.replace(path, dest)
+        fsync_dir(dirname(dest))
+
+    def _abort(self, upload: Upload):
+        self._delete_upload(upload)
+        try:
+            os.remove(self._upload_path(upload))
+        except FileNotFoundError:
+            pass
+
+
+class UploadPartResource(UploadsResource):
+    """ Receives the parts of a multipart upload, in any order and concurrently """
+
+    @require("application/octet-stream")
+    @validate_bucket
+    @validate_file
+    @validate_upload
+    def on_put(self, req: falcon.Request, resp: falcon.Response, number: int):
+        upload = req.context.upload
+        length = self._check_part(upload, number, req.content_length)
+        attempt = self._begin_part(upload)
+        part = self._start_part(upload, number, attempt)
+        try:
+            part.readfrom(req.stream, length)
+            part.finish()
+        except IngestError as e:
+            raise falcon.HTTPBadRequest(title="Invalid upload", description=str(e))
+        finally:
+            part.close()
+        self._record_part(upload, number, length, attempt)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+    def _check_part(self, upload: Upload, number: int, length: typing.Optional[int]) -> int:
+        if not 1 <= number <= MAX_PARTS:
+            raise falcon.HTTPBadRequest(title="Invalid part", description=f"Parts are numbered from 1 to {MAX_PARTS}")
+        if length is None:
+            raise falcon.HTTPLengthRequired(description="Parts must have a Content-Length")
+        if length > upload.part_size.value:
+            raise falcon.HTTPBadRequest(title="Invalid part",
+                                        description=f"Parts can be at most {upload.part_size.value} bytes")
+        return length
+
+    def _begin_part(self, upload: Upload) -> int:
+        """ Counts an attempt at sending a part of the upload. Returns the attempt """
+        return self._write(self._count_attempt, upload)
+
+    def _count_attempt(self, upload: Upload) -> int:
+        cursor = self._db.cursor()
+        if cursor.execute(COUNT_ATTEMPT, [upload.id.value]).rowcount != 1:
+            raise falcon.HTTPConflict(description="The upload was already completed or aborted")
+        row = cursor.execute(Upload.find_by_id_statement(), [upload.id.value]).fetchone()
+        return Upload.from_db_row(row).attempts.value
+
+    def _start_part(self, upload: Upload, number: int, attempt: int) -> PartIngest:
+        try:
+            return PartIngest(self._upload_path(upload), upload.part_size.value, number, attempt,
+                              self._running(upload), self._config.buffer_size)
+        except FileNotFoundError:
+            raise falcon.HTTPConflict(description="The upload was already completed or aborted")
+
+    def _record_part(self, upload: Upload, number: int, length: int, attempt: int):
+        self._write(self._insert_part, upload, number, length, attempt)
+        running = self._running(upload)
+        running.received[number] = (length, attempt)
+        # hash any parts that were waiting on this one, while the next parts are being received
+        hashers().submit(running.catch_up, self._upload_path(upload), upload.part_size.value,
+                         self._config.buffer_size, False)
+
+    def _insert_part(self, upload: Upload, number: int, length: int, attempt: int):
+        cursor = self._db.cursor()
+        if not cursor.execute(RECORD_PART, [number, length, attempt, upload.id.value]).rowcount:
+            raise falcon.HTTPConflict(description="The upload expired while the part was sent")
+        cursor.execute(TOUCH_UPLOAD, [upload.id.value])
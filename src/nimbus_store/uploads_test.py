@@ -0,0 +1,128 @@
+import json
+import sqlite3
+from collections import OrderedDict
+from hashlib import md5
+from os import listdir
+import time
+from . import uploads
+from .config import Config
+from .test import client, db, headers_json, headers_binary, pool, tempd
+from .uploads import MIN_PART_SIZE, expire_uploads, running_hash
+
+data = bytes(range(256)) * (MIN_PART_SIZE * 5 // 2 // 256)  # two and a half parts
+
+
+def start_upload(client):
+    client.simulate_post("/buckets", body=json.dumps({"name": "uploads", "desc": ""}), headers=headers_json)
+    file = {"name": "big.bin", "mime": "application/octet-stream", "path": "a"}
+    file_id = client.simulate_post("/buckets/uploads/files", body=json.dumps(file), headers=headers_json).json["id"]
+    result = client.simulate_post(f"/buckets/uploads/files/{file_id}/uploads",
+                                  body=json.dumps({"part_size": MIN_PART_SIZE}), headers=headers_json)
+    assert result.status_code == 201
+    return f"/buckets/uploads/files/{file_id}", result.json["id"]
+
+
+def put_part(client, url, number):
+    part = data[(number - 1) * MIN_PART_SIZE:number * MIN_PART_SIZE]
+    return client.simulate_put(f"{url}/parts/{number}", body=part, headers=headers_binary)
+
+
+def test_multipart_upload(client):
+    file_url, upload_id = start_upload(client)
+    url = f"{file_url}/uploads/{upload_id}"
+    for number in (3, 1):
+        assert put_part(client, url, number).status_code == 204
+    result = client.simulate_post(url, body=json.dumps({"checksum": md5(data).hexdigest()}), headers=headers_json)
+    assert result.status_code == 400
+    assert "Part 2 is missing" in result.json["description"]
+    assert put_part(client, url, 2).status_code == 204
+    result = client.simulate_get(url, headers=headers_json)
+    assert [part["number"] for part in result.json["parts"]] == [1, 2, 3]
+    assert result.json["parts"][2]["size"] == len(data) - 2 * MIN_PART_SIZE
+    result = client.simulate_post(url, body=json.dumps({"checksum": md5(b"other").hexdigest()}), headers=headers_json)
+    assert result.status_code == 400
+    result = client.simulate_post(url, body=json.dumps({"checksum": md5(data).hexdigest()}), headers=headers_json)
+    assert result.status_code == 204
+    result = client.simulate_get(f"{file_url}/data/{md5(data).hexdigest()}")
+    assert result.content == data
+    assert client.simulate_get(url, headers=headers_json).status_code == 404
+    assert not [name for name in listdir(tempd) if name.startswith(".upload-")]
+
+
+def test_parts_hashed_as_received(client):
+    file_url, upload_id = start_upload(client)
+    url = f"{file_url}/uploads/{upload_id}"
+    for number in (1, 2, 3):
+        put_part(client, url, number)
+    # sent in order, so the whole upload was hashed on the way in
+    running = running_hash(upload_id, Config())
+    assert running.parts == 3 and running.hash.hexdigest() == md5(data).hexdigest()
+    result = client.simulate_put(f"{url}/parts/1", body=b"x" * (MIN_PART_SIZE + 1), headers=headers_binary)
+    assert result.status_code == 400
+    assert client.simulate_delete(url, headers=headers_json).status_code == 204
+    assert client.simulate_put(f"{url}/parts/1", body=b"x", headers=headers_binary).status_code == 404
+
+
+def test_expire_uploads(client):
+    file_url, upload_id = start_upload(client)
+    put_part(client, f"{file_url}/uploads/{upload_id}", 1)
+    assert expire_uploads(pool, tempd, 3600) == 0
+    db.execute("UPDATE upload SET last_updated = datetime('now', '-2 hours') WHERE id = ?", [upload_id])
+    db.commit()
+    assert expire_uploads(pool, tempd, 3600) == 1
+    assert f".upload-{upload_id}" not in listdir(tempd)
+    assert client.simulate_get(f"{file_url}/uploads/{upload_id}", headers=headers_json).status_code == 404
+
+
+def test_part_sent_again_to_another_worker(client, monkeypatch):
+    file_url, upload_id = start_upload(client)
+    url = f"{file_url}/uploads/{upload_id}"
+    for number in (1, 2, 3):
+        put_part(client, url, number)
+    with monkeypatch.context() as patch:
+        patch.setattr(uploads, "_running", OrderedDict())  # the running hashes of another worker process
+        result = client.simulate_put(f"{url}/parts/2", body=b"y" * MIN_PART_SIZE, headers=headers_binary)
+        assert result.status_code == 204
+    # this process hashed the first copy of part 2, so must hash the upload again
+    result = client.simulate_post(url, body=json.dumps({"checksum": md5(data).hexdigest()}), headers=headers_json)
+    assert result.status_code == 400
+    sent = data[:MIN_PART_SIZE] + b"y" * MIN_PART_SIZE + data[2 * MIN_PART_SIZE:]
+    result = client.simulate_post(url, body=json.dumps({"checksum": md5(sent).hexdigest()}), headers=headers_json)
+    assert result.status_code == 204
+    assert client.simulate_get(f"{file_url}/data/{md5(sent).hexdigest()}").content == sent
+
+
+def test_running_hashes_expire():
+    config = Config(upload_ttl=0.05)
+    running = running_hash("expiring", config)
+    assert running_hash("expiring", config) is running
+    time.sleep(0.1)
+    running_hash("other", config)
+    assert "expiring" not in uploads._running and "other" in uploads._running
+
+
+def test_part_sent_as_upload_expires(client, monkeypatch):
+    file_url, upload_id = start_upload(client)
+    start_part = uploads.UploadPartResource._start_part
+
+    def expiring(self, upload, number, attempt):
+        part = start_part(self, upload, number, attempt)
+        db.execute("DELETE FROM upload WHERE id = ?", [upload_id])
+        db.commit()
+        return part
+
+    monkeypatch.setattr(uploads.UploadPartResource, "_start_part", expiring)
+    assert put_part(client, f"{file_url}/uploads/{upload_id}", 1).status_code == 409
+    assert db.execute("SELECT * FROM upload_part WHERE upload_id = ?", [upload_id]).fetchall() == []
+
+
+def test_upload_file_removed_if_not_recorded(client, monkeypatch):
+    def failing(self, stmt, params):
+        raise sqlite3.OperationalError("disk I/O error")
+    file_url, _ = start_upload(client)
+    monkeypatch.setattr(uploads.UploadCollectionResource, "_execute", failing)
+    before = [name for name in listdir(tempd) if name.startswith(".upload-")]
+    result = client.simulate_post(f"{file_url}/uploads", body=json.dumps({"part_size": MIN_PART_SIZE}),
+                                  headers=headers_json)
+    assert result.status_code == 500
+    assert [name for name in listdir(tempd) if name.startswith(".upload-")] == before
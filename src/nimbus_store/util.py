@@ -1,15 +1,71 @@
 import falcon
+import json
+from inspect import iscoroutinefunction
 
 
 def require(content_type):
     """ A decorator middleware (not a falcon middleware) for enforcing required Accept and Content-Type
     headers based on a provided content-type string. e.g. @require("application/json") """
+    def check(req: falcon.Request):
+        if req.method in ("POST", "PUT") and content_type not in req.get_header("Content-Type", required=True):
+            raise falcon.HTTPUnsupportedMediaType(description=f"Only {content_type} supported")
+        if not req.client_accepts(content_type):
+            raise falcon.HTTPNotAcceptable(description=f"Must accept {content_type}")
+
     def decorator(next):
+        if iscoroutinefunction(next):
+            async def f(self, req: falcon.Request, resp: falcon.Response, **kwargs):
+                check(req)
+                await next(self, req, resp, **kwargs)
+            return f
+
         def f(self, req: falcon.Request, resp: falcon.Response, **kwargs):
-            if req.method in ("POST", "PUT") and content_type not in req.get_header("Content-Type", required=True):
-                raise falcon.HTTPUnsupportedMediaType(f"Only {content_type} supported")
-            if not req.client_accepts(content_type):
-                raise falcon.HTTPNotAcceptable(f"Must accept {content_type}")
+            check(req)
             next(self, req, resp, **kwargs)
         return f
     return decorator
+
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+STREAM_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson"
+}
+
+
+def page_params(req: falcon.Request, key_type=str):
+    """ Reads the ?limit=, ?after= and ?stream= listing parameters from a request. Unless streaming, pages are
+    capped so a single listing never materializes more than MAX_PAGE_SIZE rows. Returns (limit, after, stream) """
+    stream = req.get_param("stream")
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise falcon.HTTPBadRequest(title="Invalid stream format",
+                                    description=f"stream must be one of {', '.join(STREAM_FORMATS)}")
+    limit = req.get_param_as_int("limit", min_value=1, max_value=MAX_PAGE_SIZE)
+    if limit is None and stream is None:
+        limit = DEFAULT_PAGE_SIZE
+    if key_type is int:
+        after = req.get_param_as_int("after")
+    else:
+        after = req.get_param("after")
+    return limit, after, stream
+
+
+def encode_row(row: dict, stream: str, first: bool) -> bytes:
+    """ Renders one row of a streamed listing, including the separator from the row before it """
+    if stream == "ndjson":
+        return json.dumps(row).encode() + b"\n"
+    return (b"" if first else b",") + json.dumps(row).encode()
+
+
+def stream_rows(rows, stream: str):
+    """ A generator rendering rows (as dicts) one at a time, either as a JSON array or as newline-delimited JSON, so
+    the full result set is never held in memory """
+    if stream == "json":
+        yield b"["
+    first = True
+    for row in rows:
+        yield encode_row(row, stream, first)
+        first = False
+    if stream == "json":
+        yield b"]"
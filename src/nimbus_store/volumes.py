@@ -0,0 +1,272 @@
+import hashlib
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import typing
+from os.path import dirname, join
+from uuid import uuid4
+from .ingest import fsync, fsync_dir
+from .layout import blob_path, is_packed, locate
+from .models.local_file import LocalFile
+from .models.segment import PackedBlob, Segment
+from .packs import MOVE_PACKED, pack_store
+
+
+# The file in a volume's root holding the id local_file rows record their blob's volume by, so volumes can be
+# remounted elsewhere or listed in another order
+ID_FILE = ".volume-id"
+# The weight of a volume not given one is its capacity in this many bytes
+WEIGHT_UNIT = 1 << 30
+# Records the volume and path a blob has been copied to, unless it was stored again or collected since it was read
+RELOCATE_BLOB = f"UPDATE [{LocalFile.table_name}] SET [{LocalFile.volume.name}] = ?, [{LocalFile.path.name}] = ? " \
+                f"WHERE [{LocalFile.id.name}] = ? AND [{LocalFile.volume.name}] = ? AND [{LocalFile.path.name}] = ?"
+
+
+def volume_id(root: str) -> str:
+    """ The id of the volume at root, given to it the first time it is used """
+    path = join(root, ID_FILE)
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    fd, tmp = tempfile.mkstemp(dir=root, prefix=".ingest-")
+    try:
+        os.write(fd, uuid4().hex.encode())
+        fsync(fd)
+        os.close(fd)
+        os.link(tmp, path)  # fails, rather than replacing it, if another process got there first
+        fsync_dir(root)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+    with open(path) as f:
+        return f.read().strip()
+
+
+class Volume:
+    """ A filesystem blobs are stored in. Its weight is its share of new blobs, by default its capacity in GiB. A
+    draining volume gets no new blobs, and the rebalancer moves its blobs to the others """
+
+    def __init__(self, root: str, weight: float = None, draining: bool = False):
+        self.root = root
+        self.id = volume_id(root)
+        self.weight = shutil.disk_usage(root).total / WEIGHT_UNIT if weight is None else weight
+        self.draining = draining
+        self.primary = False
+
+    @property
+    def ids(self) -> typing.Tuple[str, ...]:
+        """ The ids rows may record this volume by, including none in the primary volume """
+        return (self.id, "") if self.primary else (self.id,)
+
+    def free(self) -> int:
+        return shutil.disk_usage(self.root).free
+
+
+class Volumes:
+    """ The volumes of a node, the first being the primary. New blobs are placed by weighted rendezvous hashing of their
+    checksum """
+
+    def __init__(self, volumes: typing.List[Volume], reserve: int = 0):
+        """ reserve is how many bytes a volume must have free to be given new blobs, or 0 not to check """
+        if not volumes:
+            raise ValueError("at least one volume is needed")
+        self._volumes = list(volumes)
+        self._by_id = {volume.id: volume for volume in volumes}
+        if len(self._by_id) != len(self._volumes):
+            raise ValueError("the same volume was given more than once")
+        self.primary = self._volumes[0]
+        self.primary.primary = True
+        self.reserve = reserve
+
+    @classmethod
+    def of(cls, volumes: typing.Union[str, "Volumes"]) -> "Volumes":
+        """ volumes as is, or a single volume at the given root """
+        return volumes if isinstance(volumes, Volumes) else cls([Volume(volumes)])
+
+    def __iter__(self) -> typing.Iterator[Volume]:
+        return iter(self._volumes)
+
+    def __len__(self) -> int:
+        return len(self._volumes)
+
+    def get(self, id: str) -> typing.Optional[Volume]:
+        """ The volume with the given id, or None if it isn't one of these """
+        return self.primary if not id else self._by_id.get(id)
+
+    def ranked(self, key: str) -> typing.List[Volume]:
+        """ The volumes which take new blobs, in the order key prefers them """
+        def score(volume: Volume) -> float:
+            digest = hashlib.blake2b(f"{volume.id}/{key}".encode(), digest_size=8).digest()
+            return -volume.weight / math.log((int.from_bytes(digest, "big") + 0.5) / (1 << 64))
+        return sorted((each for each in self._volumes if not each.draining and each.weight > 0), key=score,
+                      reverse=True)
+
+    def place(self, key: str) -> Volume:
+        """ The volume a new blob, or upload, is stored in: the first volume key prefers which has more than reserve
+        bytes free """
+        ranked = self.ranked(key) or [self.primary]
+        if self.reserve > 0:
+            return next((each for each in ranked if each.free() > self.reserve), ranked[0])
+        return ranked[0]
+
+
+def rebalance(volumes: Volumes, db: sqlite3.Connection, config, batch_size: int = 1000, progress=print) -> int:
+    """ Moves every blob which isn't in the volume it would now be placed in there, while the server keeps serving.
+    Returns the number of blobs moved """
+    cursor = db.cursor()
+    stmt = LocalFile.page_statement(LocalFile.id, after=True, limit=True)
+    after = ""
+    moved = 0
+    while True:
+        rows = cursor.execute(stmt, [after, batch_size]).fetchall()
+        if not rows:
+            return moved
+        after = rows[-1][LocalFile.cols().index(LocalFile.id.name)]
+        copied = []
+        for row in rows:
+            local_file = LocalFile.from_db_row(row)
+            checksum = local_file.id.value
+            source, target = volumes.get(local_file.volume.value), volumes.place(checksum)
+            if source is None or source is target:
+                continue
+            if is_packed(local_file):
+                moved += _move_packed(db, source, target, local_file, config)
+                continue
+            fname = locate(source.root, config.layout, local_file)
+            if fname is None:
+                continue  # missing from disk, nothing to move
+            path = blob_path(config.layout, checksum)
+            try:
+                copy_blob(fname, target.root, path)
+            except FileNotFoundError:
+                continue  # collected meanwhile
+            copied.append((fname, [target.id, path, checksum, local_file.volume.value, local_file.path.value]))
+        updated = []
+        for fname, params in copied:
+            if cursor.execute(RELOCATE_BLOB, params).rowcount == 1:  # unless stored again or collected meanwhile
+                updated.append(fname)
+        db.commit()
+        for fname in updated:
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+        moved += len(updated)
+        progress(f"Moved {moved} blobs")
+
+
+def copy_blob(fname: str, root: str, path: str):
+    """ Copies a blob to path in the volume at root, by way of a temporary file so it is only ever there complete """
+    dest = join(root, path)
+    os.makedirs(dirname(dest), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=root, prefix=".ingest-")
+    try:
+        with open(fname, "rb") as src, open(fd, "wb", closefd=False) as out:
+            shutil.copyfileobj(src, out, 1 << 20)
+        os.fchmod(fd, 0o644)
+        fsync(fd)
+        os.close(fd)
+        fd = None
+        os.replace(tmp, dest)
+        fsync_dir(dirname(dest))
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _move_packed(db: sqlite3.Connection, source: Volume, target: Volume, local_file: LocalFile, config) -> bool:
+    checksum = local_file.id.value
+    cursor = db.cursor()
+    row = cursor.execute(PackedBlob.find_by_id_statement(), [checksum]).fetchone()
+    if row is None:
+        return False
+    packed = PackedBlob.from_db_row(row)
+    segment = Segment.from_db_row(cursor.execute(Segment.find_by_id_statement(), [packed.segment_id.value]).fetchone())
+    try:
+        data = pack_store(source, config).read(join(source.root, segment.path.value), packed.offset.value,
+                                               packed.length.value)
+    except FileNotFoundError:
+        return False  # compacted meanwhile, so it is moved on the next run
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        path, moved = pack_store(target, config).append(db, checksum, data)
+        r = cursor.execute(MOVE_PACKED, [moved.segment_id.value, moved.offset.value, checksum,
+                                         packed.segment_id.value, packed.offset.value])
+        if r.rowcount == 1:
+            r = cursor.execute(RELOCATE_BLOB, [target.id, path, checksum, local_file.volume.value,
+                                               local_file.path.value])
+        if r.rowcount != 1:  # stored again or collected meanwhile
+            db.rollback()
+            return False
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return True
+
+
+def parse_volume(value: str) -> typing.Tuple[str, typing.Optional[float]]:
+    """ The root and weight of a PATH[=WEIGHT] argument """
+    root, sep, weight = value.rpartition("=")
+    if not sep:
+        return value, None
+    try:
+        return root, float(weight)
+    except ValueError:
+        return value, None
+
+
+if __name__ == "__main__":
+    import argparse
+    from .config import Config
+    from .db import ConnectionPool
+    from .layout import LAYOUTS
+    parser = argparse.ArgumentParser(
+        description="Moves blobs between the volumes of a node to where they'd now be placed, while the server keeps "
+                    "serving, e.g. after adding a volume or setting one to drain. Start the server with the same "
+                    "volumes first, so new uploads are already placed by them"
+    )
+    parser.add_argument(
+        "db",
+        help="the path to the local instance of the database file"
+    )
+    parser.add_argument(
+        "volumes",
+        help="the volumes of the node, the primary first, as PATH[=WEIGHT]",
+        metavar="PATH[=WEIGHT]",
+        nargs="+"
+    )
+    parser.add_argument(
+        "--drain",
+        help="a volume to move every blob off",
+        metavar="PATH",
+        action="append",
+        default=[]
+    )
+    parser.add_argument(
+        "--layout",
+        help="the layout blobs are moved to in their new volume",
+        choices=LAYOUTS,
+        default="flat"
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="the number of blobs moved per transaction",
+        type=int,
+        default=1000
+    )
+    args = parser.parse_args()
+    roots = [parse_volume(value) for value in args.volumes]
+    volumes = Volumes([Volume(root, weight, root in args.drain) for root, weight in roots])
+    moved = rebalance(volumes, ConnectionPool(args.db).connection(), Config(layout=args.layout), args.batch_size)
+    print(f"Done, moved {moved} blobs")
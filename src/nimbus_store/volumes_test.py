@@ -0,0 +1,65 @@
+import json
+import pytest
+from falcon import testing
+from hashlib import md5
+from os.path import exists, join
+from tempfile import mkdtemp
+from . import API
+from .config import Config
+from .models.segment import PackedBlob, Segment
+from .test import headers_json, headers_binary, migrated_pool
+from .volumes import Volume, Volumes, rebalance
+
+
+@pytest.fixture
+def pool():
+    pool = migrated_pool()
+    return pool
+
+
+def upload(client, data: bytes) -> str:
+    file = {"name": "blob.bin", "mime": "application/octet-stream", "path": "volumes"}
+    id = client.simulate_post("/buckets/spread/files", body=json.dumps(file), headers=headers_json).json["id"]
+    url = f"/buckets/spread/files/{id}/data/{md5(data).hexdigest()}"
+    assert client.simulate_post(url, body=data, headers=headers_binary).status_code == 204
+    return url
+
+
+def stored(volume: Volume, data: bytes) -> bool:
+    return exists(join(volume.root, md5(data).hexdigest()))
+
+
+def test_placement_is_spread_by_weight(pool):
+    volumes = Volumes([Volume(mkdtemp(), 1), Volume(mkdtemp(), 3)])
+    client = testing.TestClient(API(pool, volumes, Config()))
+    client.simulate_post("/buckets", body=json.dumps({"name": "spread", "desc": ""}), headers=headers_json)
+    blobs = [f"blob {i}".encode() for i in range(40)]
+    urls = [upload(client, data) for data in blobs]
+    light, heavy = (sum(stored(volume, data) for data in blobs) for volume in volumes)
+    assert light + heavy == len(blobs)
+    assert 0 < light < heavy
+    for url, data in zip(urls, blobs):
+        assert client.simulate_get(url).content == data
+    keys = [md5(data).hexdigest() for data in blobs]
+    assert [volumes.place(key) for key in keys] == [volumes.place(key) for key in keys]
+
+
+def test_rebalance_drains_a_volume(pool):
+    roots = [mkdtemp(), mkdtemp()]
+    config = Config(pack_threshold=64)
+    client = testing.TestClient(API(pool, Volumes([Volume(roots[0]), Volume(roots[1])]), config))
+    client.simulate_post("/buckets", body=json.dumps({"name": "spread", "desc": ""}), headers=headers_json)
+    blobs = [f"blob {i} ".encode() * (1 if i % 2 else 20) for i in range(20)]
+    urls = [upload(client, data) for data in blobs]
+    draining = Volumes([Volume(roots[0]), Volume(roots[1], draining=True)])
+    assert rebalance(draining, pool.connection(), config, batch_size=7, progress=lambda message: None) > 0
+    kept, drained = draining
+    assert not any(stored(drained, data) for data in blobs)
+    packed = pool.connection().execute(f"SELECT DISTINCT s.[{Segment.volume.name}] FROM [{PackedBlob.table_name}] p "
+                                       f"JOIN [{Segment.table_name}] s ON s.[{Segment.id.name}] = "
+                                       f"p.[{PackedBlob.segment_id.name}]").fetchall()
+    assert packed == [(kept.id,)]
+    client = testing.TestClient(API(pool, draining, config))
+    for url, data in zip(urls, blobs):
+        assert client.simulate_get(url).content == data
+    assert rebalance(draining, pool.connection(), config, progress=lambda message: None) == 0
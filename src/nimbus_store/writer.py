@@ -0,0 +1,130 @@
+import queue
+import sqlite3
+import threading
+import time
+import typing
+import weakref
+from collections import Counter
+from .config import Config
+from .db import ConnectionPool
+from .metrics import metrics
+
+
+# How many seconds the committer waits for writes before its thread stops, to be started again by the next one
+IDLE_TIMEOUT = 1.0
+
+
+def savepoint(db: sqlite3.Connection, fn, *args):
+    """ Calls fn(*args) in a savepoint of the transaction db is in, rolling back what it did if it raises """
+    db.execute("SAVEPOINT write")
+    try:
+        result = fn(*args)
+    except BaseException:
+        db.execute("ROLLBACK TO write")
+        db.execute("RELEASE write")
+        raise
+    db.execute("RELEASE write")
+    return result
+
+
+class Write:
+    """ A write waiting to be committed, and once it is, its result or the exception it raised """
+
+    __slots__ = ("fn", "args", "done", "result", "error")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommitter:
+    """ Commits the writes of concurrent requests together in one transaction, on a thread of its own, so they share
+    the cost of a commit """
+
+    def __init__(self, db: ConnectionPool, config: Config):
+        self._pool = db
+        self._batch_size = config.commit_batch
+        self._interval = config.commit_interval
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread: typing.Optional[threading.Thread] = None
+        self.stats = Counter()
+        metrics.add_source("group_commit", self.counts)
+
+    def counts(self) -> typing.Dict[str, float]:
+        return dict(self.stats)
+
+    def submit(self, fn, *args):
+        """ Calls fn(*args) in the next shared transaction, and returns what it returns once that is committed """
+        if threading.current_thread() is self._thread:
+            return savepoint(self._pool.connection(), fn, *args)  # a write made by a write, in its transaction
+        start = time.perf_counter()
+        write = Write(fn, args)
+        with self._lock:
+            self._queue.put(write)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._commit_writes, name="nimbus-committer", daemon=True)
+                self._thread.start()
+        write.done.wait()
+        metrics.observe("nimbus_group_commit_wait_seconds", time.perf_counter() - start)
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _commit_writes(self):
+        while True:
+            try:
+                writes = [self._queue.get(timeout=IDLE_TIMEOUT)]
+            except queue.Empty:
+                with self._lock:
+                    if self._queue.empty():  # writes are only queued holding the lock, so none can be missed
+                        self._thread = None
+                        self._pool.close()
+                        return
+                continue
+            deadline = time.monotonic() + self._interval
+            while len(writes) < self._batch_size:
+                try:
+                    writes.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self._commit(writes)
+
+    def _commit(self, writes: typing.List[Write]):
+        db = self._pool.connection()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for write in writes:
+                try:
+                    write.result = savepoint(db, write.fn, *write.args)
+                except Exception as e:
+                    write.error = e
+                    self.stats["failed_writes"] += 1
+            db.commit()
+        except Exception as e:
+            if db.in_transaction:
+                db.rollback()
+            for write in writes:
+                write.result, write.error = None, write.error or e
+        self.stats["batches"] += 1
+        self.stats["writes"] += len(writes)
+        for write in writes:
+            write.done.set()
+
+
+_committers = weakref.WeakKeyDictionary()
+_committers_lock = threading.Lock()
+
+
+def group_committer(db: ConnectionPool, config: Config) -> typing.Optional[GroupCommitter]:
+    """ The committer of the given database, made with config on first use, or None if writes aren't grouped """
+    if config.commit_batch <= 1:
+        return None
+    with _committers_lock:
+        committer = _committers.get(db)
+        if committer is None:
+            committer = _committers[db] = GroupCommitter(db, config)
+        return committer
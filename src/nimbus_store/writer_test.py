@@ -0,0 +1,72 @@
+import json
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from falcon import testing
+from tempfile import mkdtemp
+from . import API
+from .config import Config
+from .metrics import metrics
+from .models.bucket import Bucket
+from .test import headers_json, headers_binary, migrated_pool
+from .writer import GroupCommitter
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = migrated_pool()
+    return pool
+
+
+def test_concurrent_writes_share_commits(pool):
+    client = testing.TestClient(API(pool, mkdtemp(), Config(commit_batch=64, commit_interval=0.05)))
+    assert client.simulate_post("/buckets", body=json.dumps({"name": "grouped", "desc": ""}),
+                                headers=headers_json).status_code == 201
+
+    def create(i):
+        file = {"name": f"{i}.txt", "mime": "text/plain", "path": "grouped"}
+        return client.simulate_post("/buckets/grouped/files", body=json.dumps(file), headers=headers_json)
+    with ThreadPoolExecutor(16) as executor:
+        results = list(executor.map(create, range(32)))
+    assert all(result.status_code == 201 for result in results)
+    assert len(client.simulate_get("/buckets/grouped/files", headers=headers_json).json) == 32
+    id, data = results[0].json["id"], b"grouped data"
+    result = client.simulate_post(f"/buckets/grouped/files/{id}/data/{md5(data).hexdigest()}", body=data,
+                                  headers=headers_binary)
+    assert result.status_code == 204
+    assert client.simulate_get(f"/buckets/grouped/files/{id}/data/{md5(data).hexdigest()}").content == data
+    assert client.simulate_delete(f"/buckets/grouped/files/{id}", headers=headers_json).status_code == 204
+    result = client.simulate_post("/buckets", body=json.dumps({"name": "grouped", "desc": ""}), headers=headers_json)
+    assert result.status_code == 409
+
+    lines = metrics.render().splitlines()
+    counts = {line.split()[0]: float(line.split()[1]) for line in lines if line.startswith("nimbus_group_commit_")}
+    assert counts["nimbus_group_commit_writes"] >= 36
+    assert counts["nimbus_group_commit_batches"] < counts["nimbus_group_commit_writes"]
+    assert counts["nimbus_group_commit_wait_seconds_count"] >= 36
+
+
+def test_failed_write_is_rolled_back_alone(pool):
+    committer = GroupCommitter(pool, Config(commit_batch=8, commit_interval=0.05))
+    barrier = threading.Barrier(4)
+
+    def write(name):
+        cursor = pool.connection().cursor()
+        cursor.execute(*Bucket(name=name, desc="").insert_statement())
+        if name == "failed":
+            raise ValueError(name)
+
+    def submit(name):
+        barrier.wait()
+        try:
+            committer.submit(write, name)
+        except ValueError:
+            return False
+        return True
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(submit, ["first", "failed", "second", "third"]))
+    assert results == [True, False, True, True]
+    assert committer.stats["writes"] == 4 and committer.stats["failed_writes"] == 1
+    names = {row[0] for row in pool.connection().execute(f"SELECT [{Bucket.name.name}] FROM [{Bucket.table_name}]")}
+    assert {"first", "second", "third"} <= names and "failed" not in names
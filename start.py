@@ -1,10 +1,13 @@
 #!/usr/bin/env python3.6
 
 import argparse
+import importlib.util
 import os
-import sqlite3
-from src.nimbus_store import API
-from wsgiref import simple_server
+from src.nimbus_store import API, Config, ConnectionPool, Volume, Volumes, background_services
+from src.nimbus_store.ingest import DIGESTS
+from src.nimbus_store.layout import LAYOUTS
+from src.nimbus_store.server import serve
+from src.nimbus_store.volumes import parse_volume
 
 parser = argparse.ArgumentParser(
     description="Nimbus distributed data store service"
@@ -12,7 +15,7 @@ parser = argparse.ArgumentParser(
 
 parser.add_argument(
     'volume',
-    help="the local system path to use as a nimbus storage root"
+    help="the local system path to use as a nimbus storage root, the primary volume, optionally as PATH=WEIGHT"
 )
 
 parser.add_argument(
@@ -26,16 +29,322 @@ parser.add_argument(
     action="store_true"
 )
 
+parser.add_argument(
+    "--import",
+    help="import the files under DIR into the bucket BUCKET, created if need be, then exit rather than serve. Progress "
+         "is saved next to the database, so an interrupted import resumes when run again. Other imports, and more "
+         "options, need python -m src.nimbus_store.importer with a --checkpoint of their own",
+    metavar=("DIR", "BUCKET"),
+    dest="import_tree",
+    nargs=2
+)
+
+parser.add_argument(
+    "--synchronous",
+    help="the sqlite synchronous PRAGMA; NORMAL is crash-safe in WAL mode, FULL also survives power loss",
+    choices=("OFF", "NORMAL", "FULL", "EXTRA"),
+    default="NORMAL"
+)
+
+parser.add_argument(
+    "--cache-size",
+    help="the sqlite page cache size per connection, in KiB",
+    type=int,
+    default=16000
+)
+
+parser.add_argument(
+    "--mmap-size",
+    help="the maximum number of bytes of the database file to memory map per connection",
+    type=int,
+    default=0
+)
+
+parser.add_argument(
+    "-s", "--server",
+    help="how to serve requests: one at a time (simple), from a pool of threads (threaded), from several "
+         "pre-forked worker processes each with a pool of threads (prefork), or as an ASGI app on an event loop "
+         "(asgi, requires uvicorn)",
+    choices=("simple", "threaded", "prefork", "asgi"),
+    default="simple"
+)
+
+parser.add_argument(
+    "--host",
+    help="the address to listen on",
+    default="0.0.0.0"
+)
+
+parser.add_argument(
+    "-p", "--port",
+    help="the port to listen on",
+    type=int,
+    default=4242
+)
+
+parser.add_argument(
+    "-w", "--workers",
+    help="the number of worker processes in prefork mode. SIGHUP the main process to gracefully reload them",
+    type=int,
+    default=os.cpu_count() or 1
+)
+
+parser.add_argument(
+    "-t", "--threads",
+    help="the number of request handling threads per process in threaded and prefork mode, or of database "
+         "threads in asgi mode",
+    type=int,
+    default=8
+)
+
+parser.add_argument(
+    "--io-threads",
+    help="the maximum number of concurrent blob reads and writes in asgi mode",
+    type=int,
+    default=32
+)
+
+parser.add_argument(
+    "--backlog",
+    help="the maximum number of connections waiting to be accepted",
+    type=int,
+    default=128
+)
+
+parser.add_argument(
+    "--keep-alive",
+    help="the maximum number of requests served on one connection before it is closed (1 disables keep-alive)",
+    type=int,
+    default=100
+)
+
+parser.add_argument(
+    "--keep-alive-timeout",
+    help="how many seconds an idle connection is kept open waiting for a request. Kept-alive connections are closed "
+         "sooner while others are waiting for a thread",
+    type=float,
+    default=5.0
+)
+
+parser.add_argument(
+    "--digest",
+    help="the algorithm blobs are content-addressed by; clients must name uploads by a checksum made with it",
+    choices=tuple(DIGESTS),
+    default="md5"
+)
+
+parser.add_argument(
+    "--buffer-size",
+    help="the size of the reads used to ingest uploads, in KiB",
+    type=int,
+    default=1024
+)
+
+parser.add_argument(
+    "--layout",
+    help="how new blobs are arranged in the volume: all in its root (flat), or fanned out over directories named by "
+         "checksum prefix (sharded). Move existing blobs with python -m src.nimbus_store.layout",
+    choices=LAYOUTS,
+    default="flat"
+)
+
+parser.add_argument(
+    "--upload-ttl",
+    help="how many seconds a multipart upload can go without receiving a part before it is abandoned",
+    type=float,
+    default=86400
+)
+
+parser.add_argument(
+    "--gc-interval",
+    help="how many seconds apart unused blobs are deleted in the background, or 0 to run "
+         "python -m src.nimbus_store.collector separately instead",
+    type=float,
+    default=300
+)
+
+parser.add_argument(
+    "--no-background",
+    help="don't expire abandoned uploads or collect unused blobs from this server, e.g. when another node sharing its "
+         "volumes and database does",
+    dest="background",
+    action="store_false"
+)
+
+parser.add_argument(
+    "--gc-rate",
+    help="the most deletions the collector makes per second",
+    type=float,
+    default=1000
+)
+
+parser.add_argument(
+    "--pending-ttl",
+    help="how many seconds a file can stay without data before it is deleted",
+    type=float,
+    default=7 * 86400
+)
+
+parser.add_argument(
+    "--metadata-cache-size",
+    help="how many buckets, and how many files, each worker caches for requests which read",
+    type=int,
+    default=10000
+)
+
+parser.add_argument(
+    "--metadata-cache-ttl",
+    help="how many seconds a cached bucket or file is used for, unless another worker writes meanwhile; 0 turns the "
+         "cache off",
+    type=float,
+    default=5
+)
+
+parser.add_argument(
+    "--compress",
+    help="compress new blobs of files whose mime type matches PATTERN (e.g. text/*) with ENCODING on disk",
+    metavar="PATTERN=ENCODING",
+    action="append",
+    default=[]
+)
+
+parser.add_argument(
+    "--compress-bucket",
+    help="compress all new blobs of the bucket NAME with ENCODING on disk, or store them as is with identity",
+    metavar="NAME=ENCODING",
+    action="append",
+    default=[]
+)
+
+parser.add_argument(
+    "--pack-threshold",
+    help="the size in bytes up to which new blobs are appended to shared segment files rather than stored in files "
+         "of their own, saving an inode and an open per blob; 0 stores every blob in its own file",
+    type=int,
+    default=0
+)
+
+parser.add_argument(
+    "--segment-size",
+    help="the size segments of packed blobs are filled to, in MiB",
+    type=int,
+    default=64
+)
+
+parser.add_argument(
+    "--compact-ratio",
+    help="the fraction of a segment's bytes which must belong to deleted blobs before the collector rewrites it",
+    type=float,
+    default=0.5
+)
+
+parser.add_argument(
+    "--volume",
+    help="another volume to store blobs in, e.g. on another disk. New blobs are spread over the volumes in proportion "
+         "to their WEIGHT, by default their capacity in GiB. Move existing blobs to where they'd now be placed with "
+         "python -m src.nimbus_store.volumes",
+    metavar="PATH[=WEIGHT]",
+    dest="volumes",
+    action="append",
+    default=[]
+)
+
+parser.add_argument(
+    "--drain",
+    help="a volume which gets no new blobs, so it can be emptied with python -m src.nimbus_store.volumes",
+    metavar="PATH",
+    action="append",
+    default=[]
+)
+
+parser.add_argument(
+    "--volume-reserve",
+    help="how many MiB a volume must have free to be given new blobs, which otherwise go to the next volume",
+    type=int,
+    default=0
+)
+
+parser.add_argument(
+    "--commit-batch",
+    help="the most concurrent writes committed together in one transaction, sharing its sync to disk; 1 commits each "
+         "on its own",
+    type=int,
+    default=1
+)
+
+parser.add_argument(
+    "--commit-interval",
+    help="how many milliseconds a write waits for others to be committed along with it, with --commit-batch",
+    type=float,
+    default=2
+)
+
 args = parser.parse_args()
 
-sql_conn = sqlite3.connect(args.db)
+if args.server == "asgi" and importlib.util.find_spec("uvicorn") is None:
+    parser.error("the asgi server mode requires uvicorn to be installed")
+
+
+def policy(option: str, values):
+    pairs = [value.partition("=") for value in values]
+    if not all(sep for _, sep, _ in pairs):
+        parser.error(f"{option} takes arguments of the form KEY=ENCODING")
+    return {key: encoding for key, _, encoding in pairs}
+
+
+def connection_pool():
+    return ConnectionPool(args.db, synchronous=args.synchronous, cache_size=-args.cache_size,
+                          mmap_size=args.mmap_size)
+
+
+try:
+    config = Config(digest=args.digest, buffer_size=args.buffer_size * 1024, layout=args.layout,
+                    upload_ttl=args.upload_ttl, gc_interval=args.gc_interval, gc_rate=args.gc_rate,
+                    pending_ttl=args.pending_ttl, cache_size=args.metadata_cache_size,
+                    cache_ttl=args.metadata_cache_ttl, compression=policy("--compress", args.compress),
+                    bucket_compression=policy("--compress-bucket", args.compress_bucket),
+                    pack_threshold=args.pack_threshold, segment_size=args.segment_size << 20,
+                    compact_ratio=args.compact_ratio, commit_batch=args.commit_batch,
+                    commit_interval=args.commit_interval / 1000)
+    volumes = Volumes([Volume(root, weight, root in args.drain)
+                       for root, weight in map(parse_volume, [args.volume] + args.volumes)],
+                      reserve=args.volume_reserve << 20)
+except ValueError as e:
+    parser.error(str(e))
+
+
+def make_app():
+    """ Called in each worker process, so database connections are only ever opened after forking """
+    if args.server == "asgi":
+        from src.nimbus_store.asgi import AsyncAPI
+        return AsyncAPI(connection_pool(), volumes, config, db_threads=args.threads, io_threads=args.io_threads)
+    return API(connection_pool(), volumes, config)
+
+
+def background():
+    """ Called once, in the worker which runs them in prefork mode, so with database connections of its own """
+    return background_services(connection_pool(), volumes, config)
+
 
 if args.migrate:
-    import migrate as migrate
-    migration = migrate.Migration(os.path.dirname(os.path.realpath(__file__)) + "/db/sqlite/migrations", sql_conn)
+    from src.nimbus_store.migrations import Migration
+    pool = connection_pool()
+    migration = Migration(os.path.dirname(os.path.realpath(__file__)) + "/db/sqlite/migrations", pool.connection())
     migration()
+    pool.close()
 
-app = API(sql_conn, args.volume)
+if args.import_tree:
+    from src.nimbus_store.importer import bulk_import
+    pool = connection_pool()
+    try:
+        counts = bulk_import(pool.connection(), volumes, config, *args.import_tree,
+                             checkpoint=f"{args.db}.import.json")
+    except ValueError as e:
+        parser.error(str(e))
+    pool.close()
+    parser.exit(message=f"Done, imported {counts.get('files', 0)} files, stored {counts.get('blobs', 0)} new blobs and "
+                        f"skipped {counts.get('skipped', 0)} files\n")
 
-httpd = simple_server.make_server("0.0.0.0", 4242, app)
-httpd.serve_forever()
+serve(make_app, args.server, args.host, args.port, workers=args.workers, threads=args.threads, backlog=args.backlog,
+      keep_alive=args.keep_alive, keep_alive_timeout=args.keep_alive_timeout,
+      background=background if args.background else None)